@@ -7,6 +7,33 @@ apt-get install python3 python3-pip -y;
 # Install Python packages required for the app
 pip3 install flask requests gunicorn --break-system-packages;
 
-python3 - <<'EOF' &
-    <GATEKEEPERCODE>
-EOF
\ No newline at end of file
+# The gatekeeper runs as a systemd service. main.py uploads its code to /opt/gatekeeper/gatekeeper.py once this script has completed, then starts it;
+# `systemctl reload gatekeeper` replaces its worker processes gracefully
+echo "Installing the gatekeeper service..."
+mkdir -p /opt/gatekeeper
+
+cat > /etc/gatekeeper.env <<'EOF'
+TRUSTED_HOST_URL=http://<TRUSTEDHOSTIP>:5000
+SERVER_MODE=production
+SERVER_THREADS=16
+EOF
+
+cat > /etc/systemd/system/gatekeeper.service <<'EOF'
+[Unit]
+Description=Gatekeeper
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+EnvironmentFile=/etc/gatekeeper.env
+WorkingDirectory=/opt/gatekeeper
+ExecStart=/usr/bin/python3 /opt/gatekeeper/gatekeeper.py
+ExecReload=/bin/kill -HUP $MAINPID
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+systemctl daemon-reload
+systemctl enable gatekeeper
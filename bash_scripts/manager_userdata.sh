@@ -64,6 +64,7 @@ GRANT REPLICATION SLAVE ON *.* TO 'replica_user'@'%';
 
 CREATE USER 'proxy'@'%' IDENTIFIED WITH mysql_native_password BY 'proxy';
 GRANT SELECT, INSERT, UPDATE, DELETE ON sakila.* TO 'proxy'@'%';
+GRANT REPLICATION CLIENT ON *.* TO 'proxy'@'%';
 FLUSH PRIVILEGES;
 
 START MASTER;
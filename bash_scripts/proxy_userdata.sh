@@ -26,20 +26,46 @@ then
     sudo pip3 install Flask --break-system-packages
 fi
 
-# Start Python Web Server as a background process
-echo "Starting the Python web server..."
+# The proxy runs as a systemd service. main.py uploads its code to /opt/proxy/proxy.py once this script has completed, then starts it;
+# `systemctl reload proxy` replaces its worker processes gracefully. Workers added or removed at runtime are kept in WORKERS_FILE
+echo "Installing the proxy service..."
+mkdir -p /opt/proxy
 
-export WORKERS_IPS='<WORKERIPSCSL>'
-export MANAGER_IP='<MANAGERIP>'
-export MYSQL_DB='sakila'
-export MYSQL_USERNAME='proxy'
-export MYSQL_PASSWORD='proxy'
+# Set by main.py when the cluster has several shards: the shard map the proxy routes the sharded tables with
+SHARD_MAP='<SHARDMAP>'
 
-python3 - <<'EOF' &
-<PROXYCODE>
+cat > /etc/proxy.env <<'EOF'
+WORKERS_IPS=<WORKERIPSCSL>
+MANAGER_IP=<MANAGERIP>
+MYSQL_DB=sakila
+MYSQL_USERNAME=proxy
+MYSQL_PASSWORD=proxy
+SERVER_MODE=production
+SERVER_THREADS=16
+WORKERS_FILE=/opt/proxy/workers.json
 EOF
 
-SERVER_PID=$!
-echo "Web server started with PID $SERVER_PID"
-echo "Press [CTRL+C] to stop the server"
+if [ -n "$SHARD_MAP" ]; then
+    echo "$SHARD_MAP" > /opt/proxy/shard_map.json
+    echo "SHARD_MAP_FILE=/opt/proxy/shard_map.json" >> /etc/proxy.env
+fi
+
+cat > /etc/systemd/system/proxy.service <<'EOF'
+[Unit]
+Description=Proxy
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+EnvironmentFile=/etc/proxy.env
+WorkingDirectory=/opt/proxy
+ExecStart=/usr/bin/python3 /opt/proxy/proxy.py
+ExecReload=/bin/kill -HUP $MAINPID
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+EOF
 
+systemctl daemon-reload
+systemctl enable proxy
@@ -7,7 +7,33 @@ apt-get install python3 python3-pip -y;
 # Install Python packages required for the app
 pip3 install flask requests gunicorn --break-system-packages;
 
+# The trusted host runs as a systemd service. main.py uploads its code to /opt/trusted_host/trusted_host.py once this script has completed, then starts it;
+# `systemctl reload trusted_host` replaces its worker processes gracefully
+echo "Installing the trusted host service..."
+mkdir -p /opt/trusted_host
 
-python3 - <<'EOF' &
-    <TRUSTEDHOSTCODE>
-EOF
\ No newline at end of file
+cat > /etc/trusted_host.env <<'EOF'
+PROXY_URL=http://<PROXYIP>:8080
+SERVER_MODE=production
+SERVER_THREADS=16
+EOF
+
+cat > /etc/systemd/system/trusted_host.service <<'EOF'
+[Unit]
+Description=Trusted host
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+EnvironmentFile=/etc/trusted_host.env
+WorkingDirectory=/opt/trusted_host
+ExecStart=/usr/bin/python3 /opt/trusted_host/trusted_host.py
+ExecReload=/bin/kill -HUP $MAINPID
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+systemctl daemon-reload
+systemctl enable trusted_host
@@ -16,6 +16,9 @@ echo "Manager IP address = $MANAGER_IP"
 MANAGER_LOG_FILE='<MANAGERLOGFILE>'
 MANAGER_LOG_POSITION='<MANAGERLOGPOSITION>'
 
+# 'sakila' to import the Sakila sample database, 'snapshot' to import the snapshot of the manager uploaded by main.py, taken at the binlog position above
+SEED='<SEED>'
+
 # Install MySQL server
 echo "Installing MySQL server..."
 apt-get install mysql-server -y;
@@ -53,28 +56,37 @@ DROP DATABASE IF EXISTS test;
 DELETE FROM mysql.db WHERE Db='test' OR Db='test\\_%';
 FLUSH PRIVILEGES;"
 
-# Download the Sakila database schema and data
-echo "Downloading Sakila database..."
-cd /tmp
-wget https://downloads.mysql.com/docs/sakila-db.tar.gz
-
-# Extract the downloaded tar file
-echo "Extracting Sakila database..."
-tar -xzvf sakila-db.tar.gz
-
-# Import the Sakila database into MySQL
-echo "Creating and importing the Sakila database..."
-mysql -u root -p$ROOT_PASSWORD -e "CREATE DATABASE sakila;"
-mysql -u root -p$ROOT_PASSWORD sakila < /tmp/sakila-db/sakila-schema.sql
-mysql -u root -p$ROOT_PASSWORD sakila < /tmp/sakila-db/sakila-data.sql
-
-echo "Sakila database installed successfully!"
+if [ "$SEED" = "snapshot" ]; then
+    # A worker added to a running cluster starts from the manager's current data, which main.py uploads once the instance is up
+    echo "Waiting for the manager snapshot..."
+    while [ ! -f /tmp/manager_snapshot.done ]; do sleep 5; done
+    mysql -u root -p$ROOT_PASSWORD < /tmp/manager_snapshot.sql
+    echo "Manager snapshot imported successfully!"
+else
+    # Download the Sakila database schema and data
+    echo "Downloading Sakila database..."
+    cd /tmp
+    wget https://downloads.mysql.com/docs/sakila-db.tar.gz
+
+    # Extract the downloaded tar file
+    echo "Extracting Sakila database..."
+    tar -xzvf sakila-db.tar.gz
+
+    # Import the Sakila database into MySQL
+    echo "Creating and importing the Sakila database..."
+    mysql -u root -p$ROOT_PASSWORD -e "CREATE DATABASE sakila;"
+    mysql -u root -p$ROOT_PASSWORD sakila < /tmp/sakila-db/sakila-schema.sql
+    mysql -u root -p$ROOT_PASSWORD sakila < /tmp/sakila-db/sakila-data.sql
+
+    echo "Sakila database installed successfully!"
+fi
 
 systemctl restart mysql;
 
 mysql -u root -p$ROOT_PASSWORD -e "
 CREATE USER 'proxy'@'%' IDENTIFIED WITH mysql_native_password BY 'proxy';
 GRANT SELECT ON sakila.* TO 'proxy'@'%';
+GRANT REPLICATION CLIENT ON *.* TO 'proxy'@'%';
 FLUSH PRIVILEGES;
 
 CHANGE MASTER TO
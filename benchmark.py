@@ -1,92 +1,250 @@
-import logging
-import time
-import random
-import requests
-from rich.console import Console
-
-requests_number = 1000
-
-logger = logging.getLogger(__name__)
-console = Console()
-
-'''
-Description: Generates a SQL query to count the number of records in the 'actor' table.
-Outputs: str - The SQL `SELECT` query as a string, designed to return the count of records in the 'actor' table.
-'''
-def generate_read_query(self):
-    return "SELECT count(*) FROM actor;"
-
-'''
-Description: Generates a SQL query to insert a new record into the 'actor' table with randomly generated first and last names.
-Outputs: str - The SQL `INSERT` query as a string, with randomly generated first and last names for the 'actor' table.
-'''
-def generate_write_query(self):
-    first_name = f"Name{random.randint(1, 1000)}"
-    last_name = f"Surname{random.randint(1, 1000)}"
-    return f"INSERT INTO actor (first_name, last_name) VALUES ('{first_name}', '{last_name}');"
-
-'''
-Description: Sends a POST request with a query and implementation to a specified URL and returns the server's response.
-Inputs: 
-    query (str) - The query to be sent in the request.
-    implementation (str) - The implementation detail or additional information to be sent with the query.
-    url (str) - The URL where the query and implementation will be sent.
-Outputs: 
-    dict - A dictionary containing the response data in JSON format, or an error message if the request fails.
-'''
-def send_query(self, query: str, implementation: str, url: str):
-    try:
-        response = requests.post(url, json={"query": query, "implementation": implementation})
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        return {"error": str(e)}
-
-'''
-Description: Runs a benchmark to measure the performance of different implementations (direct, random, and ping) 
-by sending read and write queries, tracking success rates, and recording execution times and dispersion of reads.
-'''
-def load_test(self):
-    gatekeeper_ip = self.get_public_ip(self.inst_wrapper.instances[5]["InstanceId"])
-    url = f"http://{gatekeeper_ip}:5000/query"
-    execution_times = {}
-    dispersion_of_reads_dict = {}
-    
-    for implementation in range(1, 4): # 1: direct, 2: random, 3: ping
-        dispersion_of_reads = {}
-        read_success = 0
-        write_success = 0
-        print(f"Running benchmark for implementation {implementation}...")
-        initial_time = time.time()
-        for _ in range(requests_number):
-            query = self.generate_read_query()
-            result = self.send_query(query, implementation, url)
-            if "error" not in result:
-                receiver = result["receiver"]
-                if receiver in dispersion_of_reads:
-                    dispersion_of_reads[receiver] += 1
-                else:
-                    dispersion_of_reads[receiver] = 1
-                read_success += 1
-            else:
-                print(f"Read error: {result['error']}")
-                break
-
-        for _ in range(requests_number):
-            query = self.generate_write_query()
-            result = self.send_query(query, implementation, url)
-            if "error" not in result:
-                write_success += 1
-            else:
-                print(f"Write error: {result['error']}")
-                break
-            
-        execution_times[implementation] = time.time() - initial_time
-        dispersion_of_reads_dict[implementation] = dispersion_of_reads
-        print(f"Read success: {read_success}/{requests_number}")
-        print(f"Write success: {write_success}/{requests_number}")
-    
-    # output the data to ./output/benchmark_results.txt
-    with open("./output/benchmark_results.txt", "w") as f:
-        f.write(f"Execution times: {execution_times}\n")
-        f.write(f"Dispersion of reads: {dispersion_of_reads_dict}\n")
\ No newline at end of file
+import argparse
+import json
+import logging
+import math
+import os
+import threading
+import time
+import random
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from rich.console import Console
+
+requests_number = 1000
+
+logger = logging.getLogger(__name__)
+console = Console()
+
+'''
+Description: Generates a SQL query to count the number of records in the 'actor' table.
+Outputs: str - The SQL `SELECT` query as a string, designed to return the count of records in the 'actor' table.
+'''
+def generate_read_query():
+    return "SELECT count(*) FROM actor;"
+
+'''
+Description: Generates a SQL query to insert a new record into the 'actor' table with randomly generated first and last names.
+Inputs: parameterized (bool, optional) - Return a statement template and its parameters instead of a query with the values inlined.
+Outputs: tuple - The SQL `INSERT` query as a string, with randomly generated first and last names for the 'actor' table,
+         and its parameters (None unless `parameterized`).
+'''
+def generate_write_query(parameterized: bool = False):
+    first_name = f"Name{random.randint(1, 1000)}"
+    last_name = f"Surname{random.randint(1, 1000)}"
+    if parameterized:
+        return "INSERT INTO actor (first_name, last_name) VALUES (%s, %s);", [first_name, last_name]
+    return f"INSERT INTO actor (first_name, last_name) VALUES ('{first_name}', '{last_name}');", None
+
+'''
+Description: A latency histogram with logarithmic buckets, each `growth` times wider than the previous one, so percentiles are
+reported with a bounded relative error (2.5% by default) in constant memory whatever the number of requests.
+Inputs: growth (float, optional) - The ratio between the bounds of consecutive buckets.
+'''
+class LatencyHistogram:
+    def __init__(self, growth: float = 1.05):
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.buckets = {}  # bucket index -> count, bucket i covers [growth^i, growth^(i+1)) microseconds
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        micros = max(seconds * 1e6, 1.0)
+        index = int(math.log(micros) / self._log_growth)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent: float):
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # Middle of the bucket, capped by the extremes actually observed
+                micros = self.growth ** (index + 0.5)
+                return min(max(micros / 1e6, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'min_ms': round(self.min * 1000, 3),
+            'mean_ms': round(self.total / self.count * 1000, 3),
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p95_ms': round(self.percentile(95) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+            'p999_ms': round(self.percentile(99.9) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+'''
+Description: Collects the outcome of every request of one benchmark run. Thread-safe.
+'''
+class RunResults:
+    def __init__(self):
+        self.latency = {'READ': LatencyHistogram(), 'WRITE': LatencyHistogram(), 'ALL': LatencyHistogram()}
+        self.success = {'READ': 0, 'WRITE': 0}
+        self.errors = {'READ': 0, 'WRITE': 0}
+        self.status_codes = {}
+        self.error_samples = []
+        self._lock = threading.Lock()
+
+    def record(self, query_type: str, seconds: float, status, error: str = None):
+        with self._lock:
+            self.latency[query_type].record(seconds)
+            self.latency['ALL'].record(seconds)
+            self.status_codes[str(status)] = self.status_codes.get(str(status), 0) + 1
+            if error is None:
+                self.success[query_type] += 1
+            else:
+                self.errors[query_type] += 1
+                if len(self.error_samples) < 10:
+                    self.error_samples.append(error)
+
+_sessions = threading.local()
+
+'''
+Description: Sends a query to the gatekeeper and reports how it went. Each client thread keeps its own keep-alive HTTP session.
+Inputs:
+    url (str) - The gatekeeper URL the query is posted to.
+    query (str) - The SQL query.
+    query_type (str) - 'READ' or 'WRITE'.
+    mode (str) - The routing mode for READ queries.
+    params (list, optional) - The parameters of a parameterized query.
+Outputs: tuple - (HTTP status code or None, error message or None).
+'''
+def send_query(url: str, query: str, query_type: str, mode: str, params: list = None):
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    try:
+        payload = {"query": query, "query_type": query_type, "mode": mode}
+        if params is not None:
+            payload["params"] = params
+        response = session.post(url, json=payload, timeout=30)
+        body = response.json()
+        if response.status_code != 200 or (isinstance(body, dict) and "error" in body):
+            return response.status_code, str(body.get("error") if isinstance(body, dict) else body)
+        return response.status_code, None
+    except (requests.RequestException, ValueError) as e:
+        return None, str(e)
+
+'''
+Description: Issues one request of a benchmark run and records its latency, measured from the time the request was scheduled
+rather than sent, so that queueing in the load generator under overload is not hidden (coordinated omission).
+'''
+def issue_request(results: RunResults, url: str, mode: str, write_ratio: float, scheduled: float, parameterized: bool = False):
+    query_type = 'WRITE' if random.random() < write_ratio else 'READ'
+    query, params = generate_write_query(parameterized) if query_type == 'WRITE' else (generate_read_query(), None)
+    status, error = send_query(url, query, query_type, mode, params)
+    results.record(query_type, time.perf_counter() - scheduled, status, error)
+
+'''
+Description: Runs the benchmark for one routing mode and returns its results.
+With `qps`, the load is open-loop: requests are started at a fixed rate whether or not earlier ones completed, with at most
+`concurrency` of them in flight (later ones wait, and that wait counts in their latency). Without `qps`, the load is closed-loop:
+`concurrency` clients each send their next request as soon as the previous one completed.
+Inputs:
+    url (str) - The gatekeeper URL queries are posted to.
+    mode (str) - The routing mode for READ queries.
+    total (int) - The number of requests to send.
+    write_ratio (float) - The fraction of requests that are WRITEs.
+    concurrency (int) - The maximum number of requests in flight.
+    qps (float, optional) - The target request rate for open-loop load.
+    parameterized (bool, optional) - Send WRITEs as statement templates with parameters.
+Outputs: dict - Request counts, errors, throughput and READ/WRITE/overall latency percentiles.
+'''
+def load_test(url: str, mode: str, total: int, write_ratio: float, concurrency: int, qps: float = None, parameterized: bool = False):
+    results = RunResults()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if qps:
+            for i in range(total):
+                scheduled = start + i / qps
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(issue_request, results, url, mode, write_ratio, scheduled, parameterized)
+        else:
+            counter = iter(range(total))
+            counter_lock = threading.Lock()
+
+            def client():
+                while True:
+                    with counter_lock:
+                        if next(counter, None) is None:
+                            return
+                    issue_request(results, url, mode, write_ratio, time.perf_counter(), parameterized)
+
+            for _ in range(concurrency):
+                executor.submit(client)
+    duration = time.perf_counter() - start
+
+    completed = results.latency['ALL'].count
+    return {
+        'requests': completed,
+        'reads': results.success['READ'] + results.errors['READ'],
+        'writes': results.success['WRITE'] + results.errors['WRITE'],
+        'errors': results.errors,
+        'error_samples': results.error_samples,
+        'status_codes': results.status_codes,
+        'duration_s': round(duration, 3),
+        'target_qps': qps,
+        'throughput_qps': round(completed / duration, 2) if duration else None,
+        'latency': {query_type.lower(): histogram.summary() for query_type, histogram in results.latency.items()},
+    }
+
+'''
+Description: Returns the default gatekeeper URL, read from the `instances_ips.json` file written by main.py.
+'''
+def default_url():
+    with open("instances_ips.json", "r") as f:
+        instance_ips = json.load(f)
+    return f"http://{instance_ips['gatekeeper_ip']}:5000/"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gatekeeper -> trusted host -> proxy -> MySQL chain for each routing mode.")
+    parser.add_argument("--url", help="Gatekeeper URL queries are posted to (default: gatekeeper in instances_ips.json)")
+    parser.add_argument("--modes", default="direct,random,customized,p2c,least_outstanding", help="Comma separated READ routing modes to benchmark")
+    parser.add_argument("--requests", type=int, default=2 * requests_number, help="Requests per routing mode")
+    parser.add_argument("--write-ratio", type=float, default=0.5, help="Fraction of WRITE queries")
+    parser.add_argument("--concurrency", type=int, default=16, help="Maximum requests in flight (closed-loop clients without --qps)")
+    parser.add_argument("--qps", type=float, help="Target request rate for open-loop load")
+    parser.add_argument("--parameterized", action="store_true", help="Send WRITEs as statement templates with parameters, run as prepared statements")
+    parser.add_argument("--output", default="./output/benchmark_results.json", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    url = args.url or default_url()
+    report = {
+        'config': {
+            'url': url,
+            'requests': args.requests,
+            'write_ratio': args.write_ratio,
+            'concurrency': args.concurrency,
+            'qps': args.qps,
+            'load': 'open-loop' if args.qps else 'closed-loop',
+            'parameterized': args.parameterized,
+        },
+        'modes': {},
+    }
+    for mode in args.modes.split(','):
+        console.print(f"Running benchmark for mode {mode}...")
+        result = load_test(url, mode, args.requests, args.write_ratio, args.concurrency, args.qps, args.parameterized)
+        report['modes'][mode] = result
+        latency = result['latency']['all']
+        console.print(f"{mode}: {result['throughput_qps']} qps, p50 {latency.get('p50_ms')} ms, p99 {latency.get('p99_ms')} ms, "
+                      f"errors {result['errors']}")
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    console.print(f"Results saved to {args.output}")
@@ -1,55 +1,746 @@
-from flask import Flask, request, jsonify
-import requests
-import logging
-import json
-
-app = Flask(__name__)
-
-with open("instances_ips.json", "r") as f:
-        instance_ips = json.load(f)
-
-trusted_host_ip = instance_ips["trusted_host_ip"]
-
-TRUSTED_HOST_URL = f"http://{trusted_host_ip}:5000"
-
-# Logs configuration
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("GatekeeperApp")
-
-'''
-Description: A simple health check route that responds with a confirmation message to indicate that the Trusted Host is running and accessible.
-Outputs: A plain text message "Trusted Host OK" with a status code of 200 indicating that the Trusted Host is operational.
-'''
-@app.route("/", methods=["GET"])
-def health_check():
-    logger.info("Health check requested")
-    return "Gatekeeper OK", 200
-
-'''
-Description: Validates the incoming POST request data, logs the information, and forwards the query to a trusted host. 
-Returns the response from the trusted host.
-Inputs: JSON body (dict) containing the query data to be validated and forwarded.
-Outputs: JSON response (dict) containing:
-        - The result of the query from the trusted host if successful.
-        - An error message if the request format is invalid or if an error occurs while forwarding the request.
-'''
-@app.route("/", methods=["POST"])
-def validate_and_forward():
-    # Basic data validation
-    data = request.json
-    logger.info(f"Received data: {data}")
-    if not data or "query" not in data:
-        logger.warning("Invalid request format")
-        return jsonify({"error": "Invalid request format"}), 400
-
-    # Transmits the query to the trusted host
-    try:
-        response = requests.post(f"{TRUSTED_HOST_URL}/query", json=data)
-        logger.info(f"Response from trusted host: {response.status_code}")
-        return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error forwarding request: {str(e)}")
-        return jsonify({"error": str(e)}), 500
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+from flask import Flask, g, request, jsonify
+from collections import OrderedDict
+from functools import partial
+import requests
+import threading
+import time
+import uuid
+import logging
+import json
+import math
+import os
+import queue
+import random
+import re
+
+import service_common
+
+app = Flask(__name__)
+
+# The trusted host can be set explicitly (e.g. by local_cluster.py), otherwise it is read from the IPs exported by main.py
+TRUSTED_HOST_URL = os.getenv("TRUSTED_HOST_URL")
+
+if not TRUSTED_HOST_URL:
+    with open("instances_ips.json", "r") as f:
+            instance_ips = json.load(f)
+
+    trusted_host_ip = instance_ips["trusted_host_ip"]
+
+    TRUSTED_HOST_URL = f"http://{trusted_host_ip}:5000"
+
+# Optional trace log: a sample of the requests is appended to TRACE_LOG_PATH as JSON lines, with their timing breakdown across the three hops
+trace_sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+trace_log_path = os.getenv("TRACE_LOG_PATH", "traces.log")
+
+# Admission control, with separate limits for READs and WRITEs. Rate limits are in requests per second, 0 disables them
+read_rate_limit = float(os.getenv("READ_RATE_LIMIT", "0"))
+write_rate_limit = float(os.getenv("WRITE_RATE_LIMIT", "0"))
+client_read_rate_limit = float(os.getenv("CLIENT_READ_RATE_LIMIT", "0"))
+client_write_rate_limit = float(os.getenv("CLIENT_WRITE_RATE_LIMIT", "0"))
+rate_limit_burst = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "1"))  # a bucket holds this many seconds worth of requests
+client_buckets_max = int(os.getenv("CLIENT_BUCKETS_MAX", "10000"))
+read_max_concurrency = int(os.getenv("READ_MAX_CONCURRENCY", "64"))
+write_max_concurrency = int(os.getenv("WRITE_MAX_CONCURRENCY", "32"))
+read_max_queue = int(os.getenv("READ_MAX_QUEUE", "128"))
+write_max_queue = int(os.getenv("WRITE_MAX_QUEUE", "64"))
+admission_queue_timeout = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1"))
+
+# Calls to the trusted host: timeouts in seconds (to connect, and to wait for data once connected), retries (see `service_common.CountedRetry`)
+# and connections kept alive, by default one per forwarding slot
+upstream_connect_timeout = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3"))
+upstream_timeout = float(os.getenv("UPSTREAM_TIMEOUT", "30"))
+
+# Deadlines: the time budget of a request in milliseconds when the client sets none in the `X-Request-Budget-Ms` header, and the largest accepted.
+# The remaining budget is passed on to the trusted host and the proxy; a wait for the next hop may outlast it by `DEADLINE_GRACE` seconds,
+# the time the next hop has to answer with its own deadline error
+default_deadline_ms = float(os.getenv("DEFAULT_DEADLINE_MS", "30000"))
+max_deadline_ms = float(os.getenv("MAX_DEADLINE_MS", "60000"))
+deadline_grace = float(os.getenv("DEADLINE_GRACE", "0.5"))
+upstream_max_retries = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+upstream_retry_backoff = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.05"))
+upstream_pool_max_size = int(os.getenv("UPSTREAM_POOL_SIZE", str(read_max_concurrency + write_max_concurrency)))
+
+# Request logging, done by a background thread: a sample of the requests is logged (warnings and errors always are), with payloads truncated
+request_log_sample_rate = float(os.getenv("REQUEST_LOG_SAMPLE_RATE", "1"))
+request_log_max_payload = int(os.getenv("REQUEST_LOG_MAX_PAYLOAD", "500"))
+request_log_queue_size = int(os.getenv("REQUEST_LOG_QUEUE_SIZE", "10000"))
+request_log_batch_size = int(os.getenv("REQUEST_LOG_BATCH_SIZE", "256"))
+
+# SQL validation policy. Denied tables are "table", "schema.table" or "schema.*" entries; without allowed tables every other table is allowed
+sql_allowed_statements = os.getenv("SQL_ALLOWED_STATEMENTS", "select,insert,update,delete,replace")
+sql_allowed_tables = os.getenv("SQL_ALLOWED_TABLES", "")
+sql_denied_tables = os.getenv("SQL_DENIED_TABLES", "mysql.*,information_schema.*,performance_schema.*,sys.*")
+sql_allow_multi_statements = os.getenv("SQL_ALLOW_MULTI_STATEMENTS", "false").lower() == "true"
+sql_verdict_cache_size = int(os.getenv("SQL_VERDICT_CACHE_SIZE", "10000"))
+
+# Logs configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("GatekeeperApp")
+
+metrics_registry = []  # every Metric, in the order they are rendered on the `/metrics` endpoint
+Metric = partial(service_common.Metric, metrics_registry)
+
+http_requests = Metric("http_requests_total", "counter", "HTTP requests handled, by method, route and status code.", ("method", "route", "status"))
+http_request_latency = Metric("http_request_duration_seconds", "histogram",
+                              "Time to handle an HTTP request, up to the response headers for streamed responses, by method and route.", ("method", "route"))
+
+'''
+Description: Records the start time of every request, for the per-route latency histogram, gives the request the ID
+it is traced under through the trusted host and the proxy, and starts its deadline from the budget the client set in the
+`X-Request-Budget-Ms` header (`DEFAULT_DEADLINE_MS` when there is none, at most `MAX_DEADLINE_MS`).
+'''
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.request_id = uuid.uuid4().hex
+    try:
+        budget = float(request.headers.get("X-Request-Budget-Ms", default_deadline_ms))
+    except ValueError:
+        budget = default_deadline_ms
+    g.deadline = time.monotonic() + min(budget, max_deadline_ms) / 1000
+
+'''
+Description: Records the count and latency of every request, labelled with the route that matched it rather than the raw path.
+Inputs: response (flask.Response) - The response about to be sent.
+Outputs: flask.Response - The same response.
+'''
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if "request_start" in g:
+        http_request_latency.observe(time.perf_counter() - g.request_start, request.method, route)
+    http_requests.inc(request.method, route, str(response.status_code))
+    return response
+
+trace_log = None
+trace_log_lock = threading.Lock()
+
+'''
+Description: Appends the trace of a request to the trace log: its ID, route, status, the backend that served it and every timing span
+of its `Server-Timing` header, in milliseconds. The log file is opened on first use.
+Inputs: response (flask.Response) - The response of the request, with its trace headers set.
+'''
+def write_trace(response):
+    global trace_log
+    spans = {}
+    for entry in response.headers.get("Server-Timing", "").split(","):
+        name, _, duration = entry.strip().partition(";dur=")
+        if name and duration:
+            spans[name] = float(duration)
+    record = {
+        "request_id": g.request_id,
+        "timestamp": time.time(),
+        "route": request.url_rule.rule if request.url_rule else "unmatched",
+        "status": response.status_code,
+        "backend": response.headers.get("X-Backend"),
+        "spans": spans,
+    }
+    try:
+        with trace_log_lock:
+            if trace_log is None:
+                trace_log = open(trace_log_path, "a", buffering=1)
+            trace_log.write(json.dumps(record) + "\n")
+    except OSError as e:
+        logger.error(f"Error writing trace log: {str(e)}")
+
+'''
+Description: Adds the request ID and the timing breakdown to every response. The `Server-Timing` header carries the spans reported by the
+trusted host, then 'gatekeeper_validate' (SQL validation), 'gatekeeper_upstream' (waiting for the trusted host) and 'gatekeeper' (the whole request in this service), in milliseconds.
+For a streamed result, the spans stop when the first rows are about to be sent.
+Inputs: response (flask.Response) - The response about to be sent.
+Outputs: flask.Response - The same response with the `X-Request-ID` and `Server-Timing` headers.
+'''
+@app.after_request
+def add_trace_headers(response):
+    timings = [g.upstream_timing] if g.get("upstream_timing") else []
+    if "validation_duration" in g:
+        timings.append(f"gatekeeper_validate;dur={g.validation_duration * 1000:.3f}")
+    if "upstream_duration" in g:
+        timings.append(f"gatekeeper_upstream;dur={g.upstream_duration * 1000:.3f}")
+    if "request_start" in g:
+        timings.append(f"gatekeeper;dur={(time.perf_counter() - g.request_start) * 1000:.3f}")
+    response.headers["Server-Timing"] = ", ".join(timings)
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    if trace_sample_rate > 0 and random.random() < trace_sample_rate:
+        write_trace(response)
+    return response
+
+request_log_dropped = Metric("gatekeeper_request_log_dropped_total", "counter", "Log records dropped because the request log queue was full.")
+request_log_pending = Metric("gatekeeper_request_log_pending", "gauge", "Log records waiting to be written.")
+
+'''
+Description: Logs requests without slowing them down. The request thread only decides whether the request is sampled and queues the raw record;
+a background thread formats the records (truncating payloads to `max_payload` characters) and writes them, up to `batch_size` per wake-up.
+When the queue is full, records are dropped and counted instead of blocking the request. The writer thread is started on first use,
+in the process that serves requests.
+Inputs:
+    logger (logging.Logger) - The logger the records are written to.
+    sample_rate (float) - The fraction of requests whose INFO records are logged. WARNING and above are always logged.
+    max_payload (int) - The maximum number of characters of a payload that are logged.
+    queue_size (int) - The maximum number of records waiting to be written.
+    batch_size (int) - The maximum number of records written per wake-up of the writer thread.
+'''
+class AsyncRequestLog:
+    def __init__(self, logger: logging.Logger, sample_rate: float, max_payload: int, queue_size: int, batch_size: int):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.max_payload = max_payload
+        self.batch_size = max(batch_size, 1)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    '''
+    Description: Queues a log record of the current request. All the INFO records of a request are either logged or sampled out together.
+    Inputs:
+        level (int) - The logging level.
+        message (str) - The message.
+        payload (optional) - A value appended to the message, formatted and truncated by the writer thread.
+    '''
+    def log(self, level: int, message: str, payload=None):
+        if level < logging.WARNING:
+            if "log_sampled" not in g:
+                g.log_sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+            if not g.log_sampled:
+                return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((level, g.get("request_id"), message, payload))
+        except queue.Full:
+            request_log_dropped.inc()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for level, request_id, message, payload in batch:
+                try:
+                    self.logger.log(level, self._format(request_id, message, payload))
+                except Exception:
+                    pass
+
+    def _format(self, request_id: str, message: str, payload):
+        if payload is not None:
+            text = str(payload)
+            if len(text) > self.max_payload:
+                text = f"{text[:self.max_payload]}... ({len(text)} characters)"
+            message = f"{message}: {text}"
+        return f"[{request_id}] {message}" if request_id else message
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.run, daemon=True)
+                    self._thread.start()
+
+request_log = AsyncRequestLog(logger, request_log_sample_rate, request_log_max_payload, request_log_queue_size, request_log_batch_size)
+
+'''
+Description: A token bucket rate limiter. The bucket holds up to `capacity` tokens and is refilled at `rate` tokens per second;
+a request is admitted if it can take its cost in tokens.
+Inputs:
+    rate (float) - Tokens added per second.
+    capacity (float) - The maximum number of tokens, i.e. the largest burst admitted at once.
+'''
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    '''
+    Description: Takes `cost` tokens if the bucket holds them. A cost above the capacity is capped to it, so that it can still be admitted.
+    Outputs: float - 0 if the tokens were taken, otherwise the number of seconds until the bucket holds enough of them.
+    '''
+    def take(self, cost: float = 1.0):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            cost = min(cost, self.capacity)
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0.0
+            return (cost - self.tokens) / self.rate
+
+'''
+Description: Caps the number of requests forwarded at the same time. Requests over the cap wait in a bounded queue for at most `queue_timeout`
+seconds; once the queue is full, or the wait timed out, they are turned away instead of adding to the backlog of every hop behind the gatekeeper.
+Inputs:
+    max_concurrency (int) - The maximum number of requests in flight.
+    max_queue (int) - The maximum number of requests waiting for a slot.
+    queue_timeout (float) - The maximum time a request waits for a slot, in seconds.
+'''
+class ConcurrencyLimiter:
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    '''
+    Description: Takes a slot, waiting in the queue if none is free, at most until the request's deadline.
+    Inputs: deadline (float, optional) - The monotonic time the request must be answered by.
+    Outputs: str or None - None once the request holds a slot, otherwise why it was turned away: 'queue_full', 'queue_timeout' or 'deadline_exceeded'.
+    '''
+    def acquire(self, deadline: float = None):
+        with self._cond:
+            if self.active < self.max_concurrency and not self.waiting:
+                self.active += 1
+                return None
+            if self.waiting >= self.max_queue:
+                return "queue_full"
+            self.waiting += 1
+            timeout = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.max_concurrency:
+                    now = time.monotonic()
+                    if deadline is not None and deadline <= min(timeout, now):
+                        return "deadline_exceeded"
+                    if timeout <= now:
+                        return "queue_timeout"
+                    self._cond.wait(min(timeout, deadline) - now if deadline is not None else timeout - now)
+                self.active += 1
+                return None
+            finally:
+                self.waiting -= 1
+
+    '''
+    Description: Frees a slot and wakes every waiting request: a single wakeup could go to a request that is giving up at its timeout or deadline,
+    leaving the slot free while others keep waiting. The queue is at most `max_queue` long.
+    '''
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+global_buckets = {
+    "READ": TokenBucket(read_rate_limit, read_rate_limit * rate_limit_burst) if read_rate_limit > 0 else None,
+    "WRITE": TokenBucket(write_rate_limit, write_rate_limit * rate_limit_burst) if write_rate_limit > 0 else None,
+}
+client_rate_limits = {"READ": client_read_rate_limit, "WRITE": client_write_rate_limit}
+client_buckets = OrderedDict()  # (client address, query type) -> TokenBucket, least recently used first
+client_buckets_lock = threading.Lock()
+limiters = {
+    "READ": ConcurrencyLimiter(read_max_concurrency, read_max_queue, admission_queue_timeout),
+    "WRITE": ConcurrencyLimiter(write_max_concurrency, write_max_queue, admission_queue_timeout),
+}
+
+admission_rejections = Metric("gatekeeper_admission_rejected_total", "counter", "Requests turned away by admission control, by query type and reason.",
+                              ("query_type", "reason"))
+admission_active = Metric("gatekeeper_admission_active", "gauge", "Requests currently forwarded, by query type.", ("query_type",))
+admission_waiting = Metric("gatekeeper_admission_waiting", "gauge", "Requests waiting for a forwarding slot, by query type.", ("query_type",))
+
+'''
+Description: Returns the token bucket of a client for a query type, creating it on first use. Only the `CLIENT_BUCKETS_MAX` most recently
+seen buckets are kept, so a client that was evicted starts again from a full bucket.
+Inputs:
+    client (str) - The client address.
+    query_type (str) - 'READ' or 'WRITE'.
+Outputs: TokenBucket or None - The bucket, or None if clients are not rate limited for this query type.
+'''
+def client_bucket(client: str, query_type: str):
+    rate = client_rate_limits[query_type]
+    if rate <= 0:
+        return None
+    key = (client, query_type)
+    with client_buckets_lock:
+        bucket = client_buckets.get(key)
+        if bucket is None:
+            bucket = client_buckets[key] = TokenBucket(rate, rate * rate_limit_burst)
+            if len(client_buckets) > client_buckets_max:
+                client_buckets.popitem(last=False)
+        else:
+            client_buckets.move_to_end(key)
+        return bucket
+
+'''
+Description: Admission control for the query routes, run before the request is validated. A request is classified as a WRITE if it holds
+any WRITE query, and must then pass the client's and the global token bucket of its query type (a batch costs one token per query),
+and get a forwarding slot from the concurrency limiter of its query type before its deadline.
+Outputs: None if the request is admitted, otherwise a JSON error response: 429 when a rate limit is exceeded and 503 when the gatekeeper
+        is overloaded, both with a `Retry-After` header, or 504 when the deadline passed while the request waited for a slot.
+'''
+@app.before_request
+def admit_request():
+    if request.method != "POST" or request.url_rule is None or request.url_rule.rule not in ("/", "/query/batch"):
+        return None
+    data = request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+    if request.url_rule.rule == "/query/batch":
+        queries = data.get("queries") if isinstance(data.get("queries"), list) else []
+        is_write = any(isinstance(item, dict) and item.get("query_type") == "WRITE" for item in queries)
+        cost = max(len(queries), 1)
+    else:
+        is_write = data.get("query_type") == "WRITE"
+        cost = 1
+    query_type = "WRITE" if is_write else "READ"
+
+    for scope, bucket in (("client_rate", client_bucket(request.remote_addr, query_type)), ("global_rate", global_buckets[query_type])):
+        wait = bucket.take(cost) if bucket else 0.0
+        if wait:
+            admission_rejections.inc(query_type, scope)
+            return jsonify({"error": "Rate limit exceeded"}), 429, {"Retry-After": str(math.ceil(wait))}
+
+    reason = limiters[query_type].acquire(g.deadline)
+    if reason == "deadline_exceeded":
+        admission_rejections.inc(query_type, reason)
+        deadline_exceeded.inc("admission")
+        return jsonify({"error": "Deadline exceeded"}), 504
+    if reason:
+        admission_rejections.inc(query_type, reason)
+        request_log.log(logging.WARNING, f"Shedding {query_type} request: {reason}")
+        return jsonify({"error": "Gatekeeper overloaded"}), 503, {"Retry-After": str(math.ceil(max(admission_queue_timeout, 1)))}
+    g.admission_slot = limiters[query_type]
+    return None
+
+'''
+Description: Gives the forwarding slot of an admitted request back once its response has been sent, including the whole body of a streamed response.
+Inputs: response (flask.Response) - The response about to be sent.
+Outputs: flask.Response - The same response.
+'''
+@app.after_request
+def release_admission_slot(response):
+    limiter = g.pop("admission_slot", None)
+    if limiter is not None:
+        response.call_on_close(limiter.release)
+    return response
+
+# Literals, comments and whitespace, replaced to turn a query into its fingerprint. MySQL runs the content of `/*! */` comments and
+# reads optimizer hints from `/*+ */` ones: those are kept as a `/*!` or `/*+` marker, which `QueryValidator.check` rejects
+LITERAL_PATTERN = re.compile(r''''(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|(`[^`]*`)|/\*([!+]?).*?\*/|(?:--\s|#)[^\n]*|\b0x[0-9a-f]+\b|\b\d+(?:\.\d*)?(?:e[+-]?\d+)?\b|(\s+)''',
+                             re.IGNORECASE | re.DOTALL)
+LIST_PATTERN = re.compile(r"\?(?:\s*,\s*\?)+")
+ROWS_PATTERN = re.compile(r"(\(\s*\?\+?\s*\))(?:\s*,\s*\(\s*\?\+?\s*\))+")
+READ_STATEMENTS = {"select", "show", "describe", "desc", "explain"}
+
+# Tokens of a fingerprint walked by `fingerprint_tables`: names, possibly qualified or backticked, parentheses and commas
+TABLE_TOKEN_PATTERN = re.compile(r"(?:`[^`]*`|\w+)(?:\.(?:`[^`]*`|\w+))?|[(),]")
+# Keywords followed by a table reference. After those of TABLE_LIST_KEYWORDS, a comma at the same depth starts another table reference
+TABLE_KEYWORDS = {"from", "join", "straight_join", "into", "update", "table"}
+TABLE_LIST_KEYWORDS = {"from", "update", "join", "straight_join"}
+# Keywords ending a list of table references; a comma after the condition of a join (ON, USING) still starts another one
+CLAUSE_KEYWORDS = {"where", "group", "order", "limit", "having", "union", "set", "select", "values", "value", "for", "lock", "window",
+                   "partition", "procedure", "returning", "on", "using"}
+# Modifiers that may come between a table keyword and the table reference
+TABLE_MODIFIERS = {"low_priority", "high_priority", "delayed", "ignore", "quick", "lateral", "only", "dual"}
+# Reading or writing files of the MySQL server
+FILE_ACCESS_PATTERN = re.compile(r"\binto\s+(?:outfile|dumpfile)\b|\bload_file\s*\(")
+
+'''
+Description: Turns a query into its fingerprint: string and numeric literals become `?`, lists of literals `?+` and lists of rows `(?+)+`,
+comments are dropped (executable comments and optimizer hints are reduced to their marker), whitespace is collapsed and the text is lower-cased.
+Queries that only differ in their literals share a fingerprint.
+Inputs: query (str) - The SQL query.
+Outputs: str - The fingerprint.
+'''
+def fingerprint(query: str):
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        if match.group(2):
+            return f" /*{match.group(2)} "
+        if match.group(3) or match.group(0).startswith(("/*", "--", "#")):
+            return " "
+        return "?"
+    text = LITERAL_PATTERN.sub(replace, query).strip().lower()
+    text = ROWS_PATTERN.sub(r"\1+", LIST_PATTERN.sub("?+", text))
+    return text.rstrip("; ")
+
+'''
+Description: Lists the tables a fingerprint reads or writes, as lower-cased "table" or "schema.table" names without backticks.
+The fingerprint is walked token by token: a name is a table when it follows a table keyword (see `TABLE_KEYWORDS`), or a comma in a list
+of table references. Parentheses around table references, as in `from a, (b join c)`, keep the list going inside them, while a subquery
+starts lists of its own.
+Inputs: text (str) - The query fingerprint.
+Outputs: set - The table names.
+'''
+def fingerprint_tables(text: str):
+    tables = set()
+    in_list = [False]  # per parenthesis depth: whether a comma starts another table reference
+    expect = False  # whether the next name is a table reference
+    previous = None
+    for token in TABLE_TOKEN_PATTERN.findall(text):
+        if token == "(":
+            in_list.append(expect and previous != "using")
+        elif token == ")":
+            if len(in_list) > 1:
+                in_list.pop()
+            expect = False
+        elif token == ",":
+            expect = in_list[-1]
+        elif token in TABLE_KEYWORDS:
+            expect = True
+            in_list[-1] = token in TABLE_LIST_KEYWORDS
+        elif token in CLAUSE_KEYWORDS:
+            expect = False
+            if token not in ("on", "using"):
+                in_list[-1] = False
+        elif expect and token not in TABLE_MODIFIERS:
+            tables.add(token.replace("`", ""))
+            expect = False
+        previous = token
+    return tables
+
+'''
+Description: Validates queries against the SQL policy of the gatekeeper: allowed statement types, allowed and denied tables, multi-statements,
+and the statement type matching the query type (a READ must be a SELECT, SHOW, DESCRIBE or EXPLAIN, since it may be sent to a replica).
+Each query is reduced to its fingerprint, and the verdict is cached per fingerprint and query type in a bounded LRU, so a query shape seen
+before costs one fingerprinting pass and one lookup.
+Inputs:
+    allowed_statements (set) - The statement types (first keywords) allowed.
+    allowed_tables (set) - The only tables allowed, or an empty set to allow every table that is not denied.
+    denied_tables (set) - The denied "table", "schema.table" or "schema.*" entries.
+    allow_multi_statements (bool) - Whether several statements separated by `;` are allowed in one query.
+    cache_size (int) - The maximum number of cached verdicts.
+'''
+class QueryValidator:
+    def __init__(self, allowed_statements: set, allowed_tables: set, denied_tables: set, allow_multi_statements: bool, cache_size: int):
+        self.allowed_statements = allowed_statements
+        self.allowed_tables = allowed_tables
+        self.denied_tables = denied_tables
+        self.allow_multi_statements = allow_multi_statements
+        self.cache_size = max(cache_size, 1)
+        self._verdicts = OrderedDict()  # (query type, fingerprint) -> rejection reason or None, least recently used first
+        self._lock = threading.Lock()
+
+    '''
+    Description: Validates a query.
+    Inputs:
+        query (str) - The SQL query.
+        query_type (str) - 'READ' or 'WRITE'.
+    Outputs: str or None - Why the query is rejected, or None if it is allowed.
+    '''
+    def validate(self, query: str, query_type: str):
+        key = (query_type, fingerprint(query))
+        with self._lock:
+            if key in self._verdicts:
+                self._verdicts.move_to_end(key)
+                validation_cache.inc("hit")
+                return self._verdicts[key]
+        validation_cache.inc("miss")
+        verdict = self.check(key[1], query_type)
+        with self._lock:
+            self._verdicts[key] = verdict
+            if len(self._verdicts) > self.cache_size:
+                self._verdicts.popitem(last=False)
+        return verdict
+
+    def check(self, text: str, query_type: str):
+        if not text:
+            return "empty query"
+        if "/*!" in text or "/*+" in text:
+            return "executable comments and optimizer hints are not allowed"
+        if not self.allow_multi_statements and ";" in text:
+            return "multiple statements"
+        if FILE_ACCESS_PATTERN.search(text):
+            return "reading or writing server files is not allowed"
+        statement = text.lstrip("( ").split(" ", 1)[0]
+        if statement not in self.allowed_statements:
+            return f"{statement.upper()} statements are not allowed"
+        if (query_type == "READ") != (statement in READ_STATEMENTS):
+            return f"{statement.upper()} is not a {query_type} statement"
+        for table in fingerprint_tables(text):
+            schema = table.split(".", 1)[0] if "." in table else None
+            if table in self.denied_tables or table.split(".")[-1] in self.denied_tables or (schema and f"{schema}.*" in self.denied_tables):
+                return f"table {table} is not allowed"
+            if self.allowed_tables and table.split(".")[-1] not in self.allowed_tables and table not in self.allowed_tables:
+                return f"table {table} is not allowed"
+        return None
+
+validation_latency = Metric("gatekeeper_validation_duration_seconds", "histogram", "Time spent validating the queries of a request.")
+validation_cache = Metric("gatekeeper_validation_cache_total", "counter", "Query validations answered from the verdict cache (hit) or computed (miss).", ("result",))
+validation_rejections = Metric("gatekeeper_validation_rejected_total", "counter", "Requests rejected by SQL validation, by query type.", ("query_type",))
+
+validator = QueryValidator({statement.strip().lower() for statement in sql_allowed_statements.split(",") if statement.strip()},
+                           {table.strip().lower() for table in sql_allowed_tables.split(",") if table.strip()},
+                           {table.strip().lower() for table in sql_denied_tables.split(",") if table.strip()},
+                           sql_allow_multi_statements, sql_verdict_cache_size)
+
+'''
+Description: Validates the queries of a request and records the time it took, in the validation metrics and the `Server-Timing` header.
+Inputs: items (list) - Query objects with 'query' and 'query_type' keys.
+Outputs: str or None - Why the request is rejected, naming the query for a batch, or None if every query is allowed.
+'''
+def validate_queries(items: list):
+    start = time.perf_counter()
+    reason = None
+    for index, item in enumerate(items):
+        query, query_type = item.get("query"), item.get("query_type")
+        if not isinstance(query, str) or query_type not in ("READ", "WRITE"):
+            reason = "Invalid request format"
+        else:
+            reason = validator.validate(query, query_type)
+        if reason:
+            validation_rejections.inc(query_type if query_type in ("READ", "WRITE") else "unknown")
+            if len(items) > 1:
+                reason = f"query {index}: {reason}"
+            break
+    elapsed = time.perf_counter() - start
+    validation_latency.observe(elapsed)
+    g.validation_duration = elapsed
+    return reason
+
+deadline_exceeded = Metric("deadline_exceeded_total", "counter", "Requests answered with a 504 because their deadline passed, by stage: waiting for a forwarding slot or for the trusted host.", ("stage",))
+
+'''
+Description: Raised when the deadline of the current request has passed; answered with a 504 (see `deadline_exceeded_response`).
+'''
+class DeadlineExceeded(Exception):
+    pass
+
+'''
+Description: Returns the time left to the current request before its deadline.
+Outputs: float - The remaining budget in seconds, negative once the deadline has passed.
+'''
+def remaining_budget():
+    return g.deadline - time.monotonic()
+
+'''
+Description: Answers a request whose deadline passed with a distinct error, so that the client can tell it from a failure of the backend.
+Inputs: e (DeadlineExceeded) - The exception raised.
+Outputs: JSON error response with a 504 status code.
+'''
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded_response(e):
+    request_log.log(logging.WARNING, "Deadline exceeded", e)
+    return jsonify({"error": "Deadline exceeded"}), 504
+
+# Calls to the trusted host, over keep-alive connections shared by every request
+upstream = service_common.Upstream("trusted_host", metrics_registry, upstream_pool_max_size, upstream_max_retries, upstream_retry_backoff)
+
+'''
+Description: Sends a request to the trusted host over the shared keep-alive session, under the current request ID, giving up after `UPSTREAM_CONNECT_TIMEOUT` seconds to connect or `UPSTREAM_TIMEOUT` seconds without data (at most the request's remaining budget), and records its latency and failures in the upstream metrics.
+The remaining budget is passed on in the `X-Request-Budget-Ms` header, for the trusted host to enforce. The time spent waiting for the trusted host and the timing spans it reported are kept for the `Server-Timing` header of the response.
+Inputs:
+    method (str) - The HTTP method.
+    path (str) - The path on the trusted host, e.g. "/query".
+    **kwargs - Passed on to `requests.Session.request`. The response is expected to be relayed (see `service_common.Upstream.relay`), which releases its connection.
+Outputs: requests.Response - The response of the trusted host.
+Raises: requests.exceptions.RequestException if the trusted host cannot be reached, DeadlineExceeded if the request's deadline passed first.
+'''
+def call_upstream(method: str, path: str, **kwargs):
+    remaining = remaining_budget()
+    if remaining <= 0:
+        deadline_exceeded.inc("upstream")
+        raise DeadlineExceeded("Deadline exceeded before calling the trusted host")
+    kwargs.setdefault("headers", {})["X-Request-ID"] = g.request_id
+    kwargs["headers"]["X-Request-Budget-Ms"] = str(int(remaining * 1000))
+    kwargs.setdefault("timeout", (min(upstream_connect_timeout, remaining), min(upstream_timeout, remaining + deadline_grace)))
+    start = time.perf_counter()
+    upstream.track_connection(1)
+    try:
+        response = upstream.session.request(method, f"{TRUSTED_HOST_URL}{path}", **kwargs)
+    except requests.exceptions.RequestException as e:
+        upstream.track_connection(-1)
+        if remaining_budget() <= 0:
+            deadline_exceeded.inc("upstream")
+            raise DeadlineExceeded("Deadline exceeded waiting for the trusted host") from e
+        upstream.errors.inc("trusted_host", path)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        upstream.latency.observe(elapsed, "trusted_host", path)
+        g.upstream_duration = g.get("upstream_duration", 0.0) + elapsed
+    if response.status_code >= 500:
+        upstream.errors.inc("trusted_host", path)
+    g.upstream_timing = response.headers.get("Server-Timing")
+    return response
+
+'''
+Description: Exposes request counts and latency histograms per route, the latency, failures and connection pool of the calls to the trusted host,
+the state of admission control and the request log queue, in the Prometheus text format.
+Outputs: A plain text response in the Prometheus exposition format.
+'''
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    upstream.collect_pool_metrics()
+    request_log_pending.set(request_log.pending())
+    for query_type, limiter in limiters.items():
+        admission_active.set(limiter.active, query_type)
+        admission_waiting.set(limiter.waiting, query_type)
+    return service_common.metrics_response(metrics_registry)
+
+'''
+Description: A simple health check route that responds with a confirmation message to indicate that the Trusted Host is running and accessible.
+Outputs: A plain text message "Trusted Host OK" with a status code of 200 indicating that the Trusted Host is operational.
+'''
+@app.route("/", methods=["GET"])
+def health_check():
+    request_log.log(logging.INFO, "Health check requested")
+    return "Gatekeeper OK", 200
+
+'''
+Description: Validates the incoming POST request data, logs the information, and forwards the query to a trusted host. 
+The request body is forwarded and the response of the trusted host relayed as raw bytes (see `service_common.Upstream.relay`); streamed (NDJSON) results are relayed as they arrive.
+Inputs: JSON body (dict) containing the query data to be validated and forwarded.
+Outputs: JSON response (dict) containing:
+        - The result of the query from the trusted host if successful.
+        - An error message if the request format is invalid or if an error occurs while forwarding the request.
+'''
+@app.route("/", methods=["POST"])
+def validate_and_forward():
+    # Basic data validation
+    data = request.json
+    request_log.log(logging.INFO, "Received data", data)
+    if not data or "query" not in data:
+        request_log.log(logging.WARNING, "Invalid request format")
+        return jsonify({"error": "Invalid request format"}), 400
+
+    reason = validate_queries([data])
+    if reason:
+        request_log.log(logging.WARNING, "Query rejected", reason)
+        return jsonify({"error": f"Query rejected: {reason}"}), 403
+
+    # Transmits the query to the trusted host
+    try:
+        response = call_upstream("POST", "/query", stream=True, **service_common.raw_body())
+        request_log.log(logging.INFO, "Response from trusted host", response.status_code)
+        return upstream.relay(response)
+    except requests.exceptions.RequestException as e:
+        request_log.log(logging.ERROR, "Error forwarding request", e)
+        return jsonify({"error": str(e)}), 500
+
+'''
+Description: Validates an incoming batch of queries and forwards it to the trusted host's batch endpoint.
+Relays the response from the trusted host as raw bytes.
+Inputs: JSON body (dict) containing a 'queries' list, each entry with the same format as a single query.
+Outputs: JSON response (list) with one result per query if successful, or an error message if the request format is invalid
+        or if an error occurs while forwarding the request.
+'''
+@app.route("/query/batch", methods=["POST"])
+def validate_and_forward_batch():
+    data = request.json
+    request_log.log(logging.INFO, "Received batch", data)
+    if not data or not isinstance(data.get("queries"), list) or not all(isinstance(item, dict) and "query" in item for item in data["queries"]):
+        request_log.log(logging.WARNING, "Invalid batch format")
+        return jsonify({"error": "Invalid request format"}), 400
+
+    reason = validate_queries(data["queries"])
+    if reason:
+        request_log.log(logging.WARNING, "Batch rejected", reason)
+        return jsonify({"error": f"Query rejected: {reason}"}), 403
+
+    try:
+        response = call_upstream("POST", "/query/batch", stream=True, **service_common.raw_body())
+        request_log.log(logging.INFO, "Response from trusted host", response.status_code)
+        return upstream.relay(response)
+    except requests.exceptions.RequestException as e:
+        request_log.log(logging.ERROR, "Error forwarding batch", e)
+        return jsonify({"error": str(e)}), 500
+
+if __name__ == "__main__":
+    service_common.serve(app, 5000)
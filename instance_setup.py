@@ -7,16 +7,18 @@ Description: Creates a security group in the specified VPC that allows HTTP traf
 Inputs: 
     vpc_id (str) - The ID of the VPC where the security group will be created.
     group_name (str) - The name to assign to the new security group.
+    ec2 (boto3.resources.base.ServiceResource, optional) - The EC2 resource to use, e.g. a local stand-in. A new session's by default.
 Outputs: 
     security_group_id (str) - The ID of the created security group.
 '''
 # Function that creates a security group in the specified VPC,
 # Allows HTTP traffic on port 80
 # Returns the security group ID
-def createSecurityGroup(vpc_id: str, group_name: str):
+def createSecurityGroup(vpc_id: str, group_name: str, ec2=None):
     # Create EC2 Client
-    session = boto3.Session()
-    ec2 = session.resource('ec2')
+    if ec2 is None:
+        session = boto3.Session()
+        ec2 = session.resource('ec2')
 
     response = ec2.create_security_group(GroupName=group_name,
                                          Description='Description',
@@ -52,7 +54,36 @@ def createSecurityGroup(vpc_id: str, group_name: str):
     return security_group_id
 
 '''
-Description: Creates an EC2 instance with the specified parameters and waits for it to enter the running state.
+Description: Creates a key pair and saves its private key to a .pem file readable only by its owner.
+Inputs:
+    key_name (str) - The name of the key pair.
+    pem_file_path (str) - The path of the .pem file.
+    ec2 (boto3.resources.base.ServiceResource, optional) - The EC2 resource to use, e.g. a local stand-in. A new session's by default.
+Outputs:
+    key_pair (boto3.KeyPair) - The created key pair.
+'''
+def createKeyPair(key_name: str, pem_file_path: str, ec2=None):
+    if ec2 is None:
+        session = boto3.Session()
+        ec2 = session.resource('ec2')
+
+    key_pair = ec2.create_key_pair(KeyName=key_name)
+
+    # Change security to be able to write
+    if os.path.exists(pem_file_path):
+        os.chmod(pem_file_path, stat.S_IWUSR)
+
+    with open(pem_file_path, 'w') as pem_file:
+        pem_file.write(key_pair.key_material)
+
+    # Change file permissions to 400 to protect the private key
+    os.chmod(pem_file_path, stat.S_IRUSR)
+    return key_pair
+
+'''
+Description: Launches EC2 instances with the specified parameters without waiting for them, tagged with their name at launch.
+Their private IP addresses are known as soon as they are launched, so instances configured with them can be launched right away;
+their public IP addresses are set once they run (see `waitForInstances`).
 Inputs: 
     instanceType (str) - The type of instance to create (e.g., 't2.micro').
     minCount (int) - The minimum number of instances to launch.
@@ -62,17 +93,17 @@ Inputs:
     subnet_id (str) - The subnet ID where the instance will be launched.
     user_data (str) - The user data script to configure the instance at launch.
     instance_name (str) - The name to assign to the created instance.
+    ec2 (boto3.resources.base.ServiceResource, optional) - The EC2 resource to use, e.g. a local stand-in. A new session's by default.
 Outputs: 
-    instances (list) - A list of created instance objects.
+    instances (list) - A list of launched instance objects.
 '''
-def createInstance(instanceType: str, minCount: int, maxCount: int, key_pair, security_id: str, subnet_id: str, user_data: str, instance_name: str):
-    
-    # Create EC2 Client
-    session = boto3.Session()
-    ec2 = session.resource('ec2')
+def launchInstances(instanceType: str, minCount: int, maxCount: int, key_pair, security_id: str, subnet_id: str, user_data: str, instance_name: str,
+                    ec2=None):
+    if ec2 is None:
+        session = boto3.Session()
+        ec2 = session.resource('ec2')
 
-
-    instances = ec2.create_instances(
+    return ec2.create_instances(
         ImageId='ami-0e86e20dae9224db8',
         InstanceType=instanceType,
         MinCount=minCount,
@@ -83,16 +114,58 @@ def createInstance(instanceType: str, minCount: int, maxCount: int, key_pair, se
         UserData=user_data,
         Monitoring={
             'Enabled': True
+        },
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': [{'Key': 'Name', 'Value': instance_name}]}]
+    )
+
+'''
+Description: Waits until all the given instances pass their status checks, with a single batched waiter polling them together,
+then refreshes them so that their public IP addresses are set.
+Inputs:
+    instances (list) - The instance objects to wait for.
+    ec2_client (botocore.client.EC2, optional) - The EC2 client to use, e.g. a local stand-in. A new client by default.
+    delay (int, optional) - Seconds between two polls.
+    max_attempts (int, optional) - Polls before giving up.
+'''
+def waitForInstances(instances: list, ec2_client=None, delay: int = 15, max_attempts: int = 40):
+    if ec2_client is None:
+        ec2_client = boto3.client('ec2')
+
+    print(f"Waiting for instances {[instance.id for instance in instances]} to pass their status checks...")
+    ec2_client.get_waiter('instance_status_ok').wait(
+        InstanceIds=[instance.id for instance in instances],
+        WaiterConfig={
+            'Delay': delay,
+            'MaxAttempts': max_attempts
         }
     )
+    for instance in instances:
+        instance.reload()
+    print(f"Instances {[instance.id for instance in instances]} are up and running.")
+
+'''
+Description: Creates an EC2 instance with the specified parameters and waits for it to enter the running state.
+Inputs: 
+    instanceType (str) - The type of instance to create (e.g., 't2.micro').
+    minCount (int) - The minimum number of instances to launch.
+    maxCount (int) - The maximum number of instances to launch.
+    key_pair (boto3.KeyPair) - The key pair used for SSH access.
+    security_id (str) - The security group ID associated with the instance.
+    subnet_id (str) - The subnet ID where the instance will be launched.
+    user_data (str) - The user data script to configure the instance at launch.
+    instance_name (str) - The name to assign to the created instance.
+    ec2 (boto3.resources.base.ServiceResource, optional) - The EC2 resource to use, e.g. a local stand-in. A new session's by default.
+Outputs: 
+    instances (list) - A list of created instance objects.
+'''
+def createInstance(instanceType: str, minCount: int, maxCount: int, key_pair, security_id: str, subnet_id: str, user_data: str, instance_name: str,
+                   ec2=None):
+    instances = launchInstances(instanceType, minCount, maxCount, key_pair, security_id, subnet_id, user_data, instance_name, ec2)
 
     # Wait until the instances are running
     for instance in instances:
         print(f"Waiting for instance {instance.id} to enter running state...")
         instance.wait_until_running()
         print(f"Instance {instance.id} is now running.")
-        
-        # Add tags to the instance, used for identifying FastAPI- from ELB-instances
-        instance.create_tags(Tags=[{'Key': 'Name', 'Value': instance_name}])
     
     return instances
@@ -0,0 +1,461 @@
+"""
+Local benchmark topology: runs the gatekeeper, the trusted host and the proxy on loopback ports in a single process, with the MySQL
+manager and workers replaced by stand-in nodes backed by one embedded SQLite database. The stand-ins are reached through `connect`,
+which has the same contract as `proxy.connect_to_mysql`, and each node can be given extra latency, a failure rate or be taken down.
+A running statement can be killed with `KILL QUERY <connection id>`, like on MySQL. With `--shards`, the rentals are spread over several
+replication groups, each with a database of its own, and the proxy is given the shard map.
+
+Usage:
+    python3 local_cluster.py --workers 2 --worker-latency-ms 1,5
+    python3 local_cluster.py --workers 2 --shards 3
+    python3 benchmark.py --url http://127.0.0.1:15000/
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+from mysql.connector import errors
+from werkzeug.serving import make_server
+
+import provisioning
+
+BINLOG_FILE = 'local-bin.000001'
+
+'''
+Description: Creates a small Sakila-like schema (the `actor` table and a `rental` table for large scans) and fills it.
+Inputs:
+    path (str) - The SQLite database file.
+    rentals (int) - The number of rows in the `rental` table.
+'''
+def create_schema(path: str, rentals: int):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS actor (
+            actor_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            first_name TEXT NOT NULL,
+            last_name TEXT NOT NULL,
+            last_update TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS rental (
+            rental_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rental_date TEXT NOT NULL,
+            inventory_id INTEGER NOT NULL,
+            customer_id INTEGER NOT NULL,
+            staff_id INTEGER NOT NULL
+        );
+    """)
+    conn.executemany("INSERT INTO actor (first_name, last_name) VALUES (?, ?)",
+                     [(f"NAME{i}", f"SURNAME{i}") for i in range(200)])
+    conn.executemany("INSERT INTO rental (rental_date, inventory_id, customer_id, staff_id) VALUES (?, ?, ?, ?)",
+                     [(f"2005-05-{1 + i % 28:02d} 22:53:30", i % 4581 + 1, i % 599 + 1, i % 2 + 1) for i in range(rentals)])
+    conn.commit()
+    conn.close()
+
+'''
+Description: A stand-in MySQL server. All nodes of a replication group share the same SQLite database, so replication is immediate: workers
+always report zero lag and the manager's current binlog position.
+Inputs:
+    backend (LocalBackend) - The backend the node belongs to.
+    name (str) - The node's host name, as used in MANAGER_IP / WORKERS_IPS.
+    latency (float) - Seconds added to every statement (and to every connection attempt).
+    failure_rate (float) - Probability that a statement fails with a lost connection.
+    path (str, optional) - The SQLite database file of the node's replication group; the backend's by default.
+The node counts the statements prepared on it and the executions of prepared statements, to check how well they are reused.
+'''
+class LocalNode:
+    def __init__(self, backend, name: str, latency: float = 0.0, failure_rate: float = 0.0, path: str = None):
+        self.backend = backend
+        self.name = name
+        self.path = path or backend.path
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.down = False
+        self.prepares = 0
+        self.prepared_executions = 0
+
+'''
+Description: The set of stand-in nodes and the database they share. Tracks a binlog position that advances with every committed WRITE,
+and the open connections by ID, for `KILL QUERY`.
+Inputs:
+    path (str) - The SQLite database file.
+'''
+class LocalBackend:
+    def __init__(self, path: str):
+        self.path = path
+        self.nodes = {}
+        self.position = 0
+        self._lock = threading.Lock()
+        self._connection_ids = itertools.count(1)
+        self.connections = {}
+
+    def add_node(self, name: str, latency: float = 0.0, failure_rate: float = 0.0, path: str = None):
+        self.nodes[name] = LocalNode(self, name, latency, failure_rate, path)
+        return self.nodes[name]
+
+    def advance_position(self, writes: int = 1):
+        with self._lock:
+            self.position += writes
+            return self.position
+
+    '''
+    Description: Connects to a stand-in node, with the same contract as `proxy.connect_to_mysql`.
+    Inputs:
+        host (str) - The node's host name.
+        port (int) - Ignored.
+    Outputs: LocalConnection or None if the node does not exist or is down.
+    '''
+    def connect(self, host: str, port):
+        node = self.nodes.get(host)
+        if node is None or node.down:
+            time.sleep(0.01)
+            return None
+        time.sleep(node.latency)
+        conn = LocalConnection(node, next(self._connection_ids))
+        with self._lock:
+            self.connections[conn.connection_id] = conn
+        return conn
+
+'''
+Description: A connection to a stand-in node, implementing the part of the mysql.connector connection interface used by the proxy.
+The connection starts in autocommit mode, like the ones opened by `proxy.connect_to_mysql`.
+'''
+class LocalConnection:
+    def __init__(self, node: LocalNode, connection_id: int):
+        self.node = node
+        self.connection_id = connection_id
+        self.autocommit = True
+        self.in_transaction = False
+        self.pending_writes = 0
+        self._db = sqlite3.connect(node.path, isolation_level=None, check_same_thread=False, timeout=10)
+        self._open = True
+        self._interrupted = threading.Event()
+
+    def cursor(self, dictionary: bool = False, prepared: bool = False, **kwargs):
+        return LocalCursor(self, dictionary, prepared)
+
+    def start_transaction(self):
+        self._execute_control("BEGIN")
+        self.in_transaction = True
+
+    def commit(self):
+        if self.in_transaction:
+            self._execute_control("COMMIT")
+            self.in_transaction = False
+            self.node.backend.advance_position(self.pending_writes)
+            self.pending_writes = 0
+
+    def rollback(self):
+        if self.in_transaction:
+            self._execute_control("ROLLBACK")
+            self.in_transaction = False
+            self.pending_writes = 0
+
+    def is_connected(self):
+        return self._open and not self.node.down
+
+    def ping(self, reconnect: bool = False, attempts: int = 1, delay: int = 0):
+        if not self.is_connected():
+            raise errors.InterfaceError(msg="Connection to the local node is not available", errno=2006)
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self._db.close()
+            with self.node.backend._lock:
+                self.node.backend.connections.pop(self.connection_id, None)
+
+    '''
+    Description: Interrupts the statement running on the connection, which fails with MySQL's "Query execution was interrupted" error.
+    The connection stays open.
+    '''
+    def kill_query(self):
+        self._interrupted.set()
+        self._db.interrupt()
+
+    def _wait(self, seconds: float):
+        if self._interrupted.wait(seconds):
+            raise errors.DatabaseError(msg="Query execution was interrupted", errno=1317)
+
+    def _execute_control(self, statement: str):
+        self._check_open()
+        try:
+            self._db.execute(statement)
+        except sqlite3.Error as e:
+            raise translate_error(e)
+
+    def _check_open(self):
+        if not self.is_connected():
+            self._open = False
+            raise errors.OperationalError(msg="Lost connection to MySQL server during query", errno=2013)
+
+SHOW_REPLICA_PATTERN = re.compile(r"^\s*show\s+(replica|slave)\s+status\s*;?\s*$", re.IGNORECASE)
+SHOW_MASTER_PATTERN = re.compile(r"^\s*show\s+(master|binary\s+log)\s+status\s*;?\s*$", re.IGNORECASE)
+KILL_QUERY_PATTERN = re.compile(r"^\s*kill\s+query\s+(\d+)\s*;?\s*$", re.IGNORECASE)
+READ_PATTERN = re.compile(r"^\s*(select|show|with|explain|set)\b", re.IGNORECASE)
+
+'''
+Description: Maps a SQLite error to the mysql.connector error the proxy would see from MySQL in the same situation.
+Inputs: error (sqlite3.Error) - The SQLite error.
+Outputs: mysql.connector.Error - The matching MySQL error.
+'''
+def translate_error(error: sqlite3.Error):
+    message = str(error)
+    if isinstance(error, sqlite3.IntegrityError):
+        return errors.IntegrityError(msg=message, errno=1062)
+    if 'interrupted' in message:
+        return errors.DatabaseError(msg="Query execution was interrupted", errno=1317)
+    if 'locked' in message or 'busy' in message:
+        return errors.DatabaseError(msg=message, errno=1205)
+    if 'no such table' in message:
+        return errors.ProgrammingError(msg=message, errno=1146)
+    return errors.ProgrammingError(msg=message, errno=1064)
+
+'''
+Description: A cursor of a stand-in connection. Translates the few MySQL-only statements the proxy issues (replication status,
+binlog position, session settings, `KILL QUERY`) and runs everything else on SQLite, converting `%s` placeholders to `?`.
+A prepared cursor behaves like mysql.connector's: it prepares a statement, at the cost of one more round trip, whenever it is given
+another operation object than the one it prepared last, even an equal string.
+'''
+class LocalCursor:
+    def __init__(self, conn: LocalConnection, dictionary: bool, prepared: bool = False):
+        self._conn = conn
+        self._dictionary = dictionary
+        self._prepared = prepared
+        self._executed = None
+        self._rows = []
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    @property
+    def with_rows(self):
+        return self.description is not None
+
+    def execute(self, operation: str, params=None):
+        conn = self._conn
+        node = conn.node
+        conn._check_open()
+        conn._interrupted.clear()
+        conn._wait(node.latency)
+        if node.failure_rate and random.random() < node.failure_rate:
+            conn._open = False
+            raise errors.OperationalError(msg="Lost connection to MySQL server during query", errno=2013)
+
+        if SHOW_MASTER_PATTERN.match(operation):
+            self._set_result(['File', 'Position'], [(BINLOG_FILE, node.backend.position)])
+            return
+        if SHOW_REPLICA_PATTERN.match(operation):
+            columns = ['Seconds_Behind_Source', 'Replica_SQL_Running', 'Relay_Source_Log_File', 'Exec_Source_Log_Pos']
+            self._set_result(columns, [(0, 'Yes', BINLOG_FILE, node.backend.position)])
+            return
+        kill = KILL_QUERY_PATTERN.match(operation)
+        if kill:
+            target = node.backend.connections.get(int(kill.group(1)))
+            if target is None or target.node is not node:
+                raise errors.DatabaseError(msg=f"Unknown thread id: {kill.group(1)}", errno=1094)
+            target.kill_query()
+            self._set_result(None, [])
+            return
+        if re.match(r"^\s*set\s", operation, re.IGNORECASE):
+            self._set_result(None, [])
+            return
+        if self._prepared:
+            if operation is not self._executed:
+                conn._wait(node.latency)
+                node.prepares += 1
+                self._executed = operation
+            node.prepared_executions += 1
+
+        statement = operation.replace('%s', '?')
+        try:
+            cursor = conn._db.execute(statement, tuple(params or ()))
+            rows = cursor.fetchall()
+        except sqlite3.Error as e:
+            raise translate_error(e)
+        columns = [column[0] for column in cursor.description] if cursor.description else None
+        self._set_result(columns, rows)
+        self.rowcount = cursor.rowcount if columns is None else len(rows)
+        self.lastrowid = cursor.lastrowid
+
+        if columns is None and not READ_PATTERN.match(operation):
+            if conn.in_transaction:
+                conn.pending_writes += 1
+            else:
+                node.backend.advance_position()
+
+    def fetchall(self):
+        self._check_rows()
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size: int = 1):
+        self._check_rows()
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchone(self):
+        self._check_rows()
+        return self._rows.pop(0) if self._rows else None
+
+    def close(self):
+        self._rows = []
+
+    def _set_result(self, columns, rows):
+        self.description = [(column,) for column in columns] if columns is not None else None
+        self._rows = [dict(zip(columns, row)) for row in rows] if self._dictionary and columns else [tuple(row) for row in rows]
+
+    def _check_rows(self):
+        if self.description is None:
+            raise errors.InterfaceError(msg="No result set to fetch from")
+
+'''
+Description: Serves a Flask application on a loopback port from a daemon thread.
+Inputs:
+    app (Flask) - The application.
+    port (int) - The port to listen on.
+Outputs: werkzeug.serving.BaseWSGIServer - The running server.
+'''
+def serve(app, port: int):
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+'''
+Description: Parses a comma separated list of per-node values, repeating the last one for the remaining nodes.
+'''
+def per_node(values: str, count: int):
+    parsed = [float(value) for value in values.split(',')] if values else [0.0]
+    return [parsed[min(i, len(parsed) - 1)] for i in range(count)]
+
+'''
+Description: Copies the database to one file per extra shard and deletes, from every copy, the rentals its shard does not own, with
+the statements used on MySQL (see `provisioning.shard_prune_statements`). The `rental` table is sharded by the CRC32 of `customer_id`.
+Inputs:
+    database (str) - The SQLite database file of the default shard.
+    shards (int) - The number of shards.
+Outputs: tuple - (the shard map, without the nodes of the shards; the database file of every shard, by shard name).
+'''
+def create_shards(database: str, shards: int):
+    names = ['default'] + [f"shard_{group}" for group in range(2, shards + 1)]
+    shard_map = {"shards": {name: {} for name in names}, "tables": {"rental": {"column": "customer_id", "strategy": "hash"}}}
+    paths = {name: database if name == 'default' else f"{os.path.splitext(database)[0]}_{name}.db" for name in names}
+    source = sqlite3.connect(database)
+    for path in paths.values():
+        if path != database:
+            copy = sqlite3.connect(path)
+            source.backup(copy)
+            copy.close()
+    source.close()
+    for name, path in paths.items():
+        conn = sqlite3.connect(path)
+        conn.create_function('CRC32', 1, lambda value: zlib.crc32(str(value).encode()))
+        for statement in provisioning.shard_prune_statements(shard_map, name):
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+    return shard_map, paths
+
+'''
+Description: Starts the local topology: the stand-in backend with a manager and `workers` workers, then the proxy, the trusted host
+and the gatekeeper wired to each other on loopback ports. The services read their configuration from the environment at import time,
+so the environment is prepared first.
+Inputs:
+    workers (int) - The number of stand-in workers.
+    ports (tuple) - The (gatekeeper, trusted host, proxy) ports.
+    manager_latency (float) - Seconds added to every statement on the manager.
+    worker_latencies (list) - Seconds added to every statement, per worker.
+    failure_rates (list) - Probability that a statement fails, per worker.
+    rentals (int) - The number of rows in the `rental` table.
+    database (str, optional) - The SQLite database file; a temporary file by default.
+    shards (int, optional) - The number of shards (see `create_shards`). The nodes of the extra shards are named 'shard<g>-manager' and
+        'shard<g>-worker<i>', with the latencies and failure rates of the default shard's nodes.
+Outputs: tuple - (LocalBackend, dict of the proxy, trusted_host and gatekeeper modules).
+'''
+def start_cluster(workers: int = 2, ports: tuple = (15000, 15001, 15002), manager_latency: float = 0.0,
+                  worker_latencies: list = None, failure_rates: list = None, rentals: int = 16044, database: str = None, shards: int = 1):
+    gatekeeper_port, trusted_host_port, proxy_port = ports
+    database = database or os.path.join(tempfile.mkdtemp(prefix="local_cluster_"), "sakila.db")
+    create_schema(database, rentals)
+
+    backend = LocalBackend(database)
+    backend.add_node("manager", manager_latency)
+    worker_names = [f"worker{i + 1}" for i in range(workers)]
+    for name, latency, failure_rate in zip(worker_names, worker_latencies or [0.0] * workers, failure_rates or [0.0] * workers):
+        backend.add_node(name, latency, failure_rate)
+
+    if shards > 1:
+        shard_map, paths = create_shards(database, shards)
+        for group, name in enumerate(list(shard_map["shards"])[1:], start=2):
+            backend.add_node(f"shard{group}-manager", manager_latency, path=paths[name])
+            shard_map["shards"][name] = {"manager": f"shard{group}-manager", "workers": []}
+            for i, latency, failure_rate in zip(range(workers), worker_latencies or [0.0] * workers, failure_rates or [0.0] * workers):
+                backend.add_node(f"shard{group}-worker{i + 1}", latency, failure_rate, paths[name])
+                shard_map["shards"][name]["workers"].append(f"shard{group}-worker{i + 1}")
+        shard_map_file = os.path.join(os.path.dirname(database), "shard_map.json")
+        with open(shard_map_file, "w") as file:
+            json.dump(shard_map, file)
+        os.environ["SHARD_MAP_FILE"] = shard_map_file
+
+    os.environ.update({
+        "MANAGER_IP": "manager",
+        "WORKERS_IPS": ",".join(worker_names),
+        "MYSQL_USERNAME": "proxy",
+        "MYSQL_PASSWORD": "proxy",
+        "MYSQL_DB": "sakila",
+        "PROXY_URL": f"http://127.0.0.1:{proxy_port}",
+        "TRUSTED_HOST_URL": f"http://127.0.0.1:{trusted_host_port}",
+    })
+
+    import proxy
+    import trusted_host
+    import gatekeeper
+
+    # The proxy's pools open every connection through proxy.connect_to_mysql
+    proxy.connect_to_mysql = backend.connect
+    proxy.start_background_tasks()
+
+    serve(proxy.app, proxy_port)
+    serve(trusted_host.app, trusted_host_port)
+    serve(gatekeeper.app, gatekeeper_port)
+    return backend, {"proxy": proxy, "trusted_host": trusted_host, "gatekeeper": gatekeeper}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the gatekeeper, trusted host and proxy locally against stand-in MySQL nodes.")
+    parser.add_argument("--workers", type=int, default=2, help="Number of stand-in workers")
+    parser.add_argument("--gatekeeper-port", type=int, default=15000)
+    parser.add_argument("--trusted-host-port", type=int, default=15001)
+    parser.add_argument("--proxy-port", type=int, default=15002)
+    parser.add_argument("--manager-latency-ms", type=float, default=0.0, help="Latency added to every statement on the manager")
+    parser.add_argument("--worker-latency-ms", default="0", help="Comma separated latency added to every statement, per worker")
+    parser.add_argument("--worker-failure-rate", default="0", help="Comma separated probability that a statement fails, per worker")
+    parser.add_argument("--rentals", type=int, default=16044, help="Rows in the rental table")
+    parser.add_argument("--database", help="SQLite database file (default: a temporary file)")
+    parser.add_argument("--shards", type=int, default=1, help="Number of shards the rentals are spread over")
+    args = parser.parse_args()
+
+    backend, _ = start_cluster(
+        workers=args.workers,
+        ports=(args.gatekeeper_port, args.trusted_host_port, args.proxy_port),
+        manager_latency=args.manager_latency_ms / 1000,
+        worker_latencies=[latency / 1000 for latency in per_node(args.worker_latency_ms, args.workers)],
+        failure_rates=per_node(args.worker_failure_rate, args.workers),
+        rentals=args.rentals,
+        database=args.database,
+        shards=args.shards,
+    )
+    print(f"Gatekeeper listening on http://127.0.0.1:{args.gatekeeper_port}/ (database {backend.path})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
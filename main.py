@@ -1,12 +1,12 @@
 import time
 import os
 import globals as g
-import boto3
-import stat
 import paramiko
 import json
+import argparse
+import re
 
-import instance_setup as ic
+import provisioning
 
 '''
 Description: Connects to a remote EC2 instance via SSH, runs a MySQL command to fetch the master status (file and position), and returns the result.
@@ -41,6 +41,181 @@ def fetch_manager_status(instance_ip: str, pem_file_path: str, root_password: st
     except Exception as e:
         print(f"An error occurred during SSH: {str(e)}")
 
+# Modules imported by every service, installed in /opt/<service>/ next to it
+SHARED_MODULES = ['service_common.py']
+
+'''
+Description: Uploads the code of a service to its instance over SSH, with the modules shared by the services (`SHARED_MODULES`, found next to it),
+and (re)starts the service. Waits for the instance's user data script to complete first, since that script installs the packages and the systemd unit of the service.
+The code is not embedded in the user data, which is limited to 16 KB.
+Inputs:
+    instance_ip (str) - The public IP address of the instance.
+    pem_file_path (str) - The path to the PEM file used for SSH authentication.
+    program_path (str) - The local path of the service code, e.g. proxy.py.
+    service (str) - The name of the systemd service, which is installed in /opt/<service>/<service>.py.
+'''
+def deploy_service(instance_ip: str, pem_file_path: str, program_path: str, service: str):
+    try:
+        print(f"Deploying {service} to {instance_ip}...")
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+        ssh.connect(instance_ip, username='ubuntu', key_filename=pem_file_path)
+
+        sftp = ssh.open_sftp()
+        sftp.put(program_path, f'/tmp/{service}.py')
+        for module in SHARED_MODULES:
+            sftp.put(os.path.join(os.path.dirname(program_path), module), f'/tmp/{module}')
+        sftp.close()
+
+        modules = ' '.join(f'/tmp/{module}' for module in SHARED_MODULES)
+        command = (f"cloud-init status --wait > /dev/null; sudo mv {modules} /opt/{service}/ && sudo mv /tmp/{service}.py /opt/{service}/{service}.py "
+                   f"&& sudo systemctl restart {service}")
+        stdin, stdout, stderr = ssh.exec_command(command)
+        if stdout.channel.recv_exit_status() != 0:
+            print(f"Failed to start {service}: {stderr.read().decode('utf-8')}")
+        else:
+            print(f"{service} started.")
+
+        ssh.close()
+
+    except Exception as e:
+        print(f"An error occurred during SSH: {str(e)}")
+
+
+'''
+Description: Dumps the manager's data over SSH with a consistent snapshot, which records the binlog position it was taken at, and downloads it.
+A worker that imports the snapshot and replicates from that position holds every WRITE, whenever it joins the cluster.
+Inputs:
+    instance_ip (str) - The public IP address of the manager.
+    pem_file_path (str) - The path to the PEM file used for SSH authentication.
+    root_password (str) - The root password for the MySQL server.
+    local_path (str, optional) - Where the snapshot is downloaded to.
+Outputs:
+    tuple - (local path of the snapshot, binlog file, binlog position).
+'''
+def snapshot_manager(instance_ip: str, pem_file_path: str, root_password: str, local_path: str = 'manager_snapshot.sql'):
+    print(f"Taking a snapshot of the manager at {instance_ip}...")
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(instance_ip, username='ubuntu', key_filename=pem_file_path)
+    try:
+        command = f"mysqldump -u root -p{root_password} --single-transaction --source-data=2 --databases sakila > /tmp/manager_snapshot.sql"
+        stdin, stdout, stderr = ssh.exec_command(command)
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError(f"mysqldump failed: {stderr.read().decode('utf-8')}")
+
+        sftp = ssh.open_sftp()
+        sftp.get('/tmp/manager_snapshot.sql', local_path)
+        sftp.close()
+    finally:
+        ssh.close()
+
+    with open(local_path, 'r') as file:
+        header = ''.join(file.readline() for _ in range(50))
+    position = re.search(r"_LOG_FILE='([^']+)', \w+_LOG_POS=(\d+)", header)
+    if not position:
+        raise RuntimeError("The snapshot does not record the manager's binlog position")
+    print(f"Snapshot taken at {position.group(1)}:{position.group(2)}.")
+    return local_path, position.group(1), position.group(2)
+
+'''
+Description: Uploads a snapshot of the manager to a new worker over SSH. The worker's user data script waits for it, imports it and starts
+replicating from the position it was taken at.
+Inputs:
+    instance_ip (str) - The public IP address of the worker.
+    pem_file_path (str) - The path to the PEM file used for SSH authentication.
+    snapshot_path (str) - The local path of the snapshot, see `snapshot_manager`.
+'''
+def upload_snapshot(instance_ip: str, pem_file_path: str, snapshot_path: str):
+    print(f"Uploading the manager snapshot to {instance_ip}...")
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(instance_ip, username='ubuntu', key_filename=pem_file_path)
+    try:
+        sftp = ssh.open_sftp()
+        sftp.put(snapshot_path, '/tmp/manager_snapshot.sql')
+        sftp.close()
+        stdin, stdout, stderr = ssh.exec_command("touch /tmp/manager_snapshot.done")
+        stdout.channel.recv_exit_status()
+    finally:
+        ssh.close()
+
+'''
+Description: Reads how many seconds a worker's replication is behind the manager, over SSH.
+Inputs:
+    instance_ip (str) - The public IP address of the worker.
+    pem_file_path (str) - The path to the PEM file used for SSH authentication.
+    root_password (str) - The root password for the MySQL server.
+Outputs:
+    float or None - The lag, or None while replication is not configured or not running.
+'''
+def fetch_replica_lag(instance_ip: str, pem_file_path: str, root_password: str):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(instance_ip, username='ubuntu', key_filename=pem_file_path)
+    try:
+        stdin, stdout, stderr = ssh.exec_command(f"mysql -u root -p{root_password} -e 'SHOW REPLICA STATUS\\G'")
+        output = stdout.read().decode('utf-8')
+    finally:
+        ssh.close()
+
+    status = dict(re.findall(r'^\s*(\w+): (.*)$', output, re.MULTILINE))
+    if status.get('Replica_IO_Running') != 'Yes' or status.get('Replica_SQL_Running') != 'Yes':
+        return None
+    lag = status.get('Seconds_Behind_Source')
+    return float(lag) if lag and lag != 'NULL' else None
+
+'''
+Description: Calls an admin endpoint of the proxy from its own instance over SSH, so the admin API needs no open port.
+Inputs:
+    instance_ip (str) - The public IP address of the proxy.
+    pem_file_path (str) - The path to the PEM file used for SSH authentication.
+    method (str) - The HTTP method, e.g. 'POST'.
+    path (str) - The endpoint, e.g. '/admin/workers'.
+    payload (dict, optional) - The JSON body.
+Outputs:
+    The JSON response of the proxy.
+'''
+def proxy_admin(instance_ip: str, pem_file_path: str, method: str, path: str, payload: dict = None):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(instance_ip, username='ubuntu', key_filename=pem_file_path)
+    try:
+        body = f" -H 'Content-Type: application/json' -d '{json.dumps(payload)}'" if payload is not None else ""
+        stdin, stdout, stderr = ssh.exec_command(f"curl -sf -X {method}{body} http://localhost:8080{path}")
+        output = stdout.read().decode('utf-8')
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError(f"{method} {path} failed on the proxy: {stderr.read().decode('utf-8')}")
+    finally:
+        ssh.close()
+    print(f"Proxy {method} {path}: {output}")
+    return json.loads(output)
+
+'''
+Description: Runs SQL statements on the Sakila database of a shard's manager over SSH, once its user data script has completed (see
+`provisioning.shard_prune_statements`).
+Inputs:
+    instance_ip (str) - The public IP address of the manager.
+    pem_file_path (str) - The path to the PEM file used for SSH authentication.
+    root_password (str) - The root password for the MySQL server.
+    statements (list) - The SQL statements.
+Raises:
+    RuntimeError - If a statement failed.
+'''
+def prune_shard(instance_ip: str, pem_file_path: str, root_password: str, statements: list):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(instance_ip, username='ubuntu', key_filename=pem_file_path)
+    try:
+        script = ' '.join(f"{statement};" for statement in statements)
+        stdin, stdout, stderr = ssh.exec_command(f"cloud-init status --wait > /dev/null; mysql -u root -p{root_password} sakila -e \"{script}\"")
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError(f"Pruning the shard on {instance_ip} failed: {stderr.read().decode('utf-8')}")
+    finally:
+        ssh.close()
+    print(f"Shard on {instance_ip} pruned: {statements}")
+
 
 '''
 Description: Cleans up resources by terminating EC2 instances (worker, manager, proxy, gatekeeper, and trusted host), deleting associated security groups, and removing the EC2 key pair.
@@ -103,170 +278,62 @@ def cleanup(self):
 
 
 if __name__ == "__main__":
-    print("RUNNING MAIN AUTOMATED SCRIPT")  
-
-    # cleanup()  
+    parser = argparse.ArgumentParser(description="Provision the cluster, or scale the workers of the running cluster.")
+    parser.add_argument("--workers", type=int, default=2, help="Number of workers to provision, per shard")
+    parser.add_argument("--shards", type=int, default=1, help="Number of shards, each a manager and its workers (see provisioning.build_shard_map)")
+    parser.add_argument("--scale-workers", type=int, help="Scale the running cluster described by instances_ips.json to this number of workers")
+    args = parser.parse_args()
 
     pem_file_path = g.pem_file_path
 
-    # Create EC2 Client
-    session = boto3.Session()
-    ec2 = session.resource('ec2')
-
-    # Read VPC and Subnet IDs from files
-    with open(f'{g.aws_folder_path}/vpc_id.txt', 'r') as file:
-        vpc_id = file.read().strip()
-
-    with open(f'{g.aws_folder_path}/subnet_id.txt', 'r') as file:
-        subnet_id = file.read().strip()
-
-
-    # Delete keypair with same name, USED IN TESTING
-    # ec2.KeyPair("key_name").delete()
-
-    # Create a new key pair and save the .pem file
-    key_pair = ec2.create_key_pair(KeyName='key_name')
-
-    # Change security to be able to read
-    os.chmod(pem_file_path, stat.S_IWUSR)
-
-    # Save the private key to a .pem file
-    with open(pem_file_path, 'w') as pem_file:
-        pem_file.write(key_pair.key_material)
-
-    # Change file permissions to 400 to protect the private key
-    os.chmod(pem_file_path, stat.S_IRUSR)
-
-    # Create security groups
-    security_mysql_id = ic.createSecurityGroup(vpc_id, "mysql security group")
-    security_proxy_id = ic.createSecurityGroup(vpc_id, "proxy security group")
-    security_trusted_host_id = ic.createSecurityGroup(vpc_id, "trusted host security group")
-    security_gatekeeper_id = ic.createSecurityGroup(vpc_id, "gatekeeper public security group")
-
-    # Manager and workers
-    with open(f'{g.path}/bash_scripts/worker_userdata.sh', 'r') as file:
-        worker_user_data = file.read()
-
-    with open(f'{g.path}/bash_scripts/manager_userdata.sh', 'r') as file:
-        manager_user_data = file.read()
-
-    print("Creating instances...")
-
-    print("Creating manager...")
-    manager_instances = ic.createInstance('t2.micro', 1, 1, key_pair, security_mysql_id, subnet_id, manager_user_data, "manager")
-    manager_public_ip = manager_instances[0].public_ip_address
-    manager_private_ip = manager_instances[0].private_ip_address
-
-    print("Waiting for manager to be up and running...")
-    waiter = boto3.client('ec2').get_waiter('instance_status_ok')
-    waiter.wait(
-        InstanceIds=[manager_instances[0].instance_id],
-        WaiterConfig={
-            'Delay': 15, 
-            'MaxAttempts': 20 
-        }
-    )
-
-    root_password = f'{g.root_pass}'
-    manager_log_file, manager_log_position = fetch_manager_status(manager_public_ip, pem_file_path, root_password)
-
-    print("Creating workers...")
-    server_ids = [2, 3]
-    worker_instance_ids = []
-    worker_private_ips = []
-    for server_id in server_ids:
-        user_data = worker_user_data.replace('<SERVERID>', str(server_id)).replace('<MANAGERIP>', manager_private_ip).replace('<MANAGERLOGFILE>', manager_log_file).replace('<MANAGERLOGPOSITION>', manager_log_position)
-        worker_instances = ic.createInstance('t2.micro', 1, 1, key_pair, security_mysql_id, subnet_id, user_data, "worker")
-        worker_instance_ids.append(worker_instances[0].instance_id)
-        worker_private_ips.append(worker_instances[0].private_ip_address)
-
-    print("Waiting for workers to be up and running...")
-    waiter.wait(
-        InstanceIds=worker_instance_ids,
-        WaiterConfig={
-            'Delay': 15,  
-            'MaxAttempts': 20 
-        }
-    )
-
-    # Proxy
-    with (
-        open(f'{g.path}/bash_scripts/proxy_userdata.sh', 'r') as userdata, 
-        open(f'{g.path}/proxy.py', 'r') as pythonProgram
-    ):
-        proxy_program = pythonProgram.read()
-        comma_separated_worker_ips = ','.join(worker_private_ips)
-        proxy_user_data = userdata.read().replace('<PROXYCODE>', proxy_program).replace('<MANAGERIP>', manager_private_ip).replace('<WORKERIPSCSL>', comma_separated_worker_ips)
-
-    print("Creating proxy...")
-    proxy_instances = ic.createInstance('t2.large', 1, 1, key_pair, security_proxy_id, subnet_id, proxy_user_data, "proxy")
-
-    print("Waiting for proxy to be up and running...")
-    waiter.wait(
-        InstanceIds=[proxy_instances[0].instance_id],
-        WaiterConfig={
-            'Delay': 15,  
-            'MaxAttempts': 20  
-        }
-    )
-
-    # Trusted Host
-    with (
-            open(f'{g.path}/bash_scripts/trusted_host.sh', 'r') as userdata, 
-            open(f'{g.path}/trusted_host.py', 'r') as pythonProgram
-        ):
-            trusted_host_program = pythonProgram.read()
-            trusted_host_user_data = userdata.read().replace('<TRUSTEDHOSTCODE>', trusted_host_program).replace('<MANAGERIP>', manager_private_ip).replace('<WORKERIPSCSL>', comma_separated_worker_ips)
- 
-
-    print("Creating trusted host...")
-    trusted_host_instance = ic.createInstance('t2.large', 1, 1, key_pair, security_trusted_host_id, subnet_id, trusted_host_user_data, "trusted host")
-    
-    print("Waiting for trusted host to be up and running...")
-    waiter = boto3.client('ec2').get_waiter('instance_status_ok')
-    waiter.wait(
-        InstanceIds=[trusted_host_instance[0].instance_id],
-        WaiterConfig={
-            'Delay': 15,  
-            'MaxAttempts': 20  
-        }
-    )
-
-    # Gatekeeper
-    with (
-            open(f'{g.path}/bash_scripts/gatekeeper.sh', 'r') as userdata, 
-            open(f'{g.path}/gatekeeper.py', 'r') as pythonProgram
-        ):
-            gatekeeper_program = pythonProgram.read()
-            gatekeeper_user_data = userdata.read().replace('<GATEKEEPERCODE>', gatekeeper_program).replace('<MANAGERIP>', manager_private_ip).replace('<WORKERIPSCSL>', comma_separated_worker_ips)
-
-    print("Creating gatekeeper...")
-    gatekeeper_instance = ic.createInstance('t2.large', 1, 1, key_pair, security_gatekeeper_id, subnet_id, gatekeeper_user_data, "gatekeeper")
-
-    print("Waiting for gatekeeper to be up and running...")
-    waiter = boto3.client('ec2').get_waiter('instance_status_ok')
-    waiter.wait(
-        InstanceIds=[gatekeeper_instance[0].instance_id],
-        WaiterConfig={
-            'Delay': 15, 
-            'MaxAttempts': 20 
-        }
-    )
-
-    print("Exporting IPs...")
-    def export_instances_public_ips(self):
-        instances_ips = {
-            "worker_ips": [instance.public_ip_address for instance in self.worker_instances],
-            "manager_ip": self.manager_instances.public_ip_address,
-            "proxy_ip": self.proxy_instances.public_ip_address,
-            "gatekeeper_ip": self.gatekeeper_instance.public_ip_address,
-            "trusted_host_ip": self.trusted_host_instance.public_ip_address
-        }
-
-        with open("instances_ips.json", "w") as file:
-            json.dump(instances_ips, file)
-
-    export_instances_public_ips
-
-    print("AUTOMATED SCRIPT COMPLETED!")
-
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+
+    if args.scale_workers is not None:
+        if args.scale_workers < 1:
+            parser.error("--scale-workers must be at least 1")
+        with open('instances_ips.json', 'r') as file:
+            cluster = json.load(file)
+        with open(f'{g.path}/bash_scripts/worker_userdata.sh', 'r') as file:
+            worker_script = file.read()
+
+        print(f"Scaling from {len(cluster['workers'])} to {args.scale_workers} workers...")
+        plan = provisioning.build_scale_plan(cluster, args.scale_workers, worker_script, pem_file_path, f'{g.root_pass}', snapshot_manager,
+                                             upload_snapshot, fetch_replica_lag, proxy_admin)
+        results = plan.run()
+        provisioning.export_scaled_workers(cluster, results)
+        print("SCALING COMPLETED!")
+    else:
+        print("RUNNING MAIN AUTOMATED SCRIPT")  
+
+        # cleanup()  
+
+        # Read VPC and Subnet IDs from files
+        with open(f'{g.aws_folder_path}/vpc_id.txt', 'r') as file:
+            vpc_id = file.read().strip()
+
+        with open(f'{g.aws_folder_path}/subnet_id.txt', 'r') as file:
+            subnet_id = file.read().strip()
+
+
+        # Delete keypair with same name, USED IN TESTING
+        # boto3.Session().resource('ec2').KeyPair("key_name").delete()
+
+        # User data of every role and code of every service
+        scripts = {}
+        for role, script in (('manager', 'manager_userdata.sh'), ('worker', 'worker_userdata.sh'), ('proxy', 'proxy_userdata.sh'),
+                             ('trusted_host', 'trusted_host.sh'), ('gatekeeper', 'gatekeeper.sh')):
+            with open(f'{g.path}/bash_scripts/{script}', 'r') as file:
+                scripts[role] = file.read()
+        programs = {service: f'{g.path}/{service}.py' for service in ('proxy', 'trusted_host', 'gatekeeper')}
+
+        # Independent steps run concurrently, see provisioning.py
+        print("Creating instances...")
+        plan = provisioning.build_cluster_plan(vpc_id, subnet_id, scripts, programs, pem_file_path, f'{g.root_pass}', fetch_manager_status, deploy_service,
+                                               worker_count=args.workers, shard_count=args.shards, prune_shard=prune_shard)
+        results = plan.run()
+
+        print("Exporting IPs...")
+        provisioning.export_instances_ips(results, subnet_id)
+
+        print("AUTOMATED SCRIPT COMPLETED!")
@@ -0,0 +1,389 @@
+"""
+Parallel provisioning of the cluster. The steps of bringing the cluster up (key pair, security groups, instance launches, waits, deployments)
+form a dependency graph run by `ProvisioningPlan`: every step starts as soon as the steps it needs have completed.
+Only two dependencies are real: the workers replicate from the manager's binlog position, which can only be read once the manager
+is up, and each relay (proxy, trusted host, gatekeeper) is configured with the private IPs of its upstream, which are known as soon as
+the upstream is launched. Everything else runs concurrently, and the instances of a stage are waited for with one batched waiter.
+
+`build_scale_plan` changes the number of workers of the running cluster: new workers are seeded with a snapshot of the manager and
+registered with the proxy once they have caught up, removed ones are drained from the proxy before their instances are terminated.
+
+With several shards, the cluster plan brings up one replication group (a manager and its workers) per shard, each starting from the
+full Sakila data. Once a shard's manager is up, the rows of the sharded tables it does not own are deleted from it (see
+`shard_prune_statements`), which its workers replicate, and the proxy is given the shard map (see `proxy.load_shard_map`).
+
+Both plans work with boto3 or with the local stand-in of `local_aws.py`, which measures the speedup offline.
+"""
+
+import json
+import re
+import threading
+import time
+import types
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import boto3
+
+import instance_setup as ic
+
+'''
+Description: A set of provisioning steps and their dependencies, run concurrently: a step starts as soon as every step it depends on
+has completed, on a pool of `max_parallel` threads (one thread runs the steps one after another, in the order they were added).
+A step is a function called with the results of the completed steps, by step name, and its return value becomes its own result.
+If a step fails, no further step is started, and the error is raised once the running steps have completed.
+'''
+class ProvisioningPlan:
+    def __init__(self):
+        self.steps = {}  # name -> (function, names of the steps it depends on)
+        self.timings = {}  # name -> (start, end), in seconds since the plan started running
+        self._lock = threading.Lock()
+
+    '''
+    Description: Adds a step to the plan. The steps it depends on must have been added before, so the plan has no cycle.
+    Inputs:
+        name (str) - The step name, under which its result is stored.
+        function (function) - Called with the results of the completed steps (dict), returns the result of the step.
+        depends_on (list, optional) - The names of the steps that must complete first.
+    '''
+    def add(self, name: str, function, depends_on: list = ()):
+        unknown = [dependency for dependency in depends_on if dependency not in self.steps]
+        if unknown:
+            raise ValueError(f"Step {name} depends on unknown steps {unknown}")
+        self.steps[name] = (function, tuple(depends_on))
+
+    '''
+    Description: Runs every step of the plan.
+    Inputs: max_parallel (int, optional) - The maximum number of steps running at the same time.
+    Outputs: dict - The result of every step, by step name.
+    '''
+    def run(self, max_parallel: int = 16):
+        results = {}
+        pending = dict(self.steps)
+        running = {}  # future -> step name
+        error = None
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(max_parallel, 1)) as executor:
+            while True:
+                if error is None:
+                    for name, (function, depends_on) in list(pending.items()):
+                        if all(dependency in results for dependency in depends_on):
+                            del pending[name]
+                            running[executor.submit(self._run_step, name, function, dict(results), start)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        print(f"Step {name} failed: {e}")
+                        error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def _run_step(self, name: str, function, results: dict, start: float):
+        began = time.perf_counter() - start
+        print(f"[{began:8.1f}s] {name} started")
+        result = function(results)
+        ended = time.perf_counter() - start
+        with self._lock:
+            self.timings[name] = (began, ended)
+        print(f"[{ended:8.1f}s] {name} completed in {ended - began:.1f}s")
+        return result
+
+# The sharded tables of the Sakila schema and their shard key, in the order their rows are pruned: payments reference rentals
+SHARDED_TABLES = (('payment', 'customer_id'), ('rental', 'customer_id'))
+
+'''
+Description: Builds the shard map the proxy routes with (see `proxy.load_shard_map`): the rentals and payments of a customer are on the
+shard the CRC32 of their `customer_id` points to, and every other table is whole on every shard. The proxy keeps those copies alike by
+sending every WRITE to an unsharded table to the manager of every shard (see `proxy.broadcast_write`), so that the rentals and payments
+of a shard refer to the same customers, inventory and staff as on the default shard.
+Inputs: groups (dict) - The private IPs of every shard after the default one, by shard name: {'manager': IP, 'workers': [IPs]}.
+Outputs: dict - The shard map.
+'''
+def build_shard_map(groups: dict):
+    return {
+        "shards": dict({"default": {}}, **groups),
+        "tables": {table: {"column": column, "strategy": "hash"} for table, column in SHARDED_TABLES},
+    }
+
+'''
+Description: Lists the statements deleting, from a shard's manager, the rows of the hash-sharded tables the shard does not own.
+MySQL's `CRC32()` of a key is the CRC32 of its text, as computed by the proxy.
+Inputs:
+    shard_map (dict) - The shard map (see `build_shard_map`).
+    shard (str) - The shard name.
+Outputs: list - The DELETE statements, in the order of the shard map's tables.
+'''
+def shard_prune_statements(shard_map: dict, shard: str):
+    statements = []
+    for table, rule in shard_map['tables'].items():
+        owners = rule.get('shards', list(shard_map['shards']))
+        if rule.get('strategy', 'hash') != 'hash' or shard not in owners:
+            continue
+        statements.append(f"DELETE FROM {table} WHERE CRC32({rule['column']}) % {len(owners)} != {owners.index(shard)}")
+    return statements
+
+'''
+Description: Builds the plan that brings the cluster up: the key pair and the security groups, the manager, then the workers once the
+manager's binlog position can be read, the proxy, the trusted host and the gatekeeper as soon as their upstream is launched, and finally
+the deployment of the three services once their instances pass their status checks. With several shards, each extra shard gets a
+manager and `worker_count` workers of its own, and the proxy is only deployed once every shard's manager has been pruned.
+Inputs:
+    vpc_id (str) - The ID of the VPC the security groups are created in.
+    subnet_id (str) - The ID of the subnet the instances are launched in.
+    scripts (dict) - The user data scripts by role: 'manager', 'worker', 'proxy', 'trusted_host' and 'gatekeeper'.
+    programs (dict) - The local path of the code of each service: 'proxy', 'trusted_host' and 'gatekeeper'.
+    pem_file_path (str) - The path the private key of the key pair is saved to, and SSH connections use.
+    root_password (str) - The MySQL root password of the manager.
+    fetch_manager_status (function) - Reads the manager's binlog (file, position) over SSH, see `main.fetch_manager_status`.
+    deploy_service (function) - Uploads and starts a service over SSH, see `main.deploy_service`.
+    worker_count (int, optional) - The number of workers.
+    ec2 (boto3.resources.base.ServiceResource, optional) - The EC2 resource, e.g. a local stand-in. boto3's by default.
+    ec2_client (botocore.client.EC2, optional) - The EC2 client the waiters come from, e.g. a local stand-in. boto3's by default.
+    sequential (bool, optional) - Reproduce the former provisioning, for comparison: every launch waits for its instance to run,
+        each stage is waited for on its own and each relay is only launched once its upstream is deployed. Run such a plan on one thread.
+    waiter_delay (float, optional) - Seconds between two polls of a waiter.
+    key_name (str, optional) - The name of the key pair.
+    shard_count (int, optional) - The number of shards, i.e. of replication groups.
+    prune_shard (function, optional) - Runs SQL statements on a shard's manager over SSH, see `main.prune_shard`. Needed with several shards.
+Outputs: ProvisioningPlan - The plan. Its results hold the instances of each role ('manager', 'worker_<n>', 'proxy', 'trusted_host', 'gatekeeper'),
+    the instances of the extra shards ('shard_<g>_manager', 'shard_<g>_worker_<n>') and the shard map ('shard_map', None with one shard).
+'''
+def build_cluster_plan(vpc_id: str, subnet_id: str, scripts: dict, programs: dict, pem_file_path: str, root_password: str,
+                       fetch_manager_status, deploy_service, worker_count: int = 2, ec2=None, ec2_client=None,
+                       sequential: bool = False, waiter_delay: float = 15, key_name: str = 'key_name', shard_count: int = 1, prune_shard=None):
+    if shard_count > 1 and (sequential or prune_shard is None):
+        raise ValueError("Several shards need the parallel plan and a prune_shard function")
+    plan = ProvisioningPlan()
+    create = ic.createInstance if sequential else ic.launchInstances
+
+    def launch(name: str, instance_type: str, security_group: str, user_data):
+        return lambda results: create(instance_type, 1, 1, results['key_pair'], results[security_group], subnet_id, user_data(results), name, ec2)[0]
+
+    def wait_for(*roles):
+        return lambda results: ic.waitForInstances([results[role] for role in roles], ec2_client, delay=waiter_delay)
+
+    def read_manager_status(prefix: str = ''):
+        def read(results):
+            status = fetch_manager_status(results[f'{prefix}manager'].public_ip_address, pem_file_path, root_password)
+            if not status or len(status) != 2:
+                raise RuntimeError(f"Could not read the {prefix}manager's binlog position")
+            return status
+        return read
+
+    def worker_user_data(server_id: int, prefix: str = ''):
+        def build(results):
+            log_file, log_position = results[f'{prefix}manager_status']
+            return (scripts['worker'].replace('<SERVERID>', str(server_id)).replace('<MANAGERIP>', results[f'{prefix}manager'].private_ip_address)
+                    .replace('<MANAGERLOGFILE>', log_file).replace('<MANAGERLOGPOSITION>', log_position).replace('<SEED>', 'sakila'))
+        return build
+
+    def deploy(service: str):
+        return lambda results: deploy_service(results[service].public_ip_address, pem_file_path, programs[service], service)
+
+    plan.add('key_pair', lambda results: ic.createKeyPair(key_name, pem_file_path, ec2))
+    for group, group_name in (('mysql', 'mysql security group'), ('proxy', 'proxy security group'),
+                              ('trusted_host', 'trusted host security group'), ('gatekeeper', 'gatekeeper public security group')):
+        plan.add(f'security_{group}', lambda results, group_name=group_name: ic.createSecurityGroup(vpc_id, group_name, ec2))
+
+    # The default shard's steps keep their names ('manager', 'worker_<n>'), the extra shards' are prefixed with 'shard_<g>_'
+    prefixes = [''] + [f'shard_{group}_' for group in range(2, shard_count + 1)]
+    shard_workers = {}
+    for prefix in prefixes:
+        plan.add(f'{prefix}manager', launch('manager', 't2.micro', 'security_mysql', lambda results: scripts['manager']), ['key_pair', 'security_mysql'])
+        plan.add(f'{prefix}manager_ready', wait_for(f'{prefix}manager'), [f'{prefix}manager'])
+        plan.add(f'{prefix}manager_status', read_manager_status(prefix), [f'{prefix}manager_ready'])
+        shard_workers[prefix] = [f'{prefix}worker_{server_id}' for server_id in range(2, worker_count + 2)]
+        for worker in shard_workers[prefix]:
+            plan.add(worker, launch('worker', 't2.micro', 'security_mysql', worker_user_data(int(worker.rsplit('_', 1)[1]), prefix)),
+                     [f'{prefix}manager_status'])
+    workers = shard_workers['']
+    extra_instances = [step for prefix in prefixes[1:] for step in [f'{prefix}manager'] + shard_workers[prefix]]
+
+    def shard_map(results):
+        if shard_count == 1:
+            return None
+        return build_shard_map({prefix.rstrip('_'): {'manager': results[f'{prefix}manager'].private_ip_address,
+                                                     'workers': [results[worker].private_ip_address for worker in shard_workers[prefix]]}
+                                for prefix in prefixes[1:]})
+
+    def prune(prefix: str):
+        def run(results):
+            statements = shard_prune_statements(results['shard_map'], prefix.rstrip('_') or 'default')
+            return prune_shard(results[f'{prefix}manager'].public_ip_address, pem_file_path, root_password, statements)
+        return run
+
+    # The pruning DELETEs are written to each manager's binlog after the position its workers replicate from, so the workers apply them too
+    plan.add('shard_map', shard_map, extra_instances)
+    prunes = []
+    if shard_count > 1:
+        for prefix in prefixes:
+            prunes.append(f"prune_{prefix.rstrip('_') or 'default'}")
+            plan.add(prunes[-1], prune(prefix), ['shard_map', f'{prefix}manager_status'])
+
+    services = ['proxy', 'trusted_host', 'gatekeeper']
+    user_data = {
+        'proxy': lambda results: (scripts['proxy'].replace('<MANAGERIP>', results['manager'].private_ip_address)
+                                  .replace('<WORKERIPSCSL>', ','.join(results[worker].private_ip_address for worker in workers))
+                                  .replace('<SHARDMAP>', json.dumps(results['shard_map']) if results['shard_map'] else '')),
+        'trusted_host': lambda results: scripts['trusted_host'].replace('<PROXYIP>', results['proxy'].private_ip_address),
+        'gatekeeper': lambda results: scripts['gatekeeper'].replace('<TRUSTEDHOSTIP>', results['trusted_host'].private_ip_address),
+    }
+    upstream = {'proxy': workers + ['shard_map'], 'trusted_host': ['proxy'], 'gatekeeper': ['trusted_host']}
+
+    if sequential:
+        plan.add('workers_ready', wait_for(*workers), workers)
+        upstream = {'proxy': ['workers_ready', 'shard_map'], 'trusted_host': ['deploy_proxy'], 'gatekeeper': ['deploy_trusted_host']}
+        for service in services:
+            plan.add(service, launch(service.replace('_', ' '), 't2.large', f'security_{service}', user_data[service]),
+                     [f'security_{service}'] + upstream[service])
+            plan.add(f'{service}_ready', wait_for(service), [service])
+            plan.add(f'deploy_{service}', deploy(service), [f'{service}_ready'])
+        return plan
+
+    for service in services:
+        plan.add(service, launch(service.replace('_', ' '), 't2.large', f'security_{service}', user_data[service]), [f'security_{service}'] + upstream[service])
+    extra_workers = [worker for prefix in prefixes[1:] for worker in shard_workers[prefix]]
+    plan.add('cluster_ready', wait_for(*workers, *extra_workers, *services), workers + extra_workers + services)
+    for service in services:
+        plan.add(f'deploy_{service}', deploy(service), ['cluster_ready'] + (prunes if service == 'proxy' else []))
+    return plan
+
+'''
+Description: Builds the plan that scales the running cluster to `worker_count` workers.
+New workers start from the manager's current data: a snapshot is dumped on the manager, the workers are launched to replicate from the
+binlog position it was taken at, import it once they pass their status checks, and are registered with the running proxy (see its
+`/admin/workers` endpoints) once their replication has caught up. Surplus workers, the most recently added first, are drained and removed
+from the proxy before their instances are terminated.
+Inputs:
+    cluster (dict) - The running cluster, as exported by `export_instances_ips`.
+    worker_count (int) - The number of workers to scale to.
+    worker_script (str) - The user data script of the workers.
+    pem_file_path (str) - The path to the PEM file used for SSH connections.
+    root_password (str) - The MySQL root password of the manager and the workers.
+    snapshot_manager (function) - Dumps the manager's data over SSH, see `main.snapshot_manager`.
+    upload_snapshot (function) - Uploads the dump to a new worker over SSH, see `main.upload_snapshot`.
+    fetch_replica_lag (function) - Reads the replication lag of a worker over SSH, see `main.fetch_replica_lag`.
+    proxy_admin (function) - Calls an admin endpoint of the proxy over SSH, see `main.proxy_admin`.
+    ec2 (boto3.resources.base.ServiceResource, optional) - The EC2 resource, e.g. a local stand-in. boto3's by default.
+    ec2_client (botocore.client.EC2, optional) - The EC2 client the waiters come from, e.g. a local stand-in. boto3's by default.
+    waiter_delay (float, optional) - Seconds between two polls of a waiter.
+    catch_up_timeout (float, optional) - Seconds a new worker is given to catch up with the manager once seeded.
+    poll_interval (float, optional) - Seconds between two reads of the replication lag of a new worker.
+Outputs: ProvisioningPlan - The plan. Its results hold the new instances ('worker_<server id>') and the removed workers ('removed_<server id>').
+'''
+def build_scale_plan(cluster: dict, worker_count: int, worker_script: str, pem_file_path: str, root_password: str, snapshot_manager, upload_snapshot,
+                     fetch_replica_lag, proxy_admin, ec2=None, ec2_client=None, waiter_delay: float = 15, catch_up_timeout: float = 1800,
+                     poll_interval: float = 15):
+    plan = ProvisioningPlan()
+    current = sorted(cluster['workers'], key=lambda worker: worker['server_id'])
+    next_server_id = max((worker['server_id'] for worker in current), default=1) + 1
+    key_pair = types.SimpleNamespace(name=cluster['key_name'])
+
+    def launch(server_id: int):
+        def build(results):
+            _, log_file, log_position = results['manager_snapshot']
+            user_data = (worker_script.replace('<SERVERID>', str(server_id)).replace('<MANAGERIP>', cluster['manager_private_ip'])
+                         .replace('<MANAGERLOGFILE>', log_file).replace('<MANAGERLOGPOSITION>', str(log_position)).replace('<SEED>', 'snapshot'))
+            return ic.launchInstances('t2.micro', 1, 1, key_pair, cluster['security_mysql_id'], cluster['subnet_id'], user_data, 'worker', ec2)[0]
+        return build
+
+    def wait_until_caught_up(worker: str):
+        def wait_for_lag(results):
+            deadline = time.monotonic() + catch_up_timeout
+            while True:
+                lag = fetch_replica_lag(results[worker].public_ip_address, pem_file_path, root_password)
+                if lag == 0:
+                    return lag
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"{worker} has not caught up with the manager after {catch_up_timeout}s (lag: {lag})")
+                time.sleep(poll_interval)
+        return wait_for_lag
+
+    added = [f'worker_{server_id}' for server_id in range(next_server_id, next_server_id + worker_count - len(current))]
+    if added:
+        plan.add('manager_snapshot', lambda results: snapshot_manager(cluster['manager_ip'], pem_file_path, root_password))
+        for worker in added:
+            plan.add(worker, launch(int(worker.split('_')[1])), ['manager_snapshot'])
+        plan.add('workers_ready', lambda results: ic.waitForInstances([results[worker] for worker in added], ec2_client, delay=waiter_delay), added)
+        for worker in added:
+            plan.add(f'seed_{worker}', lambda results, worker=worker: upload_snapshot(results[worker].public_ip_address, pem_file_path,
+                                                                                      results['manager_snapshot'][0]), ['workers_ready'])
+            plan.add(f'caught_up_{worker}', wait_until_caught_up(worker), [f'seed_{worker}'])
+            plan.add(f'register_{worker}', lambda results, worker=worker: proxy_admin(cluster['proxy_ip'], pem_file_path, 'POST', '/admin/workers',
+                                                                                      {'host': results[worker].private_ip_address}), [f'caught_up_{worker}'])
+
+    def remove(worker: dict):
+        def deregister(results):
+            proxy_admin(cluster['proxy_ip'], pem_file_path, 'DELETE', f"/admin/workers/{worker['private_ip']}")
+            return worker
+        return deregister
+
+    def terminate(worker: dict):
+        def terminate_instance(results):
+            (ec2_client or boto3.client('ec2')).terminate_instances(InstanceIds=[worker['instance_id']])
+        return terminate_instance
+
+    for worker in reversed(current[worker_count:] if worker_count < len(current) else []):
+        plan.add(f"removed_{worker['server_id']}", remove(worker))
+        plan.add(f"terminate_{worker['server_id']}", terminate(worker), [f"removed_{worker['server_id']}"])
+    return plan
+
+'''
+Description: Writes the public IP addresses of the provisioned instances to `instances_ips.json`, which the benchmark and the relays read,
+along with what `build_scale_plan` needs to add workers to the cluster later: the workers' server IDs, instance IDs and private IPs,
+the manager's private IP, the key pair, the subnet and the MySQL security group. The extra shards, if any, are listed with the
+public IPs of their manager and workers, and the shard map the proxy was given.
+Inputs:
+    results (dict) - The results of a cluster plan run (see `build_cluster_plan`).
+    subnet_id (str) - The ID of the subnet the instances were launched in.
+    path (str, optional) - The file to write.
+'''
+def export_instances_ips(results: dict, subnet_id: str, path: str = 'instances_ips.json'):
+    workers = [{"server_id": int(role.split('_')[1]), "instance_id": instance.id, "public_ip": instance.public_ip_address,
+                "private_ip": instance.private_ip_address}
+               for role, instance in results.items() if re.fullmatch(r'worker_\d+', role)]
+    instances_ips = {
+        "worker_ips": [worker["public_ip"] for worker in sorted(workers, key=lambda worker: worker["server_id"])],
+        "manager_ip": results['manager'].public_ip_address,
+        "proxy_ip": results['proxy'].public_ip_address,
+        "gatekeeper_ip": results['gatekeeper'].public_ip_address,
+        "trusted_host_ip": results['trusted_host'].public_ip_address,
+        "workers": sorted(workers, key=lambda worker: worker["server_id"]),
+        "manager_private_ip": results['manager'].private_ip_address,
+        "key_name": results['key_pair'].name,
+        "subnet_id": subnet_id,
+        "security_mysql_id": results['security_mysql']
+    }
+    if results.get('shard_map'):
+        instances_ips["shards"] = {
+            name: {"manager_ip": results[f'{name}_manager'].public_ip_address,
+                   "worker_ips": [results[role].public_ip_address for role in sorted((role for role in results if re.fullmatch(rf'{name}_worker_\d+', role)),
+                                                                                    key=lambda role: int(role.rsplit('_', 1)[1]))]}
+            for name in results['shard_map']['shards'] if name != 'default'
+        }
+        instances_ips["shard_map"] = results['shard_map']
+
+    with open(path, "w") as file:
+        json.dump(instances_ips, file)
+
+'''
+Description: Updates `instances_ips.json` after a scale plan run: the workers removed by the plan are dropped and the new ones appended.
+Inputs:
+    cluster (dict) - The cluster the plan was built for (see `build_scale_plan`).
+    results (dict) - The results of the scale plan run.
+    path (str, optional) - The file to write.
+'''
+def export_scaled_workers(cluster: dict, results: dict, path: str = 'instances_ips.json'):
+    removed = {result['server_id'] for step, result in results.items() if step.startswith('removed_')}
+    added = [{"server_id": int(step.split('_')[1]), "instance_id": instance.id, "public_ip": instance.public_ip_address,
+              "private_ip": instance.private_ip_address}
+             for step, instance in results.items() if re.fullmatch(r'worker_\d+', step)]
+    workers = sorted([worker for worker in cluster['workers'] if worker['server_id'] not in removed] + added, key=lambda worker: worker['server_id'])
+
+    with open(path, "w") as file:
+        json.dump(dict(cluster, workers=workers, worker_ips=[worker['public_ip'] for worker in workers]), file)
@@ -1,187 +1,3153 @@
-from flask import Flask, request, jsonify
-import random
-import mysql.connector
-import time
-import requests
-import os
-
-app = Flask(__name__)
-
-workers_ips = os.getenv('WORKERS_IPS')
-manager_ip = os.getenv('MANAGER_IP')
-mysql_username = os.getenv('MYSQL_USERNAME')
-mysql_password = os.getenv('MYSQL_PASSWORD')
-mysql_db_name = os.getenv('MYSQL_DB')
-
-if workers_ips:
-    workers = [{'host': ip, 'port': 3306} for ip in workers_ips.split(',')]
-    print(f"Workers: {workers}") 
-else:
-    workers = []
-    print("WORKERS_IPS environment variable is not set.")
-
-manager = {'host': manager_ip, 'port': 3306}
-
-'''
-Description: Connects to a MySQL database on the specified host and port using the provided credentials.
-Inputs:
-    host (str) - The host address of the MySQL server.
-    port (int) - The port number to connect to on the MySQL server.
-Outputs: conn (mysql.connector.connection) - A MySQL connection object if the connection is successful, or `None` if the connection fails.
-'''
-def connect_to_mysql(host: str, port: str):
-    try:
-        conn = mysql.connector.connect(host=host, port=port, user=mysql_username, password=mysql_password, database=mysql_db_name)
-        return conn
-    except mysql.connector.Error as err:
-        app.logger.error(f"Error connecting to MySQL at {host}:{port}: {err}")
-        return None
-
-'''
-Description: Executes a query directly on the MySQL manager database and returns the result.
-Inputs: query (str) - The SQL query to be executed on the MySQL database.
-Outputs: result (list or dict) - The result of the query execution:
-        - If successful, returns a list of tuples containing the query result.
-        - If an error occurs, returns a dictionary with an error message.
-'''
-# Direct hit: Forward to manager
-def direct_hit(query: str):
-    try:
-        conn = connect_to_mysql(manager['host'], manager['port'])
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute(query)
-            result = cursor.fetchall()
-            conn.commit()
-            conn.close()
-            return result
-        else:
-            return {'error': 'Failed to connect to the MySQL manager'}
-    except Exception as e:
-        app.logger.error(f"Error executing query on manager: {e}")
-        return {'error': 'Error executing query on manager'}
-
-
-'''
-Description: Executes a query on a randomly selected worker node from a list of available workers and returns the result.
-Inputs: query (str) - The SQL query to be executed on the selected worker node.
-Outputs: result (list or dict) - The result of the query execution:
-        - If successful, returns a list of tuples containing the query result.
-        - If an error occurs (e.g., no worker nodes available, connection failure, or query execution error), returns a dictionary with an error message.
-'''
-# Random: Forward to a random worker
-def random_worker(query: str):
-    try:
-        if not workers:
-            return {'error': 'No worker nodes available'}
-        worker = random.choice(workers)
-        conn = connect_to_mysql(worker['host'], worker['port'])
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute(query)
-            result = cursor.fetchall()
-            conn.close()
-            return result
-        else:
-            return {'error': 'Failed to connect to a worker node'}
-    except Exception as e:
-        app.logger.error(f"Error executing query on worker: {e}")
-        return {'error': 'Error executing query on worker'}
-
-'''
-Description: Executes a query on the worker node with the lowest ping time, optimizing for performance by selecting the fastest worker.
-Inputs: query (str) - The SQL query to be executed on the selected worker node.
-Outputs: result (list or dict) - The result of the query execution:
-        - If successful, returns a list of tuples containing the query result.
-        - If an error occurs (e.g., no worker nodes available, connection failure, or query execution error), returns a dictionary with an error message.
-'''
-# Customized: Forward to the worker with the lowest ping time
-def customized_worker(query:str):
-    try:
-        if not workers:
-            return {'error': 'No worker nodes available'}
-        
-        best_worker = None
-        lowest_ping = float('inf')
-        for worker in workers:
-            ping_time = measure_ping_time(worker['host'])
-            if ping_time < lowest_ping:
-                lowest_ping = ping_time
-                best_worker = worker
-        
-        if best_worker:
-            conn = connect_to_mysql(best_worker['host'], best_worker['port'])
-            if conn:
-                cursor = conn.cursor()
-                cursor.execute(query)
-                result = cursor.fetchall()
-                conn.close()
-                return result
-            else:
-                return {'error': f'Failed to connect to the worker with the lowest ping ({best_worker["host"]})'}
-        else:
-            return {'error': 'No workers available for customized routing'}
-    except Exception as e:
-        app.logger.error(f"Error executing query on customized worker: {e}")
-        return {'error': 'Error executing query on customized worker'}
-
-'''
-Description: Measures the ping time (response time) to a server by sending an HTTP GET request and returning the elapsed time.
-Inputs: host (str) - The hostname or IP address of the server to ping.
-Outputs: float - The time it took for the server to respond, in seconds. If an error occurs, returns `float('inf')`.
-'''
-# Measure the ping time to a server
-def measure_ping_time(host: str):
-    try:
-        response = requests.get(f'http://{host}', timeout=5)
-        return response.elapsed.total_seconds()
-    except requests.RequestException as e:
-        app.logger.error(f"Error measuring ping time to {host}: {e}")
-        return float('inf')
-
-'''
-Description: Handles incoming HTTP POST requests to the `/query` endpoint, 
-processes the query based on its type (READ or WRITE), 
-and routes it to the appropriate worker or manager.
-Inputs: JSON body (dict) containing:
-        - 'query' (str) - The SQL query to be executed.
-        - 'query_type' (str) - The type of query ('READ' or 'WRITE').
-        - 'mode' (str, optional) - The mode for routing 'READ' queries ('random' or 'customized'). Defaults to 'random' if not provided.
-Outputs: JSON response (dict) containing:
-        - The result of the query execution if successful.
-        - An error message if there was an issue with the query or processing.
-'''
-# Route for handling HTTP requests
-@app.route('/query', methods=['POST'])
-def handle_query():
-    try:
-        query = request.json.get('query')
-        query_type = request.json.get('query_type')  # 'READ' or 'WRITE'
-
-        if not query or not query_type:
-            return jsonify({'error': 'Query and query_type are required'}), 400
-
-        if query_type == 'WRITE':
-            result = direct_hit(query)  # WRITE operations go to the manager
-        elif query_type == 'READ':
-            # Choose between random or customized routing
-            mode = request.json.get('mode', 'random')  # Default to 'random'
-            if mode == 'random':
-                result = random_worker(query)
-            elif mode == 'customized':
-                result = customized_worker(query)
-            else:
-                result = random_worker(query)
-        else:
-            result = {'error': 'Unknown query type'}
-
-        if 'error' in result:
-            return jsonify(result), 500 
-
-        return jsonify(result)
-    except Exception as e:
-        app.logger.error(f"Error handling request: {e}")
-        return jsonify({'error': 'Internal server error'}), 500
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+from flask import Flask, Response, g, request, jsonify
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
+import heapq
+import itertools
+import json
+import random
+import re
+import mysql.connector
+import queue
+import threading
+import time
+import uuid
+import os
+import zlib
+
+import service_common
+
+app = Flask(__name__)
+
+workers_ips = os.getenv('WORKERS_IPS')
+manager_ip = os.getenv('MANAGER_IP')
+mysql_username = os.getenv('MYSQL_USERNAME')
+mysql_password = os.getenv('MYSQL_PASSWORD')
+mysql_db_name = os.getenv('MYSQL_DB')
+workers_weights = os.getenv('WORKERS_WEIGHTS')
+
+# Connection pool settings, shared by the manager pool and every worker pool
+pool_min_size = int(os.getenv('POOL_MIN_SIZE', '1'))
+pool_max_size = int(os.getenv('POOL_MAX_SIZE', '10'))
+pool_idle_timeout = float(os.getenv('POOL_IDLE_TIMEOUT', '300'))
+pool_checkout_timeout = float(os.getenv('POOL_CHECKOUT_TIMEOUT', '5'))
+pool_ping_interval = float(os.getenv('POOL_PING_INTERVAL', '1'))
+pool_maintenance_interval = float(os.getenv('POOL_MAINTENANCE_INTERVAL', '30'))
+mysql_connect_timeout = int(os.getenv('MYSQL_CONNECT_TIMEOUT', '2'))
+
+# Deadlines: the time budget of a request in milliseconds when the caller sets none in the `X-Request-Budget-Ms` header, and the largest accepted.
+# Statements still running when the deadline of their request passes are killed (see `DeadlineWatchdog`)
+default_deadline_ms = float(os.getenv('DEFAULT_DEADLINE_MS', '30000'))
+max_deadline_ms = float(os.getenv('MAX_DEADLINE_MS', '60000'))
+
+# Per-worker circuit breakers
+breaker_failure_threshold = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '3'))
+breaker_open_seconds = float(os.getenv('BREAKER_OPEN_SECONDS', '5'))
+
+# Background latency probing used by the customized routing mode
+latency_probe_interval = float(os.getenv('LATENCY_PROBE_INTERVAL', '2'))
+latency_ewma_alpha = float(os.getenv('LATENCY_EWMA_ALPHA', '0.3'))
+
+# Load-aware routing: queries in flight and observed query latency per backend
+observed_latency_default = float(os.getenv('OBSERVED_LATENCY_DEFAULT_MS', '5')) / 1000
+
+# Optional cache of READ results, invalidated per table by WRITEs
+result_cache_enabled = os.getenv('RESULT_CACHE_ENABLED', 'false').lower() == 'true'
+result_cache_max_entries = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1000'))
+result_cache_ttl = float(os.getenv('RESULT_CACHE_TTL', '5'))
+
+# Rows fetched per round trip when a READ result is streamed
+stream_chunk_size = int(os.getenv('STREAM_CHUNK_SIZE', '500'))
+
+# Batch endpoint limits
+batch_max_size = int(os.getenv('BATCH_MAX_SIZE', '1000'))
+batch_max_parallel = int(os.getenv('BATCH_MAX_PARALLEL', '8'))
+
+# Parameterized queries run as server-side prepared statements, cached per pooled connection (see `StatementCache`)
+statement_cache_size = int(os.getenv('STATEMENT_CACHE_SIZE', '64'))
+template_metrics_max = int(os.getenv('TEMPLATE_METRICS_MAX', '100'))
+
+# Opt-in group commit of WRITEs on the manager
+group_commit_enabled = os.getenv('GROUP_COMMIT_ENABLED', 'false').lower() == 'true'
+group_commit_window = float(os.getenv('GROUP_COMMIT_WINDOW_MS', '2')) / 1000
+group_commit_max_batch = int(os.getenv('GROUP_COMMIT_MAX_BATCH', '64'))
+
+# Replication lag tracking; replicas further behind than the budget get no READs
+replica_lag_budget = float(os.getenv('REPLICA_LAG_BUDGET', '5'))
+replica_status_interval = float(os.getenv('REPLICA_STATUS_INTERVAL', '1'))
+
+# Opt-in hedged READs: a READ still running after the `HEDGE_PERCENTILE` percentile of the recent latency of its query fingerprint
+# (its last `HEDGE_WINDOW` READs, once there are `HEDGE_MIN_SAMPLES`) is sent to a second worker as well, and the first result wins.
+# Hedges are capped at `HEDGE_MAX_RATIO` of the READs, with bursts of up to `HEDGE_BURST` hedges
+hedge_enabled = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+hedge_percentile = float(os.getenv('HEDGE_PERCENTILE', '95'))
+hedge_window = int(os.getenv('HEDGE_WINDOW', '200'))
+hedge_min_samples = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+hedge_min_delay = float(os.getenv('HEDGE_MIN_DELAY_MS', '1')) / 1000
+hedge_max_ratio = float(os.getenv('HEDGE_MAX_RATIO', '0.05'))
+hedge_burst = float(os.getenv('HEDGE_BURST', '10'))
+hedge_fingerprints_max = int(os.getenv('HEDGE_FINGERPRINTS_MAX', '1000'))
+
+# The result cache lives in each serving process and is only invalidated by the WRITEs that process handles: with several gunicorn processes,
+# a WRITE would leave stale results in the caches of the others for up to RESULT_CACHE_TTL seconds, so the cache is turned off
+if result_cache_enabled and service_common.server_mode == 'production' and service_common.server_workers > 1:
+    print("RESULT_CACHE_ENABLED is ignored with SERVER_WORKERS > 1: the result cache is per process and WRITEs would not invalidate the other processes' caches.")
+    result_cache_enabled = False
+
+# Elastic membership (see the `/admin/workers` endpoints): seconds a removed worker is given to finish its queries in flight, and the file
+# that shares the membership between the serving processes, polled every `MEMBERSHIP_SYNC_INTERVAL` seconds, and keeps it across restarts
+drain_timeout = float(os.getenv('DRAIN_TIMEOUT', '30'))
+workers_file = os.getenv('WORKERS_FILE')
+membership_sync_interval = float(os.getenv('MEMBERSHIP_SYNC_INTERVAL', '1'))
+
+# Sharding: the shard map (see `load_shard_map`) spreads the sharded tables over several replication groups. Without it, every table lives
+# on MANAGER_IP and its WORKERS_IPS replicas
+shard_map_file = os.getenv('SHARD_MAP_FILE')
+
+if workers_ips:
+    # Optional static weights, in the same order as WORKERS_IPS; replicas on larger instances can take a proportionally larger share of READs
+    weights = [float(weight) for weight in workers_weights.split(',')] if workers_weights else []
+    workers = [{'host': ip, 'port': 3306, 'weight': weights[i] if i < len(weights) else 1.0} for i, ip in enumerate(workers_ips.split(','))]
+    print(f"Workers: {workers}")
+else:
+    workers = []
+    print("WORKERS_IPS environment variable is not set.")
+
+# Workers added, drained or removed at runtime are saved to WORKERS_FILE, which then takes precedence over WORKERS_IPS
+if workers_file and os.path.exists(workers_file):
+    with open(workers_file) as file:
+        workers = json.load(file)
+    print(f"Workers from {workers_file}: {workers}")
+
+manager = {'host': manager_ip, 'port': 3306}
+
+metrics_registry = []  # every Metric, in the order they are rendered on the `/metrics` endpoint
+Metric = partial(service_common.Metric, metrics_registry)
+
+http_requests = Metric('http_requests_total', 'counter', 'HTTP requests handled, by method, route and status code.', ('method', 'route', 'status'))
+http_request_latency = Metric('http_request_duration_seconds', 'histogram',
+                              'Time to handle an HTTP request, up to the response headers for streamed responses, by method and route.', ('method', 'route'))
+
+# Timing spans of the request the current thread is handling; background threads have none
+trace = threading.local()
+
+'''
+Description: Records the start time of every request, for the per-route latency histogram, and starts its trace under the request ID
+set by the gatekeeper.
+'''
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    trace.spans = {}
+    trace.backend = None
+
+'''
+Description: Records the count and latency of every request, labelled with the route that matched it rather than the raw path.
+Inputs: response (flask.Response) - The response about to be sent.
+Outputs: flask.Response - The same response.
+'''
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    if 'request_start' in g:
+        http_request_latency.observe(time.perf_counter() - g.request_start, request.method, route)
+    http_requests.inc(request.method, route, str(response.status_code))
+    return response
+
+'''
+Description: Adds the request ID, the backend that served the query and the proxy's timing spans to every response.
+The spans are reported in a `Server-Timing` header, in milliseconds: 'proxy_route' (choosing the worker), 'proxy_conn' (checking out,
+and if needed opening, a pooled connection), 'proxy_db' (MySQL execution), 'proxy_commit' (waiting for a group commit) and 'proxy' (the whole request).
+For a streamed result, the spans stop when the first rows are about to be sent.
+Inputs: response (flask.Response) - The response about to be sent.
+Outputs: flask.Response - The same response with the `X-Request-ID`, `X-Backend` and `Server-Timing` headers.
+'''
+@app.after_request
+def add_trace_headers(response):
+    spans = getattr(trace, 'spans', None) or {}
+    timings = [f"proxy_{name};dur={seconds * 1000:.3f}" for name, seconds in spans.items()]
+    if 'request_start' in g:
+        timings.append(f"proxy;dur={(time.perf_counter() - g.request_start) * 1000:.3f}")
+    response.headers['Server-Timing'] = ', '.join(timings)
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    if getattr(trace, 'backend', None):
+        response.headers['X-Backend'] = trace.backend
+    trace.spans = None
+    return response
+
+'''
+Description: Records the backend serving the request the current thread is handling, reported in its `X-Backend` header.
+Inputs: backend (str) - The backend ("host:port"), or 'cache' for a result served from the result cache.
+'''
+def record_backend(backend: str):
+    if getattr(trace, 'spans', None) is not None:
+        trace.backend = backend
+
+'''
+Description: Adds the time spent in a `with` block to a timing span of the request the current thread is handling, if any.
+Spans entered several times, e.g. by a retried READ, add up.
+Inputs: name (str) - The span name.
+'''
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans = getattr(trace, 'spans', None)
+        if spans is not None:
+            spans[name] = spans.get(name, 0.0) + time.perf_counter() - start
+
+'''
+Description: Raised when the deadline of the request a query belongs to has passed: before the query could start, while it waited for
+a pooled connection, or while it ran, in which case the statement was killed on the backend.
+'''
+class DeadlineExceeded(Exception):
+    pass
+
+deadline_exceeded = Metric('proxy_deadline_exceeded_total', 'counter',
+                           'Requests and queries that ran out of time, by stage: on arrival, waiting for a connection or a group commit, or killed while running.', ('stage',))
+
+'''
+Description: Raised by a query cancelled because it is no longer needed, e.g. the READ of a hedged pair that lost the race (see `hedged_read`).
+Inputs:
+    message (str) - The error message.
+    started (bool, optional) - False if the query was cancelled before its statement was sent, leaving its connection usable.
+'''
+class QueryCancelled(Exception):
+    def __init__(self, message: str, started: bool = True):
+        super().__init__(message)
+        self.started = started
+
+# Deadline (monotonic time) of the request the current thread is handling; background threads have none
+request_deadline = threading.local()
+
+'''
+Description: Lets another thread cancel the statements run by the thread that entered the scope (see `cancel_scopes`): a statement running
+when `cancel` is called is killed on its backend, and a statement about to start is not started, the query raising `QueryCancelled`.
+'''
+class CancelScope:
+    def __init__(self):
+        self.cancelled = False
+        self._token = None  # watchdog token of the statement running
+        self._lock = threading.Lock()
+
+    '''
+    Description: Registers the statement about to run, unless the scope was cancelled.
+    Inputs: token (int) - The statement's `DeadlineWatchdog` token.
+    Outputs: bool - False if the scope was cancelled and the statement must not run.
+    '''
+    def attach(self, token: int):
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._token = token
+            return True
+
+    def detach(self):
+        with self._lock:
+            self._token = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._token is not None:
+                deadline_watchdog.cancel(self._token)
+
+# Cancel scope the current thread runs its queries in, if any
+cancel_scopes = threading.local()
+
+'''
+Description: Sets the deadline of the queries run by the current thread, e.g. a batch executor thread working for a request.
+Inputs: deadline (float or None) - The monotonic time by which they must complete, or None for no deadline.
+'''
+def set_deadline(deadline: float):
+    request_deadline.value = deadline
+
+'''
+Description: Returns the deadline of the queries run by the current thread.
+Outputs: float or None - A monotonic time, or None if the thread works for no request.
+'''
+def current_deadline():
+    return getattr(request_deadline, 'value', None)
+
+'''
+Description: Starts the deadline of every request from the budget the previous hop passed in the `X-Request-Budget-Ms` header
+(`DEFAULT_DEADLINE_MS` when there is none, at most `MAX_DEADLINE_MS`). A request whose budget was spent before it arrived is answered at once.
+Outputs: None, or a 504 JSON error response if the budget is already spent.
+'''
+@app.before_request
+def start_deadline():
+    try:
+        budget = float(request.headers.get('X-Request-Budget-Ms', default_deadline_ms))
+    except ValueError:
+        budget = default_deadline_ms
+    set_deadline(time.monotonic() + min(budget, max_deadline_ms) / 1000)
+    if budget <= 0:
+        deadline_exceeded.inc('arrival')
+        return jsonify({'error': 'Deadline exceeded'}), 504
+    return None
+
+'''
+Description: Kills the statements still running when the deadline of their request passes, with `KILL QUERY` sent to their backend over a
+separate connection, so that a runaway query frees the proxy thread waiting for it, its pooled connection and the MySQL thread running it.
+The statement then fails and the query raises `DeadlineExceeded` (see `deadline_guard`). Watching a statement costs a heap push under a lock;
+the watchdog thread only wakes up when a deadline passes, and sends each kill from a thread of its own so that a slow backend delays no other kill.
+'''
+class DeadlineWatchdog:
+    def __init__(self):
+        self._heap = []  # (deadline, token), including statements that already completed until their deadline comes up
+        self._watched = {}  # token -> (host, port, MySQL connection ID) of the statements running
+        self._killed = set()  # tokens of the statements killed and not yet unwatched
+        self._tokens = itertools.count()
+        self._cond = threading.Condition()
+        self.kills = 0
+
+    '''
+    Description: Watches the statements run on a connection until `unwatch`.
+    Inputs:
+        deadline (float) - The monotonic time by which they must complete.
+        node (dict) - The backend node the connection is open to.
+        connection_id (int) - The MySQL connection (thread) ID.
+    Outputs: int - A token to pass to `unwatch`.
+    '''
+    def watch(self, deadline: float, node: dict, connection_id: int):
+        with self._cond:
+            token = next(self._tokens)
+            self._watched[token] = (node['host'], node['port'], connection_id)
+            heapq.heappush(self._heap, (deadline, token))
+            if self._heap[0][1] == token:
+                self._cond.notify()
+            return token
+
+    '''
+    Description: Stops watching a connection.
+    Inputs: token (int) - The value returned by `watch`.
+    Outputs: bool - True if a statement on the connection was killed for its deadline.
+    '''
+    def unwatch(self, token: int):
+        with self._cond:
+            self._watched.pop(token, None)
+            if token in self._killed:
+                self._killed.discard(token)
+                return True
+            return False
+
+    '''
+    Description: Kills the statements running on a watched connection right away, as if their deadline had passed.
+    Inputs: token (int) - The value returned by `watch`.
+    '''
+    def cancel(self, token: int):
+        with self._cond:
+            target = self._watched.get(token)
+            if target is None or token in self._killed:
+                return
+            self._killed.add(token)
+        threading.Thread(target=self.kill, args=target + (False,), daemon=True).start()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0][1] not in self._watched:
+                        heapq.heappop(self._heap)
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                expired = []
+                while self._heap and self._heap[0][0] <= now:
+                    _, token = heapq.heappop(self._heap)
+                    if token in self._watched:
+                        self._killed.add(token)
+                        expired.append(self._watched[token])
+            for host, port, connection_id in expired:
+                threading.Thread(target=self.kill, args=(host, port, connection_id), daemon=True).start()
+
+    def kill(self, host: str, port: int, connection_id: int, deadline: bool = True):
+        conn = connect_to_mysql(host, port)
+        if conn is None:
+            app.logger.error(f"Could not connect to {host}:{port} to kill the query of connection {connection_id}")
+            return
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'KILL QUERY {int(connection_id)}')
+            cursor.close()
+            self.kills += 1
+            if deadline:
+                deadline_exceeded.inc('query')
+        except mysql.connector.Error as e:
+            # 1094: the connection was closed in the meantime, with its statement
+            if e.errno != 1094:
+                app.logger.error(f"Error killing the query of connection {connection_id} on {host}:{port}: {e}")
+        except Exception as e:
+            app.logger.error(f"Error killing the query of connection {connection_id} on {host}:{port}: {e}")
+        finally:
+            ConnectionPool._close(conn)
+
+deadline_watchdog = DeadlineWatchdog()
+
+'''
+Description: Bounds the statements run on a connection in a `with` block by the deadline of the current thread: the block is not entered once
+the deadline has passed, and statements still running when it passes are killed. Within a cancel scope (see `CancelScope`), they are also
+killed when the scope is cancelled. The connection must then be discarded, since a kill racing with the end of a statement may have hit
+the next one; `ConnectionPool.connection` does so for `DeadlineExceeded` and `QueryCancelled`.
+A WRITE that runs out of time may or may not have been applied.
+Inputs:
+    conn (mysql.connector.connection) - The connection the statements run on.
+    node (dict) - The backend node of the connection.
+Raises: DeadlineExceeded if the deadline passed before or during the block, QueryCancelled if the cancel scope was cancelled.
+'''
+@contextmanager
+def deadline_guard(conn, node: dict):
+    deadline = current_deadline()
+    scope = getattr(cancel_scopes, 'value', None)
+    if deadline is None and scope is None:
+        yield
+        return
+    if scope is not None and scope.cancelled:
+        raise QueryCancelled(f"Query on {node_key(node)} cancelled before it started", started=False)
+    if deadline is not None and time.monotonic() >= deadline:
+        deadline_exceeded.inc('query')
+        raise DeadlineExceeded(f"Deadline exceeded before the query started on {node_key(node)}")
+    token = deadline_watchdog.watch(deadline if deadline is not None else time.monotonic() + max_deadline_ms / 1000, node, conn.connection_id)
+    if scope is not None and not scope.attach(token):
+        deadline_watchdog.unwatch(token)
+        raise QueryCancelled(f"Query on {node_key(node)} cancelled before it started", started=False)
+    try:
+        try:
+            yield
+        finally:
+            if scope is not None:
+                scope.detach()
+            killed = deadline_watchdog.unwatch(token)
+    except Exception as e:
+        if killed:
+            raise interruption(node, scope) from e
+        raise
+    if killed:
+        raise interruption(node, scope)
+
+'''
+Description: Returns the error raised by a query killed by the watchdog: for its deadline, or because its cancel scope was cancelled.
+Inputs:
+    node (dict) - The backend node the query ran on.
+    scope (CancelScope or None) - The cancel scope of the query.
+Outputs: DeadlineExceeded or QueryCancelled - The error.
+'''
+def interruption(node: dict, scope):
+    if scope is not None and scope.cancelled:
+        return QueryCancelled(f"Query on {node_key(node)} cancelled")
+    return DeadlineExceeded(f"Query killed on {node_key(node)} at its deadline")
+
+'''
+Description: Connects to a MySQL database on the specified host and port using the provided credentials.
+The connection runs in autocommit mode so that a pooled connection never holds a transaction (and its read snapshot) open between queries,
+and gives up after `MYSQL_CONNECT_TIMEOUT` seconds so that a dead backend fails fast.
+Inputs:
+    host (str) - The host address of the MySQL server.
+    port (int) - The port number to connect to on the MySQL server.
+Outputs: conn (mysql.connector.connection) - A MySQL connection object if the connection is successful, or `None` if the connection fails.
+'''
+def connect_to_mysql(host: str, port: str):
+    try:
+        conn = mysql.connector.connect(host=host, port=port, user=mysql_username, password=mysql_password, database=mysql_db_name, autocommit=True,
+                                       connection_timeout=mysql_connect_timeout)
+        return conn
+    except mysql.connector.Error as err:
+        app.logger.error(f"Error connecting to MySQL at {host}:{port}: {err}")
+        return None
+
+'''
+Description: Raised when a connection cannot be checked out of a pool, either because the backend refused the connection
+or because every connection stayed busy for the whole checkout timeout.
+'''
+class PoolError(Exception):
+    pass
+
+'''
+Description: Raised when a pool cannot open a connection because the backend is down or unreachable.
+'''
+class BackendUnavailable(PoolError):
+    pass
+
+'''
+Description: A circuit breaker for one worker, driven by connection and query failures reported by the worker's pool.
+    - closed: the worker receives traffic. `failure_threshold` consecutive failures open the breaker.
+    - open: the worker receives no traffic. Once `open_seconds` have passed, a successful background probe moves it to half-open.
+    - half_open: the worker receives traffic again; the next success closes the breaker, the next failure opens it again.
+Inputs:
+    failure_threshold (int) - Consecutive failures that open the breaker.
+    open_seconds (float) - Minimum time the breaker stays open before a probe may re-admit the worker.
+'''
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.opened = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def allows_traffic(self):
+        return self.state != 'open'
+
+    def record_success(self):
+        with self._lock:
+            if self.state == 'open':
+                return
+            self.state = 'closed'
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'open':
+                return
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.opened += 1
+
+    '''
+    Description: Called by the background prober after a successful probe of the worker; re-admits an open worker once `open_seconds` have passed.
+    '''
+    def probe_passed(self):
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = 'half_open'
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'failures': self.failures,
+                'opened': self.opened,
+                'open_for': round(time.monotonic() - self.opened_at, 3) if self.state == 'open' else None,
+            }
+
+'''
+Description: A bounded, thread-safe pool of MySQL connections to a single backend.
+Idle connections are reused most-recently-used first, so the least used ones age out and are evicted after `idle_timeout` seconds
+(the pool never shrinks below `min_size`). A connection that sat idle for longer than `ping_interval` seconds is pinged before being handed out.
+If the pool has a circuit breaker, failed connection attempts and connections lost while in use count as failures, and connections
+returned in good health as successes.
+Inputs:
+    host (str) - The host address of the MySQL server.
+    port (int) - The port number of the MySQL server.
+    min_size (int) - The number of connections kept open even when idle.
+    max_size (int) - The maximum number of connections open at the same time.
+    idle_timeout (float) - Seconds after which an idle connection above `min_size` is closed.
+    checkout_timeout (float) - Seconds a checkout waits for a free connection once the pool is exhausted, at most until the request's deadline.
+    ping_interval (float) - Idle seconds after which a connection is checked for liveness on checkout.
+    breaker (CircuitBreaker, optional) - The circuit breaker of the backend.
+'''
+class ConnectionPool:
+    def __init__(self, host: str, port: int, min_size: int, max_size: int, idle_timeout: float, checkout_timeout: float, ping_interval: float,
+                 breaker: CircuitBreaker = None):
+        self.host = host
+        self.port = port
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_interval = ping_interval
+        self.breaker = breaker
+
+        self._idle = deque()  # (conn, released_at), most recently released on the right
+        self._size = 0  # open connections, idle or checked out
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.checkouts = 0
+        self.created = 0
+        self.closed = 0
+        self.evicted = 0
+        self.dead = 0
+        self.exhausted = 0
+        self.timeouts = 0
+
+    def acquire(self):
+        request_end = current_deadline()
+        deadline = time.monotonic() + self.checkout_timeout
+        if request_end is not None:
+            deadline = min(deadline, request_end)
+        waited = False
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolError(f"Connection pool for {self.host}:{self.port} is closed")
+                self._evict_idle(time.monotonic())
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    conn, released_at = None, None
+                else:
+                    if not waited:
+                        self.exhausted += 1
+                        waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if deadline == request_end:
+                            deadline_exceeded.inc('pool')
+                            raise DeadlineExceeded(f"Deadline exceeded waiting for a connection to {self.host}:{self.port}")
+                        self.timeouts += 1
+                        raise PoolError(f"Connection pool for {self.host}:{self.port} exhausted")
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                conn = connect_to_mysql(self.host, self.port)
+                if conn is None:
+                    self._discard(None)
+                    if self.breaker:
+                        self.breaker.record_failure()
+                    raise BackendUnavailable(f"Failed to connect to MySQL at {self.host}:{self.port}")
+                with self._cond:
+                    self.created += 1
+                    self.checkouts += 1
+                return conn
+
+            # Liveness check, skipped for connections that were in use a moment ago
+            if time.monotonic() - released_at > self.ping_interval and not self.is_alive(conn):
+                with self._cond:
+                    self.dead += 1
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self.checkouts += 1
+            return conn
+
+    def release(self, conn, discard: bool = False, record: bool = True):
+        if self.breaker and record:
+            if discard:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        if not discard:
+            with self._cond:
+                if not self._closed:
+                    self._idle.append((conn, time.monotonic()))
+                    self._cond.notify()
+                    return
+        self._discard(conn)
+
+    '''
+    Description: Checks out a connection for the duration of a `with` block and returns it to the pool afterwards.
+    If the block raises and the connection is no longer usable, the connection is closed instead of being returned.
+    A connection whose query ran out of time or was cancelled (see `deadline_guard`) is closed as well, without counting as a failure of the backend,
+    unless the query was cancelled before its statement was sent. No connection is checked out once the cancel scope of the thread is cancelled.
+    Raises: QueryCancelled if the cancel scope of the thread was cancelled.
+    '''
+    @contextmanager
+    def connection(self):
+        scope = getattr(cancel_scopes, 'value', None)
+        if scope is not None and scope.cancelled:
+            raise QueryCancelled(f"Query on {self.host}:{self.port} cancelled before it started", started=False)
+        with span('conn'):
+            conn = self.acquire()
+        try:
+            yield conn
+        except QueryCancelled as e:
+            self.release(conn, discard=e.started, record=False)
+            raise
+        except DeadlineExceeded:
+            self.release(conn, discard=True, record=False)
+            raise
+        except Exception:
+            self.release(conn, discard=not self.is_alive(conn))
+            raise
+        else:
+            self.release(conn)
+
+    '''
+    Description: Closes expired idle connections and opens new ones until the pool holds at least `min_size` connections.
+    Called periodically from the pool maintenance thread.
+    '''
+    def maintain(self):
+        with self._cond:
+            self._evict_idle(time.monotonic())
+            missing = 0 if self._closed else self.min_size - self._size
+            self._size += max(missing, 0)
+        for _ in range(missing):
+            conn = connect_to_mysql(self.host, self.port)
+            if conn is None:
+                self._discard(None)
+                continue
+            with self._cond:
+                self.created += 1
+                if not self._closed:
+                    self._idle.appendleft((conn, time.monotonic()))
+                    self._cond.notify()
+                    continue
+            # The pool was closed while connecting, its backend has left the cluster
+            self._discard(conn)
+
+    '''
+    Description: Closes the pool once its backend has left the cluster: idle connections are closed at once, connections still checked out
+    are closed when they are released, and further checkouts fail.
+    '''
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self.closed += len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'created': self.created,
+                'closed': self.closed,
+                'evicted': self.evicted,
+                'dead': self.dead,
+                'exhausted': self.exhausted,
+                'timeouts': self.timeouts,
+            }
+
+    # Must be called with self._cond held
+    def _evict_idle(self, now: float):
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self.evicted += 1
+            self._close(conn)
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            if conn is not None:
+                self.closed += 1
+            self._cond.notify()
+        if conn is not None:
+            self._close(conn)
+
+    @staticmethod
+    def is_alive(conn):
+        try:
+            return conn.is_connected()
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+pools = {}
+pools_lock = threading.Lock()
+breakers = {f"{worker['host']}:{worker['port']}": CircuitBreaker(breaker_failure_threshold, breaker_open_seconds) for worker in workers}
+
+'''
+Description: Returns the key identifying a backend node in the pools and statistics.
+Inputs: node (dict) - A backend node with 'host' and 'port' keys (the manager or an entry of `workers`).
+Outputs: str - The node key in the form "host:port".
+'''
+def node_key(node: dict):
+    return f"{node['host']}:{node['port']}"
+
+'''
+Description: Returns the connection pool of a backend node, creating it on first use.
+Inputs: node (dict) - A backend node with 'host' and 'port' keys (the manager or an entry of `workers`).
+Outputs: ConnectionPool - The pool of connections to that node.
+Raises: PoolError if the node is a worker that was removed (see `retire_worker`) after it was picked.
+'''
+def get_pool(node: dict):
+    key = node_key(node)
+    pool = pools.get(key)
+    if pool is None:
+        if node.get('removed'):
+            raise PoolError(f"Worker {key} was removed")
+        with pools_lock:
+            pool = pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(node['host'], node['port'], pool_min_size, pool_max_size,
+                                      pool_idle_timeout, pool_checkout_timeout, pool_ping_interval, breakers.get(key))
+                pools[key] = pool
+    return pool
+
+'''
+Description: Periodically evicts idle connections and tops every pool up to its minimum size. Runs in a daemon thread.
+'''
+def pool_maintenance_loop():
+    while True:
+        time.sleep(pool_maintenance_interval)
+        for pool in list(pools.values()):
+            try:
+                pool.maintain()
+            except Exception as e:
+                app.logger.error(f"Error maintaining pool for {pool.host}:{pool.port}: {e}")
+
+statement_cache_events = Metric('proxy_statement_cache_total', 'counter',
+                                'Parameterized query executions that reused a statement prepared on their connection (hit) or prepared it (prepare), '
+                                'and prepared statements closed to make room for another (eviction).', ('event',))
+template_latency = Metric('proxy_template_query_duration_seconds', 'histogram',
+                          'Latency of parameterized queries, by statement template and query type. Templates beyond TEMPLATE_METRICS_MAX share the "other" series.',
+                          ('template', 'query_type'))
+template_labels = set()  # templates with their own series in the template metrics
+template_labels_lock = threading.Lock()
+
+'''
+Description: An LRU cache of the server-side prepared statements of one pooled connection, keyed by statement template.
+A template is prepared the first time the connection runs it, and later executions only send the parameters. Beyond `max_size` templates,
+the statement used least recently is closed on the server. The cache is only used by the thread the connection is checked out to, so it takes no lock.
+Inputs: max_size (int) - The maximum number of statements kept prepared on the connection.
+'''
+class StatementCache:
+    def __init__(self, max_size: int):
+        self.max_size = max(max_size, 1)
+        self._statements = OrderedDict()  # template -> (operation, prepared cursor)
+
+    def execute(self, conn, template: str, params: list):
+        entry = self._statements.get(template)
+        prepared = entry is None
+        if prepared:
+            # A prepared cursor only reuses its statement when given the very string object it prepared, which is kept with it
+            entry = self._statements[template] = (template, conn.cursor(prepared=True))
+            statement_cache_events.inc('prepare')
+            while len(self._statements) > self.max_size:
+                _, (_, evicted) = self._statements.popitem(last=False)
+                statement_cache_events.inc('eviction')
+                self._close(evicted)
+        else:
+            self._statements.move_to_end(template)
+            statement_cache_events.inc('hit')
+        operation, cursor = entry
+        try:
+            cursor.execute(operation, params)
+        except Exception:
+            # The template may not even be preparable, it is only kept once it ran
+            if prepared:
+                del self._statements[template]
+                self._close(cursor)
+            raise
+        return cursor
+
+    @staticmethod
+    def _close(cursor):
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+'''
+Description: Runs a parameterized query as a server-side prepared statement on a pooled connection, through the connection's statement cache.
+Inputs:
+    conn (mysql.connector.connection) - The connection, checked out of its pool.
+    template (str) - The statement template, with `%s` or `?` placeholders.
+    params (list) - The values bound to the placeholders.
+Outputs: cursor - The prepared cursor holding the result. It belongs to the statement cache and must not be closed.
+Raises: mysql.connector.Error if the statement cannot be prepared or executed.
+'''
+def execute_prepared(conn, template: str, params: list):
+    cache = getattr(conn, 'statement_cache', None)
+    if cache is None:
+        cache = conn.statement_cache = StatementCache(statement_cache_size)
+    return cache.execute(conn, template, params)
+
+'''
+Description: Returns the label a statement template is recorded under in the template metrics: its normalized text, or "other" once
+`TEMPLATE_METRICS_MAX` templates have their own series, which keeps the number of series bounded.
+Inputs: template (str) - The statement template.
+Outputs: str - The label.
+'''
+def template_label(template: str):
+    label = normalize_query(template)
+    with template_labels_lock:
+        if label not in template_labels:
+            if len(template_labels) >= template_metrics_max:
+                return 'other'
+            template_labels.add(label)
+    return label
+
+'''
+Description: Executes a query on a backend node over a pooled connection and returns the rows it produced.
+Inputs:
+    node (dict) - The backend node (the manager or an entry of `workers`) to run the query on.
+    query (str) - The SQL query to be executed, or a statement template if `params` is given.
+    params (list, optional) - The parameters of a parameterized query, which then runs as a prepared statement (see `execute_statement`).
+Outputs: list - A list of tuples containing the query result, empty for statements that return no rows.
+Raises: PoolError if no connection could be obtained, mysql.connector.Error if the query fails, DeadlineExceeded if the request ran out of time.
+'''
+def run_query(node: dict, query: str, params: list = None):
+    with tracked(node), get_pool(node).connection() as conn:
+        cursor = conn.cursor()
+        try:
+            with span('db'), deadline_guard(conn, node):
+                return execute_statement(conn, cursor, query, params)
+        finally:
+            cursor.close()
+
+'''
+Description: Executes a query directly on the MySQL manager database and returns the result.
+When the result cache is enabled, cached reads of the tables the query touches are invalidated once it succeeds.
+When group commit is enabled, the query is handed to the group committer and the call returns once its transaction has committed.
+Inputs:
+    query (str) - The SQL query to be executed on the MySQL database, or a statement template if `params` is given.
+    params (list, optional) - The parameters of a parameterized query.
+Outputs: result (list or dict) - The result of the query execution:
+        - If successful, returns a list of tuples containing the query result.
+        - If an error occurs, returns a dictionary with an error message.
+'''
+# Direct hit: Forward to manager
+def direct_hit(query: str, params: list = None):
+    if group_commit_enabled:
+        with span('commit'):
+            result = group_committer.submit(query, params)
+        record_backend(node_key(manager))
+        return result
+    try:
+        result = run_query(manager, query, params)
+        if result_cache_enabled:
+            result_cache.invalidate(query_tables(query))
+        return result
+    except DeadlineExceeded:
+        raise
+    except PoolError as e:
+        app.logger.error(f"Error connecting to manager: {e}")
+        return {'error': 'Failed to connect to the MySQL manager'}
+    except Exception as e:
+        app.logger.error(f"Error executing query on manager: {e}")
+        return {'error': 'Error executing query on manager'}
+
+
+worker_load = {}  # node key -> {'inflight': queries in flight, 'latency': exponentially weighted query latency in seconds}
+worker_load_lock = threading.Lock()
+
+backend_query_latency = Metric('proxy_backend_query_duration_seconds', 'histogram', 'Query latency per backend, by query type and routing mode.',
+                               ('backend', 'role', 'query_type', 'mode'))
+backend_query_errors = Metric('proxy_backend_query_errors_total', 'counter', 'Queries that failed on a backend, by query type and routing mode.',
+                              ('backend', 'role', 'query_type', 'mode'))
+
+# Query type and routing mode of the queries the current thread runs, used to label the backend metrics
+query_labels = threading.local()
+
+'''
+Description: Sets the query type and routing mode the backend metrics of the queries run by the current thread are labelled with.
+Threads that never set them, such as the background probes, are labelled 'MONITOR'.
+Inputs:
+    query_type (str) - 'READ' or 'WRITE'.
+    mode (str) - The routing mode of a READ, or how a WRITE is committed ('direct', 'batch' or 'group_commit').
+'''
+def set_query_labels(query_type: str, mode: str):
+    query_labels.value = (query_type, mode)
+
+'''
+Description: Marks the start of a query on a backend node for load-aware routing and the backend metrics.
+Inputs: node (dict) - The backend node.
+Outputs: tuple - The start time and metric labels, to be passed to `end_request`.
+'''
+def begin_request(node: dict):
+    key = node_key(node)
+    with worker_load_lock:
+        load = worker_load.setdefault(key, {'inflight': 0, 'latency': None})
+        load['inflight'] += 1
+    record_backend(key)
+    labels = (key, 'manager' if node is manager or node.get('role') == 'manager' else 'worker') + getattr(query_labels, 'value', ('MONITOR', 'none'))
+    return time.perf_counter(), labels
+
+'''
+Description: Marks the end of a query on a backend node, folds its latency into the node's exponentially weighted query latency
+and records it in the backend metrics.
+Inputs:
+    node (dict) - The backend node.
+    token (tuple) - The value returned by `begin_request`.
+    error (bool, optional) - Whether the query failed.
+'''
+def end_request(node: dict, token: tuple, error: bool = False):
+    start, labels = token
+    elapsed = time.perf_counter() - start
+    with worker_load_lock:
+        load = worker_load[node_key(node)]
+        load['inflight'] -= 1
+        previous = load['latency']
+        load['latency'] = elapsed if previous is None else latency_ewma_alpha * elapsed + (1 - latency_ewma_alpha) * previous
+    backend_query_latency.observe(elapsed, *labels)
+    if error:
+        backend_query_errors.inc(*labels)
+
+'''
+Description: Tracks a query on a backend node for the duration of a `with` block. The query counts as failed if the block raises.
+'''
+@contextmanager
+def tracked(node: dict):
+    token = begin_request(node)
+    try:
+        yield
+    except Exception:
+        end_request(node, token, error=True)
+        raise
+    else:
+        end_request(node, token)
+
+'''
+Description: Estimates the cost of sending one more query to a worker: the queries it would have in flight times its recent query latency,
+divided by its static weight. Workers without observed latency use `OBSERVED_LATENCY_DEFAULT_MS`.
+Must be called with `worker_load_lock` held.
+Inputs: worker (dict) - The worker node.
+Outputs: float - The estimated cost.
+'''
+def worker_cost(worker: dict):
+    load = worker_load.get(node_key(worker))
+    inflight = load['inflight'] if load else 0
+    latency = load['latency'] if load and load['latency'] is not None else observed_latency_default
+    return (inflight + 1) * latency / worker.get('weight', 1.0)
+
+'''
+Description: Chooses a worker by the power of two choices: samples two distinct workers with probability proportional to their weight
+and keeps the one with the lower `worker_cost`.
+Inputs: candidates (list) - The eligible worker nodes, not empty.
+Outputs: worker (dict) - The selected worker node.
+'''
+def power_of_two_choices(candidates: list):
+    if len(candidates) == 1:
+        return candidates[0]
+    first = random.choices(candidates, weights=[w.get('weight', 1.0) for w in candidates])[0]
+    others = [w for w in candidates if w is not first]
+    second = random.choices(others, weights=[w.get('weight', 1.0) for w in others])[0]
+    with worker_load_lock:
+        return first if worker_cost(first) <= worker_cost(second) else second
+
+'''
+Description: Chooses the worker with the fewest queries in flight relative to its weight; ties are broken at random.
+Inputs: candidates (list) - The eligible worker nodes, not empty.
+Outputs: worker (dict) - The selected worker node.
+'''
+def least_outstanding(candidates: list):
+    with worker_load_lock:
+        def outstanding(worker):
+            load = worker_load.get(node_key(worker))
+            return ((load['inflight'] if load else 0) + 1) / worker.get('weight', 1.0)
+        lowest = min(outstanding(w) for w in candidates)
+        return random.choice([w for w in candidates if outstanding(w) == lowest])
+
+'''
+Description: Executes a READ directly on the MySQL manager database, bypassing the workers, and returns the result.
+Inputs:
+    query (str) - The SQL query to be executed on the manager.
+    min_position (tuple, optional) - Ignored, the manager is always up to date.
+    params (list, optional) - The parameters of a parameterized query.
+Outputs: result (list or dict) - The result of the query execution:
+        - If successful, returns a list of tuples containing the query result.
+        - If an error occurs, returns a dictionary with an error message.
+'''
+# Direct: Forward a READ to the manager
+def manager_read(query: str, min_position: tuple = None, params: list = None):
+    try:
+        return run_query(manager, query, params)
+    except DeadlineExceeded:
+        raise
+    except PoolError as e:
+        app.logger.error(f"Error connecting to manager: {e}")
+        return {'error': 'Failed to connect to the MySQL manager'}
+    except Exception as e:
+        app.logger.error(f"Error executing query on manager: {e}")
+        return {'error': 'Error executing query on manager'}
+
+READ_MODES = ('direct', 'random', 'customized', 'p2c', 'least_outstanding')
+
+'''
+Description: Chooses the worker a READ is sent to under the given routing mode, among the replicas that are fresh enough:
+replicas lagging more than `REPLICA_LAG_BUDGET` seconds are skipped, and with a session token only replicas known to have
+applied the manager's binlog up to that position are considered.
+Workers whose circuit breaker is open are skipped as well.
+Inputs:
+    mode (str) - The routing mode, 'direct', 'random', 'customized', 'p2c' or 'least_outstanding'. Unknown modes fall back to 'random'.
+    min_position (tuple, optional) - The manager binlog position (file, position) the replica must have applied.
+    exclude (dict, optional) - A worker not to choose, e.g. the one a failed READ is being retried from.
+    group (list, optional) - The workers to choose from: `workers` by default, or the replicas of a shard (see `shard_nodes`).
+Outputs: worker (dict or None) - The selected worker node, or None if the READ should go to the manager ('direct' mode, or no replica qualifies).
+'''
+def pick_worker(mode: str, min_position: tuple = None, exclude: dict = None, group: list = None):
+    if mode == 'direct':
+        return None
+    candidates = [w for w in fresh_workers(min_position, group) if w is not exclude]
+    if not candidates:
+        return None
+    if mode == 'p2c':
+        return power_of_two_choices(candidates)
+    if mode == 'least_outstanding':
+        return least_outstanding(candidates)
+    if mode == 'customized':
+        if fastest_worker in candidates:
+            return fastest_worker
+        with latency_lock:
+            known = [w for w in candidates if node_key(w) in worker_latency]
+            if known:
+                return min(known, key=lambda w: worker_latency[node_key(w)])
+        # Until the first probe round completes there is no estimate yet, fall back to random routing
+    return random.choice(candidates)
+
+'''
+Description: Tells whether an exception means the backend itself failed (unreachable, connection lost, pool exhausted),
+as opposed to an error in the query, so that the READ is worth retrying elsewhere.
+Inputs: error (Exception) - The exception raised while running a query.
+Outputs: bool - True for backend failures.
+'''
+def is_backend_failure(error: Exception):
+    return isinstance(error, (PoolError, mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError))
+
+# Literals, comments and whitespace, replaced to turn a query into its fingerprint (see gatekeeper.py)
+LITERAL_PATTERN = re.compile(r'''(?:'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")|(`[^`]*`)|/\*.*?\*/|(?:--\s|#)[^\n]*|\b0x[0-9a-f]+\b|\b\d+(?:\.\d*)?(?:e[+-]?\d+)?\b|%s|\?|(\s+)''',
+                             re.IGNORECASE | re.DOTALL)
+LIST_PATTERN = re.compile(r'\?(?:\s*,\s*\?)+')
+
+'''
+Description: Reduces a query to its fingerprint: literals and placeholders become `?`, lists of them `?+`, comments and runs of whitespace
+a single space, so that the queries of the same shape share their latency statistics.
+Inputs: query (str) - The SQL query, or a statement template.
+Outputs: str - The lower-cased fingerprint.
+'''
+def query_fingerprint(query: str):
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        if match.group(2) or match.group(0).startswith(('/*', '--', '#')):
+            return ' '
+        return '?'
+    text = LITERAL_PATTERN.sub(replace, query).strip().lower()
+    return LIST_PATTERN.sub('?+', text).rstrip('; ')
+
+'''
+Description: Tracks the recent latency of READs per query fingerprint, in a window of the last `window` READs of each fingerprint, and
+derives the delay after which a READ is hedged: the given percentile of its window, at least `min_delay`. The percentile is recomputed
+every few samples rather than on every READ. Only the `max_fingerprints` most recently seen fingerprints are kept.
+Inputs:
+    percentile (float) - The percentile of the recent latency a READ is hedged after, e.g. 95.
+    window (int) - The number of recent READs kept per fingerprint.
+    min_samples (int) - The number of READs of a fingerprint needed before its READs are hedged.
+    min_delay (float) - The minimum hedging delay, in seconds.
+    max_fingerprints (int) - The number of fingerprints tracked.
+'''
+class FingerprintLatency:
+    def __init__(self, percentile: float, window: int, min_samples: int, min_delay: float, max_fingerprints: int):
+        self.percentile = percentile
+        self.window = max(window, 1)
+        self.min_samples = max(min(min_samples, self.window), 1)
+        self.min_delay = min_delay
+        self.max_fingerprints = max_fingerprints
+        self._entries = OrderedDict()  # fingerprint -> [recent latencies, hedging delay or None, samples since it was computed]
+        self._lock = threading.Lock()
+
+    '''
+    Description: Returns the delay after which a READ of a fingerprint is hedged.
+    Inputs: fingerprint (str) - The query fingerprint.
+    Outputs: float or None - The delay in seconds, or None while the fingerprint has too few samples.
+    '''
+    def delay(self, fingerprint: str):
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                return None
+            self._entries.move_to_end(fingerprint)
+            return entry[1]
+
+    '''
+    Description: Records the latency of a READ.
+    Inputs:
+        fingerprint (str) - The query fingerprint.
+        seconds (float) - The latency of the READ.
+    '''
+    def observe(self, fingerprint: str, seconds: float):
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                entry = self._entries[fingerprint] = [deque(maxlen=self.window), None, 0]
+                if len(self._entries) > self.max_fingerprints:
+                    self._entries.popitem(last=False)
+            entry[0].append(seconds)
+            entry[2] += 1
+            if len(entry[0]) >= self.min_samples and (entry[1] is None or entry[2] >= max(len(entry[0]) // 10, 1)):
+                ordered = sorted(entry[0])
+                index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+                entry[1] = max(ordered[index], self.min_delay)
+                entry[2] = 0
+
+'''
+Description: Caps the share of READs that are hedged. Every hedgeable READ adds `ratio` of a token to the budget, up to `burst` tokens,
+and every hedge takes one, so that hedges stay under `ratio` of the READs over time: when a worker is slow for every query, hedging
+stops instead of doubling the load on the others.
+Inputs:
+    ratio (float) - The maximum share of READs hedged, e.g. 0.05.
+    burst (float) - The maximum number of tokens, i.e. of hedges sent back to back.
+'''
+class HedgeBudget:
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    '''
+    Description: Takes a token for a hedge.
+    Outputs: bool - True if the hedge may be sent.
+    '''
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+hedge_latency = FingerprintLatency(hedge_percentile, hedge_window, hedge_min_samples, hedge_min_delay, hedge_fingerprints_max)
+hedge_budget = HedgeBudget(hedge_max_ratio, hedge_burst)
+
+hedged_reads = Metric('proxy_hedged_reads_total', 'counter',
+                      'Hedged READs: hedges sent to a second worker, hedges that finished first (won), and hedges not sent because the hedge budget was spent (throttled).',
+                      ('event',))
+
+'''
+Description: Runs one READ of a hedged pair on a `hedge_executor` thread, under the labels and deadline of the request, in a cancel scope.
+Inputs:
+    node (dict) - The backend node.
+    query (str) - The SQL query, or a statement template if `params` is given.
+    params (list) - The parameters of a parameterized query, or None.
+    labels (tuple) - The query type and routing mode of the READ, for the backend metrics.
+    deadline (float) - The deadline of the request, or None.
+    scope (CancelScope) - The scope the READ is cancelled through.
+Outputs: tuple - The query result and the READ's latency in seconds.
+'''
+def run_hedge_attempt(node: dict, query: str, params: list, labels: tuple, deadline: float, scope: CancelScope):
+    set_query_labels(*labels)
+    set_deadline(deadline)
+    cancel_scopes.value = scope
+    start = time.perf_counter()
+    try:
+        return run_query(node, query, params), time.perf_counter() - start
+    finally:
+        cancel_scopes.value = None
+
+'''
+Description: Executes a READ on a worker, hedging it: if it is still running after the hedging delay of its fingerprint (see `FingerprintLatency`),
+the same READ is sent to a second fresh and healthy worker of the same group chosen by `pick_worker`, unless the hedge budget is spent.
+The first READ to succeed wins; the other is cancelled, its statement killed on its worker. A READ whose fingerprint has too few samples yet
+is not hedged.
+Inputs:
+    worker (dict) - The worker chosen for the READ.
+    query (str) - The SQL query to be executed.
+    mode (str) - The routing mode, passed to `pick_worker` to choose the second worker.
+    min_position (tuple, optional) - The binlog position (file, position) the second worker must have applied.
+    params (list, optional) - The parameters of a parameterized query.
+    group (list, optional) - The workers of the replication group of `worker`, e.g. of a shard (see `shard_nodes`); `workers` by default.
+Outputs: list - A list of tuples containing the query result.
+Raises: the error of the first READ if neither succeeded (PoolError, mysql.connector.Error, DeadlineExceeded).
+'''
+def hedged_read(worker: dict, query: str, mode: str, min_position: tuple = None, params: list = None, group: list = None):
+    fingerprint = query_fingerprint(query)
+    delay = hedge_latency.delay(fingerprint)
+    hedge_budget.deposit()
+    if delay is None:
+        start = time.perf_counter()
+        result = run_query(worker, query, params)
+        hedge_latency.observe(fingerprint, time.perf_counter() - start)
+        return result
+
+    labels = getattr(query_labels, 'value', ('READ', mode))
+    deadline = current_deadline()
+    attempts = {}  # future -> (node, cancel scope)
+    scope = CancelScope()
+    attempts[hedge_executor.submit(run_hedge_attempt, worker, query, params, labels, deadline, scope)] = (worker, scope)
+    with span('db'):
+        done, pending = wait(list(attempts), timeout=delay)
+        if not done:
+            with span('route'):
+                second = pick_worker(mode, min_position, exclude=worker, group=group)
+            if second is None:
+                pass
+            elif not hedge_budget.withdraw():
+                hedged_reads.inc('throttled')
+            else:
+                hedged_reads.inc('sent')
+                scope = CancelScope()
+                attempts[hedge_executor.submit(run_hedge_attempt, second, query, params, labels, deadline, scope)] = (second, scope)
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                node, _ = attempts[future]
+                try:
+                    result, elapsed = future.result()
+                except Exception as e:
+                    if node is worker or error is None:
+                        error = e
+                    if not is_backend_failure(e) and not isinstance(e, QueryCancelled):
+                        pending = set()
+                    continue
+                for other in pending:
+                    attempts[other][1].cancel()
+                if node is not worker:
+                    hedged_reads.inc('won')
+                record_backend(node_key(node))
+                hedge_latency.observe(fingerprint, elapsed)
+                return result
+        for future in attempts:
+            attempts[future][1].cancel()
+    raise error
+
+'''
+Description: Executes a READ on the worker chosen by `pick_worker` among the workers of a shard. If the worker fails, the READ is retried once on
+another healthy worker of the shard, or on the shard's manager if there is none. With `HEDGE_ENABLED`, a READ sent to a worker is hedged
+(see `hedged_read`).
+Inputs:
+    query (str) - The SQL query to be executed.
+    mode (str) - The routing mode passed to `pick_worker`.
+    min_position (tuple, optional) - The binlog position (file, position) of the shard's manager the worker must have applied.
+    params (list, optional) - The parameters of a parameterized query.
+    shard (str, optional) - The shard to read from (see `shard_nodes`); the default shard, `manager` and `workers`, by default.
+Outputs: list - A list of tuples containing the query result.
+Raises: PoolError or mysql.connector.Error if the query failed.
+'''
+def read_with_retry(query: str, mode: str, min_position: tuple = None, params: list = None, shard: str = 'default'):
+    shard_manager, group = shard_nodes(shard)
+    with span('route'):
+        worker = pick_worker(mode, min_position, group=group) or shard_manager
+    try:
+        if hedge_enabled and worker is not shard_manager:
+            return hedged_read(worker, query, mode, min_position, params, group)
+        return run_query(worker, query, params)
+    except Exception as e:
+        if worker is shard_manager or not is_backend_failure(e):
+            raise
+        app.logger.warning(f"Worker {worker['host']} failed ({e}), retrying the query on another node")
+        with span('route'):
+            retry = pick_worker(mode, min_position, exclude=worker, group=group) or shard_manager
+        return run_query(retry, query, params)
+
+'''
+Description: Executes a query on a randomly selected worker node from a list of available workers and returns the result.
+If no replica is fresh enough (see `pick_worker`), the query is executed on the manager instead. A READ failing because its worker
+failed is retried once on another node (see `read_with_retry`).
+Inputs:
+    query (str) - The SQL query to be executed on the selected worker node.
+    min_position (tuple, optional) - The manager binlog position (file, position) the worker must have applied.
+    params (list, optional) - The parameters of a parameterized query.
+Outputs: result (list or dict) - The result of the query execution:
+        - If successful, returns a list of tuples containing the query result.
+        - If an error occurs (e.g., no worker nodes available, connection failure, or query execution error), returns a dictionary with an error message.
+'''
+# Random: Forward to a random worker
+def random_worker(query: str, min_position: tuple = None, params: list = None):
+    try:
+        if not workers:
+            return {'error': 'No worker nodes available'}
+        return read_with_retry(query, 'random', min_position, params)
+    except DeadlineExceeded:
+        raise
+    except PoolError as e:
+        app.logger.error(f"Error connecting to worker: {e}")
+        return {'error': 'Failed to connect to a worker node'}
+    except Exception as e:
+        app.logger.error(f"Error executing query on worker: {e}")
+        return {'error': 'Error executing query on worker'}
+
+'''
+Description: Executes a query on the worker node with the lowest MySQL round-trip time, optimizing for performance by selecting the fastest worker.
+The fastest worker is maintained in memory by the background latency prober, so routing does no network I/O of its own.
+If no replica is fresh enough (see `pick_worker`), the query is executed on the manager instead. A READ failing because its worker
+failed is retried once on another node (see `read_with_retry`).
+Inputs:
+    query (str) - The SQL query to be executed on the selected worker node.
+    min_position (tuple, optional) - The manager binlog position (file, position) the worker must have applied.
+    params (list, optional) - The parameters of a parameterized query.
+Outputs: result (list or dict) - The result of the query execution:
+        - If successful, returns a list of tuples containing the query result.
+        - If an error occurs (e.g., no worker nodes available, connection failure, or query execution error), returns a dictionary with an error message.
+'''
+# Customized: Forward to the worker with the lowest ping time
+def customized_worker(query:str, min_position: tuple = None, params: list = None):
+    try:
+        if not workers:
+            return {'error': 'No worker nodes available'}
+
+        try:
+            return read_with_retry(query, 'customized', min_position, params)
+        except PoolError as e:
+            app.logger.error(f"Error connecting to worker: {e}")
+            return {'error': 'Failed to connect to the worker with the lowest ping'}
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error executing query on customized worker: {e}")
+        return {'error': 'Error executing query on customized worker'}
+
+'''
+Description: Executes a query on the least loaded worker node, as chosen by `power_of_two_choices` ('p2c' mode) or `least_outstanding`
+('least_outstanding' mode), taking queries in flight, recent query latency and the workers' static weights into account.
+If no replica is fresh enough (see `pick_worker`), the query is executed on the manager instead. A READ failing because its worker
+failed is retried once on another node (see `read_with_retry`).
+Inputs:
+    query (str) - The SQL query to be executed on the selected worker node.
+    min_position (tuple, optional) - The manager binlog position (file, position) the worker must have applied.
+    mode (str, optional) - 'p2c' or 'least_outstanding'. Defaults to 'p2c'.
+    params (list, optional) - The parameters of a parameterized query.
+Outputs: result (list or dict) - The result of the query execution:
+        - If successful, returns a list of tuples containing the query result.
+        - If an error occurs (e.g., no worker nodes available, connection failure, or query execution error), returns a dictionary with an error message.
+'''
+# Load-aware: Forward to the least loaded worker
+def balanced_worker(query: str, min_position: tuple = None, mode: str = 'p2c', params: list = None):
+    try:
+        if not workers:
+            return {'error': 'No worker nodes available'}
+        return read_with_retry(query, mode, min_position, params)
+    except DeadlineExceeded:
+        raise
+    except PoolError as e:
+        app.logger.error(f"Error connecting to worker: {e}")
+        return {'error': 'Failed to connect to a worker node'}
+    except Exception as e:
+        app.logger.error(f"Error executing query on balanced worker: {e}")
+        return {'error': 'Error executing query on worker'}
+
+worker_latency = {}  # node key -> exponentially weighted MySQL round-trip time, in seconds
+fastest_worker = None
+latency_lock = threading.Lock()
+
+'''
+Description: Measures the MySQL round-trip time of a worker by running `SELECT 1` over a pooled connection.
+Inputs: worker (dict) - The worker node to ping.
+Outputs: float - The round-trip time in seconds. If the worker cannot be reached or the query fails, returns `float('inf')`.
+'''
+def measure_ping_time(worker: dict):
+    start = time.perf_counter()
+    try:
+        run_query(worker, 'SELECT 1')
+        return time.perf_counter() - start
+    except Exception as e:
+        app.logger.error(f"Error measuring ping time to {worker['host']}: {e}")
+        return float('inf')
+
+'''
+Description: Folds a new round-trip sample into the exponentially weighted latency estimate of a worker.
+A failed probe marks the worker as unreachable; the first successful sample afterwards replaces the estimate instead of being averaged with infinity.
+Inputs:
+    worker (dict) - The worker node the sample belongs to.
+    sample (float) - The measured round-trip time in seconds, `float('inf')` for a failed probe.
+'''
+def record_latency(worker: dict, sample: float):
+    key = node_key(worker)
+    with latency_lock:
+        if worker.get('removed'):
+            return
+        previous = worker_latency.get(key)
+        if previous is None or previous == float('inf') or sample == float('inf'):
+            worker_latency[key] = sample
+        else:
+            worker_latency[key] = latency_ewma_alpha * sample + (1 - latency_ewma_alpha) * previous
+
+'''
+Description: Probes every worker once per `LATENCY_PROBE_INTERVAL` seconds and keeps `fastest_worker` pointing at the worker
+with the lowest latency estimate. A successful probe also lets the circuit breaker of a failed worker re-admit it. Runs in a daemon thread.
+'''
+def latency_probe_loop():
+    global fastest_worker
+    while True:
+        for worker in all_workers():
+            sample = measure_ping_time(worker)
+            record_latency(worker, sample)
+            breaker = breakers.get(node_key(worker))
+            if breaker and sample != float('inf'):
+                breaker.probe_passed()
+
+        with latency_lock:
+            candidates = [w for w in workers if worker_latency.get(node_key(w), float('inf')) != float('inf')
+                          and (node_key(w) not in breakers or breakers[node_key(w)].allows_traffic())]
+            fastest_worker = min(candidates, key=lambda w: worker_latency[node_key(w)]) if candidates else None
+        time.sleep(latency_probe_interval)
+
+replica_status = {}  # node key -> {'lag': seconds or None, 'position': (file, position) or None, 'updated': monotonic time}
+replica_status_lock = threading.Lock()
+replica_status_statement = 'SHOW REPLICA STATUS'
+
+'''
+Description: Parses a session token returned by a WRITE into the binlog position of a shard's manager. A token holds one position per
+shard the WRITE ran on, separated by commas: "binlog file:position" for the default shard, "shard@binlog file:position" for the others.
+Inputs:
+    token (str) - The token.
+    shard (str, optional) - The shard whose manager's position is returned; the default shard by default.
+Outputs: tuple or None - (file, position), or None if the token is missing, malformed or has no position for the shard.
+'''
+def parse_position(token, shard: str = 'default'):
+    if not token or not isinstance(token, str):
+        return None
+    for entry in token.split(','):
+        name, _, entry = entry.strip().rpartition('@')
+        if (name or 'default') != shard or ':' not in entry:
+            continue
+        log_file, _, position = entry.rpartition(':')
+        return (log_file, int(position)) if position.isdigit() else None
+    return None
+
+'''
+Description: Returns the current binlog position of the manager of shards. Called after a WRITE committed, so the positions cover that WRITE.
+Inputs: shards (list, optional) - The shards the WRITE ran on; the default shard by default.
+Outputs: str or None - The positions as a session token (see `parse_position`), or None if one could not be read.
+'''
+def manager_position(shards: list = None):
+    tokens = []
+    for name in shards or ['default']:
+        try:
+            rows = run_query(shard_nodes(name)[0], 'SHOW MASTER STATUS')
+        except Exception as e:
+            app.logger.error(f"Error reading the binlog position of the manager of shard {name}: {e}")
+            return None
+        if not rows:
+            return None
+        tokens.append(f"{rows[0][0]}:{rows[0][1]}" if name == 'default' else f"{name}@{rows[0][0]}:{rows[0][1]}")
+    return ','.join(tokens)
+
+'''
+Description: Reads the replication status of a worker: how many seconds it is behind the manager and up to which manager binlog position it has applied.
+Requires the REPLICATION CLIENT privilege. Uses `SHOW REPLICA STATUS`, falling back to `SHOW SLAVE STATUS` on MySQL versions before 8.0.22.
+Inputs: worker (dict) - The worker node.
+Outputs: dict - 'lag' (float or None when replication is stopped or broken) and 'position' ((file, position) or None).
+'''
+def fetch_replica_status(worker: dict):
+    global replica_status_statement
+    with get_pool(worker).connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            try:
+                cursor.execute(replica_status_statement)
+            except mysql.connector.ProgrammingError:
+                if replica_status_statement == 'SHOW SLAVE STATUS':
+                    raise
+                replica_status_statement = 'SHOW SLAVE STATUS'
+                cursor.execute(replica_status_statement)
+            row = cursor.fetchone()
+            if cursor.with_rows:
+                cursor.fetchall()
+        finally:
+            cursor.close()
+
+    if not row:
+        return {'lag': None, 'position': None}
+
+    def field(name):
+        return row.get(name, row.get(name.replace('Source', 'Master').replace('Replica', 'Slave')))
+
+    lag = field('Seconds_Behind_Source')
+    running = field('Replica_SQL_Running') == 'Yes'
+    log_file, position = field('Relay_Source_Log_File'), field('Exec_Source_Log_Pos')
+    return {
+        'lag': float(lag) if running and lag is not None else None,
+        'position': (log_file, int(position)) if log_file and position is not None else None,
+    }
+
+'''
+Description: Samples the replication status of every worker, of every shard, once per `REPLICA_STATUS_INTERVAL` seconds. Runs in a daemon thread.
+A worker whose status cannot be read keeps no entry, and is then neither excluded for lag nor trusted with session reads.
+'''
+def replica_status_loop():
+    while True:
+        for worker in all_workers():
+            key = node_key(worker)
+            try:
+                status = fetch_replica_status(worker)
+                status['updated'] = time.monotonic()
+                with replica_status_lock:
+                    if not worker.get('removed'):
+                        replica_status[key] = status
+            except Exception as e:
+                app.logger.error(f"Error reading replication status of {worker['host']}: {e}")
+                with replica_status_lock:
+                    replica_status.pop(key, None)
+        time.sleep(replica_status_interval)
+
+'''
+Description: Returns the workers healthy and fresh enough to serve a READ. A worker is dropped if it is draining, if its circuit breaker is open,
+if its last sample shows replication stopped or a lag above
+`REPLICA_LAG_BUDGET`; with a minimum position, a worker is only kept if its last sample shows it has applied the manager's binlog up to that position.
+Inputs:
+    min_position (tuple, optional) - The manager binlog position (file, position) the worker must have applied.
+    group (list, optional) - The workers to choose from: `workers` by default, or the replicas of a shard (see `shard_nodes`).
+Outputs: list - The eligible worker nodes.
+'''
+def fresh_workers(min_position: tuple = None, group: list = None):
+    eligible = []
+    with replica_status_lock:
+        for worker in workers if group is None else group:
+            if worker.get('draining'):
+                continue
+            breaker = breakers.get(node_key(worker))
+            if breaker and not breaker.allows_traffic():
+                continue
+            status = replica_status.get(node_key(worker))
+            if status is not None and (status['lag'] is None or status['lag'] > replica_lag_budget):
+                continue
+            if min_position is not None and (status is None or status['position'] is None or status['position'] < min_position):
+                continue
+            eligible.append(worker)
+    return eligible
+
+membership_lock = threading.Lock()
+membership_mtime = None  # modification time of WORKERS_FILE when this process last applied it
+
+'''
+Description: Describes the worker membership of this process, in the format of `WORKERS_FILE`.
+Outputs: list - One dict per worker: 'host', 'port', 'weight' and whether it is 'draining'.
+'''
+def membership():
+    return [{'host': w['host'], 'port': w['port'], 'weight': w.get('weight', 1.0), 'draining': w.get('draining', False)} for w in workers]
+
+'''
+Description: Makes the workers of this process match a membership: new workers are added with a closed circuit breaker, known workers take
+the weight and draining flag of their entry, and workers missing from it start draining. Workers are only removed by `retire_worker`.
+`workers` is replaced rather than modified, so the threads iterating over it are not disturbed.
+Inputs: entries (list) - The membership, see `membership`.
+Outputs: list - The workers missing from the membership that are not being retired yet; they must be passed to `retire_worker`.
+'''
+def apply_membership(entries: list):
+    global workers
+    with membership_lock:
+        current = {node_key(worker): worker for worker in workers}
+        added = []
+        for entry in entries:
+            key = node_key(entry)
+            worker = current.pop(key, None)
+            if worker is None:
+                breakers.setdefault(key, CircuitBreaker(breaker_failure_threshold, breaker_open_seconds))
+                added.append({'host': entry['host'], 'port': entry['port'], 'weight': entry.get('weight', 1.0), 'draining': entry.get('draining', False)})
+            else:
+                worker['weight'] = entry.get('weight', 1.0)
+                worker['draining'] = entry.get('draining', False)
+                worker.pop('retiring', None)
+        if added:
+            workers = workers + added
+        retired = []
+        for worker in current.values():
+            worker['draining'] = True
+            if not worker.get('retiring'):
+                worker['retiring'] = True
+                retired.append(worker)
+    return retired
+
+'''
+Description: Reports how busy a worker still is: the queries it has in flight and the pooled connections to it that are checked out
+(a batch or a stream holds its connection between queries).
+Inputs: worker (dict) - The worker node.
+Outputs: dict - 'inflight' and 'connections_in_use'.
+'''
+def worker_activity(worker: dict):
+    key = node_key(worker)
+    with worker_load_lock:
+        load = worker_load.get(key)
+        inflight = load['inflight'] if load else 0
+    pool = pools.get(key)
+    return {'inflight': inflight, 'connections_in_use': pool.stats()['in_use'] if pool else 0}
+
+'''
+Description: Removes a draining worker from this process: waits up to `timeout` seconds for its queries in flight to finish and its connections
+to come back, then drops it from the routing, the breakers, the probes and the metrics, and closes its pool. Connections still checked out
+after the timeout are closed when they are released. The removal is abandoned if the worker was added back in the meantime.
+Inputs:
+    worker (dict) - The worker node, as returned by `apply_membership`.
+    timeout (float, optional) - Seconds to wait for the worker to drain. Defaults to `DRAIN_TIMEOUT`.
+Outputs: bool - True if the worker drained before the timeout.
+'''
+def retire_worker(worker: dict, timeout: float = None):
+    global workers
+    key = node_key(worker)
+    deadline = time.monotonic() + (drain_timeout if timeout is None else timeout)
+    while True:
+        activity = worker_activity(worker)
+        drained = activity['inflight'] == 0 and activity['connections_in_use'] == 0
+        if drained or time.monotonic() >= deadline:
+            break
+        time.sleep(0.05)
+
+    with membership_lock:
+        if not worker.get('retiring'):
+            return drained
+        workers = [w for w in workers if w is not worker]
+        worker['removed'] = True
+        breakers.pop(key, None)
+    with pools_lock:
+        pool = pools.pop(key, None)
+    if pool:
+        pool.close()
+    with latency_lock:
+        worker_latency.pop(key, None)
+    with replica_status_lock:
+        replica_status.pop(key, None)
+    with worker_load_lock:
+        if key in worker_load and worker_load[key]['inflight'] == 0:
+            del worker_load[key]
+    for metric in (backend_inflight, pool_connections, pool_exhausted, pool_timeouts, breaker_state, replica_lag):
+        metric.remove('backend', key)
+    app.logger.info(f"Worker {key} removed ({'drained' if drained else 'drain timed out'})")
+    return drained
+
+'''
+Description: Retires workers in background threads, for the removals this process learns about from `WORKERS_FILE`.
+Inputs: retired (list) - The workers returned by `apply_membership`.
+'''
+def retire_in_background(retired: list):
+    for worker in retired:
+        threading.Thread(target=retire_worker, args=(worker,), daemon=True).start()
+
+'''
+Description: Reads the membership saved in `WORKERS_FILE`.
+Outputs: tuple - (entries, modification time), or (None, None) if the file does not exist yet.
+'''
+def read_membership_file():
+    try:
+        mtime = os.stat(workers_file).st_mtime_ns
+        with open(workers_file) as file:
+            return json.load(file), mtime
+    except FileNotFoundError:
+        return None, None
+
+'''
+Description: Changes the worker membership and applies it to this process. With `WORKERS_FILE`, the change is made to the saved membership
+under an exclusive file lock, so that concurrent changes from other serving processes are not lost, and the other processes pick it up
+within `MEMBERSHIP_SYNC_INTERVAL` seconds.
+Inputs: change (function) - Called with the current membership (see `membership`), returns the new one.
+Outputs: list - The workers to pass to `retire_worker`.
+'''
+def update_membership(change):
+    global membership_mtime
+    if not workers_file:
+        return apply_membership(change(membership()))
+
+    import fcntl
+    with open(f"{workers_file}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        entries, _ = read_membership_file()
+        entries = change(membership() if entries is None else entries)
+        temporary = f"{workers_file}.tmp"
+        with open(temporary, 'w') as file:
+            json.dump(entries, file)
+        os.replace(temporary, workers_file)
+        membership_mtime = os.stat(workers_file).st_mtime_ns
+        return apply_membership(entries)
+
+'''
+Description: Applies the changes other serving processes made to `WORKERS_FILE`, checking it every `MEMBERSHIP_SYNC_INTERVAL` seconds.
+Runs in a daemon thread when `WORKERS_FILE` is set.
+'''
+def membership_sync_loop():
+    global membership_mtime
+    while True:
+        try:
+            entries, mtime = read_membership_file()
+            if entries is not None and mtime != membership_mtime:
+                membership_mtime = mtime
+                retire_in_background(apply_membership(entries))
+        except Exception as e:
+            app.logger.error(f"Error reading worker membership from {workers_file}: {e}")
+        time.sleep(membership_sync_interval)
+
+'''
+Description: Executes a READ on a worker over a pooled connection and returns a generator that streams the result as NDJSON,
+one JSON array per row, fetching `STREAM_CHUNK_SIZE` rows per round trip. The connection stays checked out until the generator
+is exhausted or closed, so memory use is bounded by the chunk size rather than by the size of the result.
+If the query fails after streaming started, a final line with an error object is emitted.
+A parameterized query runs as a prepared statement; as its cursor stays cached on the connection, a stream closed before its last row
+discards the connection rather than leaving unread rows on it. The statement is watched until the stream ends: if the request's deadline passes
+first, it is killed and the stream ends with a 'Deadline exceeded' error line.
+Inputs:
+    node (dict) - The worker node to run the query on.
+    query (str) - The SQL query to be executed, or a statement template if `params` is given.
+    params (list, optional) - The parameters of a parameterized query.
+Outputs: generator - Yields NDJSON text chunks.
+Raises: PoolError if no connection could be obtained, mysql.connector.Error if the query cannot be started, DeadlineExceeded if the request ran out of time first.
+'''
+def stream_query(node: dict, query: str, params: list = None):
+    pool = get_pool(node)
+    token = begin_request(node)
+    try:
+        with span('conn'):
+            conn = pool.acquire()
+    except Exception:
+        end_request(node, token, error=True)
+        raise
+    deadline = current_deadline()
+    watch = deadline_watchdog.watch(deadline, node, conn.connection_id) if deadline is not None else None
+    try:
+        with span('db'):
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlineExceeded(f"Deadline exceeded before the query started on {node_key(node)}")
+            if params is None:
+                cursor = conn.cursor()
+                cursor.execute(query)
+            else:
+                cursor = execute_prepared(conn, query, params)
+    except Exception as e:
+        killed = watch is not None and deadline_watchdog.unwatch(watch)
+        timed_out = killed or isinstance(e, DeadlineExceeded)
+        pool.release(conn, discard=timed_out or not ConnectionPool.is_alive(conn), record=not timed_out)
+        end_request(node, token, error=True)
+        if killed:
+            raise DeadlineExceeded(f"Query killed on {node_key(node)} at its deadline") from e
+        raise
+
+    def generate():
+        discard = False
+        finished = False
+        killed = False
+        try:
+            while cursor.with_rows:
+                rows = cursor.fetchmany(stream_chunk_size)
+                if not rows:
+                    break
+                yield ''.join(app.json.dumps(list(row)) + '\n' for row in rows)
+            finished = True
+        except Exception as e:
+            killed = watch is not None and deadline_watchdog.unwatch(watch)
+            app.logger.error(f"Error streaming query result from {node['host']}: {e}")
+            discard = True
+            yield app.json.dumps({'error': 'Deadline exceeded' if killed else 'Error streaming query result'}) + '\n'
+        finally:
+            if watch is not None and deadline_watchdog.unwatch(watch):
+                killed = discard = True
+            if params is None:
+                try:
+                    cursor.close()
+                except Exception:
+                    discard = True
+            elif not finished:
+                discard = True
+            pool.release(conn, discard=discard, record=not killed)
+            end_request(node, token, error=discard)
+
+    return generate()
+
+'''
+Description: Normalizes a query into a cache key by collapsing whitespace outside of string literals and dropping trailing semicolons.
+Inputs: query (str) - The SQL query.
+Outputs: str - The normalized query text.
+'''
+def normalize_query(query: str):
+    tokens = re.findall(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`|\s+|[^'\"`\s]+|['\"`]", query)
+    return ''.join(' ' if token.isspace() else token for token in tokens).strip().rstrip(';').rstrip()
+
+TABLE_PATTERN = re.compile(r"\b(?:from|join|into|update|table)\s+((?:`?\w+`?\.)?`?\w+`?(?:\s*,\s*(?:`?\w+`?\.)?`?\w+`?)*)", re.IGNORECASE)
+UNCACHEABLE_PATTERN = re.compile(r"\b(?:rand|now|sysdate|uuid|uuid_short|curdate|curtime|current_timestamp|unix_timestamp|connection_id|last_insert_id|found_rows)\s*\(|\bfor\s+update\b|\block\s+in\s+share\s+mode\b|@", re.IGNORECASE)
+
+'''
+Description: Extracts the names of the tables a query reads from or writes to.
+Inputs: query (str) - The SQL query.
+Outputs: set - The lower-cased table names, without database qualifiers. Empty if no table could be recognized.
+'''
+def query_tables(query: str):
+    tables = set()
+    for match in TABLE_PATTERN.finditer(query):
+        for name in match.group(1).split(','):
+            tables.add(name.strip().split('.')[-1].strip('`').lower())
+    return tables
+
+'''
+Description: Tells whether the result of a query may be cached: it must be a plain SELECT over known tables without non-deterministic functions or locking clauses.
+Inputs: query (str) - The normalized SQL query.
+Outputs: bool - True if the result may be cached.
+'''
+def is_cacheable(query: str):
+    return query[:6].lower() == 'select' and not UNCACHEABLE_PATTERN.search(query) and bool(query_tables(query))
+
+'''
+Description: Returns the result cache key of a READ: its normalized text, along with its parameters for a parameterized query.
+Inputs:
+    query (str) - The SQL query, or a statement template if `params` is given.
+    params (list, optional) - The parameters of a parameterized query.
+Outputs: str, tuple or None - The key, or None if the result of the query may not be cached (see `is_cacheable`).
+'''
+def result_cache_key(query: str, params: list = None):
+    normalized = normalize_query(query)
+    if not is_cacheable(normalized):
+        return None
+    return normalized if params is None else (normalized, tuple(params))
+
+'''
+Description: A thread-safe LRU cache of READ results with a TTL. Every entry records the tables it depends on so that a WRITE
+only invalidates the entries of the tables it touched. A per-table version counter keeps a read that started before a WRITE
+from storing its (possibly stale) result after the invalidation.
+Inputs:
+    max_entries (int) - The maximum number of cached results; the least recently used entry is evicted beyond it.
+    ttl (float) - Seconds a result stays valid. It also bounds how stale a result read from a lagging replica can be.
+'''
+class ResultCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (result, tables, expires_at)
+        self._by_table = {}  # table -> set of keys
+        self._versions = {}  # table -> number of invalidations so far
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def versions(self, tables: set):
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in sorted(tables))
+
+    def put(self, key: str, result, tables: set, versions: tuple):
+        with self._lock:
+            # A WRITE to one of the tables completed while the read was running
+            if versions != tuple(self._versions.get(table, 0) for table in sorted(tables)):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, tables, time.monotonic() + self.ttl)
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    '''
+    Description: Drops every entry depending on one of the given tables. An empty set means the touched tables are unknown, and clears the whole cache.
+    '''
+    def invalidate(self, tables: set):
+        with self._lock:
+            if not tables:
+                tables = set(self._by_table) | set(self._versions)
+                self._entries.clear()
+                self._by_table.clear()
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                for key in self._by_table.pop(table, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    # Must be called with self._lock held
+    def _remove(self, key: str):
+        _, tables, _ = self._entries.pop(key)
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+result_cache = ResultCache(result_cache_max_entries, result_cache_ttl)
+
+'''
+Description: Serves a READ from the result cache, or routes it with the given routing function and caches the result.
+Inputs:
+    query (str) - The SQL query to be executed, or a statement template if `params` is given.
+    route (function) - The routing function (e.g. `random_worker`) used on a cache miss.
+    params (list, optional) - The parameters of a parameterized query, which are part of the cache key.
+Outputs: result (list or dict) - The cached or freshly read result, or a dictionary with an error message. Errors are never cached.
+'''
+def cached_read(query: str, route, params: list = None):
+    key = result_cache_key(query, params)
+    if key is None:
+        return route(query, params=params)
+
+    result = result_cache.get(key)
+    if result is not None:
+        record_backend('cache')
+        return result
+
+    tables = query_tables(query)
+    versions = result_cache.versions(tables)
+    result = route(query, params=params)
+    if 'error' not in result:
+        result_cache.put(key, result, tables, versions)
+    return result
+
+INSERT_PATTERN = re.compile(r"^\s*insert\s+into\s+((?:`?\w+`?\.)?`?\w+`?)\s*(\([^()]*\))?\s*values\s*", re.IGNORECASE)
+DEADLOCK_ERRNO = 1213
+
+'''
+Description: Returns the index of the parenthesis closing the one at the start of a SQL fragment, skipping over string literals.
+Inputs: text (str) - A SQL fragment starting with '('.
+Outputs: int - The index of the matching ')', or -1 if it is not closed.
+'''
+def closing_paren(text: str):
+    depth = 0
+    quote = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == '\\':
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in ("'", '"', '`'):
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return -1
+
+'''
+Description: Splits a single-row `INSERT INTO table (columns) VALUES (...)` statement into the parts needed to merge it with others.
+Inputs: query (str) - The SQL query.
+Outputs: tuple or None - (merge key, statement head up to VALUES, the row tuple), or None if the query is not a plain single-row INSERT
+         (e.g. multi-row, INSERT ... SELECT or ON DUPLICATE KEY UPDATE).
+'''
+def split_single_row_insert(query: str):
+    match = INSERT_PATTERN.match(query)
+    if not match:
+        return None
+    row = query[match.end():].rstrip().rstrip(';').rstrip()
+    if not row.startswith('(') or closing_paren(row) != len(row) - 1:
+        return None
+    table, columns = match.group(1), match.group(2) or ''
+    key = (table.replace('`', '').lower(), re.sub(r'[\s`]', '', columns).lower())
+    return key, f"INSERT INTO {table} {columns} VALUES ".replace('  ', ' '), row
+
+'''
+Description: Merges consecutive single-row INSERTs into the same table and columns into multi-row INSERTs. Other statements are kept as they are, in order.
+Parameterized queries are never merged: they run as prepared statements, whose templates would vary with the number of merged rows.
+Inputs:
+    queries (list) - The WRITE queries of a batch, in order.
+    params (list, optional) - The parameters of each query, None for a query that is not parameterized.
+Outputs: list - (statement, indices) pairs, where indices are the positions in `queries` the statement covers.
+'''
+def coalesce_writes(queries: list, params: list = None):
+    groups = []
+    current_key = None
+    for index, query in enumerate(queries):
+        parts = split_single_row_insert(query) if params is None or params[index] is None else None
+        if parts and parts[0] == current_key:
+            groups[-1][1].append(parts[2])
+            groups[-1][2].append(index)
+            continue
+        current_key = parts[0] if parts else None
+        if parts:
+            groups.append([parts[1], [parts[2]], [index]])
+        else:
+            groups.append([query, None, [index]])
+    return [(head + ', '.join(rows) if rows else head, indices) for head, rows, indices in groups]
+
+'''
+Description: Executes the WRITEs of a batch on the manager inside a single transaction, with consecutive single-row INSERTs merged.
+A failing statement only rolls itself back in MySQL, so the rest of the transaction is kept; when a merged INSERT fails, its rows are
+retried one by one to find out which of them are at fault. A deadlock rolls back the whole transaction and fails every WRITE of the batch.
+Inputs:
+    queries (list) - The WRITE queries of the batch, in order.
+    params (list, optional) - The parameters of each query, None for a query that is not parameterized.
+Outputs: list - One result per query, in order: an empty list on success or a dictionary with an error message.
+'''
+def run_write_batch(queries: list, params: list = None):
+    params = params or [None] * len(queries)
+    results = [None] * len(queries)
+    try:
+        with tracked(manager), get_pool(manager).connection() as conn, deadline_guard(conn, manager):
+            cursor = conn.cursor()
+            try:
+                conn.start_transaction()
+                for statement, indices in coalesce_writes(queries, params):
+                    if len(indices) > 1:
+                        try:
+                            execute_statement(conn, cursor, statement)
+                            for index in indices:
+                                results[index] = []
+                            continue
+                        except mysql.connector.Error as e:
+                            if e.errno == DEADLOCK_ERRNO:
+                                raise
+                    for index in indices:
+                        try:
+                            results[index] = execute_statement(conn, cursor, queries[index], params[index])
+                        except mysql.connector.Error as e:
+                            if e.errno == DEADLOCK_ERRNO:
+                                raise
+                            app.logger.error(f"Error executing batched query on manager: {e}")
+                            results[index] = {'error': 'Error executing query on manager'}
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+    except DeadlineExceeded as e:
+        app.logger.warning(f"Batch rolled back: {e}")
+        return [{'error': 'Deadline exceeded'}] * len(queries)
+    except PoolError as e:
+        app.logger.error(f"Error connecting to manager: {e}")
+        return [{'error': 'Failed to connect to the MySQL manager'}] * len(queries)
+    except Exception as e:
+        app.logger.error(f"Error executing batch on manager: {e}")
+        return [{'error': 'Error executing query on manager'}] * len(queries)
+
+    if result_cache_enabled:
+        tables = [query_tables(query) for query in queries]
+        result_cache.invalidate(set().union(*tables) if all(tables) else set())
+    return results
+
+'''
+Description: Executes one statement on a cursor and drains its result set, if any. A parameterized statement runs instead as a prepared
+statement from the connection's statement cache (see `execute_prepared`), and its latency is recorded in the template metrics.
+Inputs:
+    conn (mysql.connector.connection) - The connection the cursor belongs to.
+    cursor (mysql.connector.cursor) - The cursor to execute the statement on.
+    statement (str) - The SQL statement, or a statement template if `params` is given.
+    params (list, optional) - The parameters of a parameterized statement.
+Outputs: list - The rows the statement produced, empty for statements that return no rows.
+'''
+def execute_statement(conn, cursor, statement: str, params: list = None):
+    if params is None:
+        cursor.execute(statement)
+        return cursor.fetchall() if cursor.with_rows else []
+    start = time.perf_counter()
+    cursor = execute_prepared(conn, statement, params)
+    rows = cursor.fetchall() if cursor.with_rows else []
+    template_latency.observe(time.perf_counter() - start, template_label(statement), getattr(query_labels, 'value', ('MONITOR',))[0])
+    return rows
+
+'''
+Description: Commits WRITEs in groups. A single writer thread collects the WRITEs that arrive within `window` seconds of the first one,
+up to `max_batch` of them, and runs them with `run_write_batch` in one manager transaction, so the whole group costs one commit.
+Each caller is released only after that commit, or when its request's deadline passes. A group runs under the earliest deadline of its WRITEs,
+so a commit that outlives it is killed; WRITEs whose deadline passed while they were queued are dropped from their group.
+The writer thread is started on first use, in the process that serves requests.
+Inputs:
+    window (float) - Seconds to wait for more WRITEs after the first one of a group arrived.
+    max_batch (int) - The maximum number of WRITEs committed together.
+'''
+class GroupCommitter:
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max(max_batch, 1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.batches = 0
+        self.writes = 0
+        self.histogram = {}  # batch size bucket (power of two upper bound) -> number of batches
+
+    '''
+    Description: Queues a WRITE and waits for the commit of its group.
+    Outputs: list or dict - The result of the WRITE: an empty list on success or a dictionary with an error message.
+    Raises: DeadlineExceeded if the deadline of the current thread passed first; the WRITE may still be committed.
+    '''
+    def submit(self, query: str, params: list = None):
+        self._ensure_started()
+        deadline = current_deadline()
+        item = {'query': query, 'params': params, 'deadline': deadline, 'done': threading.Event(), 'result': None}
+        self._queue.put(item)
+        if not item['done'].wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+            deadline_exceeded.inc('commit')
+            raise DeadlineExceeded('Deadline exceeded waiting for the group commit')
+        return item['result']
+
+    def run(self):
+        set_query_labels('WRITE', 'group_commit')
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            now = time.monotonic()
+            for item in [item for item in batch if item['deadline'] is not None and item['deadline'] <= now]:
+                batch.remove(item)
+                item['result'] = {'error': 'Deadline exceeded'}
+                item['done'].set()
+            if not batch:
+                continue
+
+            deadlines = [item['deadline'] for item in batch if item['deadline'] is not None]
+            set_deadline(min(deadlines) if deadlines else None)
+            try:
+                results = run_write_batch([item['query'] for item in batch], [item['params'] for item in batch])
+            except Exception as e:
+                app.logger.error(f"Error committing write group: {e}")
+                results = [{'error': 'Error executing query on manager'}] * len(batch)
+            self._record(len(batch))
+            for item, result in zip(batch, results):
+                item['result'] = result
+                item['done'].set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'window_ms': self.window * 1000,
+                'max_batch': self.max_batch,
+                'batches': self.batches,
+                'writes': self.writes,
+                'pending': self._queue.qsize(),
+                'batch_size_histogram': {f'le_{bucket}': count for bucket, count in sorted(self.histogram.items())},
+            }
+
+    def _record(self, size: int):
+        bucket = 1
+        while bucket < size:
+            bucket *= 2
+        with self._lock:
+            self.batches += 1
+            self.writes += size
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.run, daemon=True)
+                    self._thread.start()
+
+group_committer = GroupCommitter(group_commit_window, group_commit_max_batch)
+
+'''
+Description: Executes the READs of a batch that were routed to the same worker, one after another over a single pooled connection.
+If the worker fails, the READs that did not complete are retried once on another node chosen with `retry_mode`.
+Inputs:
+    node (dict) - The worker node the READs were routed to.
+    items (list) - (index, query, params) triples, where params is None for a query that is not parameterized.
+    retry_mode (str, optional) - The routing mode used to pick the node to retry on. No retry if not given.
+    min_position (tuple, optional) - The manager binlog position (file, position) the retry node must have applied.
+Outputs: dict - The result of each READ by index: a list of tuples, or a dictionary with an error message.
+'''
+def run_read_group(node: dict, items: list, retry_mode: str = None, min_position: tuple = None, deadline: float = None):
+    if retry_mode is not None:
+        set_query_labels('READ', retry_mode)
+        set_deadline(deadline)
+    results = {}
+    try:
+        with get_pool(node).connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for index, query, params in items:
+                    try:
+                        with tracked(node), deadline_guard(conn, node):
+                            results[index] = execute_statement(conn, cursor, query, params)
+                    except mysql.connector.Error as e:
+                        app.logger.error(f"Error executing batched query on worker: {e}")
+                        results[index] = {'error': 'Error executing query on worker'}
+            finally:
+                cursor.close()
+    except DeadlineExceeded as e:
+        app.logger.warning(f"Batch on {node_key(node)} stopped: {e}")
+        for index, _, _ in items:
+            results.setdefault(index, {'error': 'Deadline exceeded'})
+    except Exception as e:
+        if not is_backend_failure(e) or retry_mode is None or node is manager:
+            app.logger.error(f"Error executing batch on worker: {e}")
+        else:
+            app.logger.warning(f"Worker {node['host']} failed ({e}), retrying its batched queries on another node")
+            retry = pick_worker(retry_mode, min_position, exclude=node) or manager
+            pending = [item for item in items if item[0] not in results]
+            results.update(run_read_group(retry, pending))
+    for index, _, _ in items:
+        results.setdefault(index, {'error': 'Failed to connect to a worker node'})
+    return results
+
+batch_executor = ThreadPoolExecutor(max_workers=batch_max_parallel)
+
+'''
+Description: Raised for a query on sharded tables that cannot be routed, e.g. an INSERT without the shard key, or a READ over every
+shard whose results cannot be merged. Answered with a 400.
+'''
+class ShardingError(Exception):
+    pass
+
+'''
+Description: Loads the shard map, a JSON file of the form
+    {"shards": {"default": {}, "shard_2": {"manager": "10.0.0.12", "workers": ["10.0.0.13", "10.0.0.14"]}},
+     "tables": {"rental": {"column": "customer_id", "strategy": "hash"},
+                "payment": {"column": "payment_id", "strategy": "range", "ranges": [[null, "default"], [8000, "shard_2"]]}}}
+Each shard is a replication group: a manager and its replicas. The shard named "default" is the group of MANAGER_IP and WORKERS_IPS,
+whose workers can change at runtime (see `apply_membership`). Each sharded table names its shard key column and how a key value is placed:
+"hash" spreads the values over its "shards" (every shard by default) by the CRC32 of their text, like MySQL's `CRC32()`; "range" gives each
+shard the values from its lower bound (null: unbounded) up to the next bound. Tables not in the map have a copy on every shard, kept alike
+by `broadcast_write`, and are read from the default shard.
+Inputs: path (str) - The shard map file.
+Outputs: tuple - (shard groups by name, None for the default shard; rules of the sharded tables by lower-cased table name).
+Raises: ValueError if the map is invalid.
+'''
+def load_shard_map(path: str):
+    with open(path) as file:
+        config = json.load(file)
+    groups = {}
+    for name, entry in config.get('shards', {}).items():
+        if name == 'default':
+            groups[name] = None
+            continue
+        shard_manager = {'host': entry['manager'], 'port': entry.get('port', 3306), 'role': 'manager'}
+        shard_workers = [{'host': host, 'port': entry.get('port', 3306), 'weight': 1.0} for host in entry.get('workers', [])]
+        groups[name] = {'manager': shard_manager, 'workers': shard_workers}
+
+    rules = {}
+    for table, rule in config.get('tables', {}).items():
+        strategy = rule.get('strategy', 'hash')
+        column = rule['column'].strip('`').lower()
+        if strategy == 'hash':
+            owners, bounds = list(rule.get('shards', groups)), []
+        elif strategy == 'range':
+            ranges = sorted(rule['ranges'], key=lambda entry: (entry[0] is not None, entry[0]))
+            owners = [None] + [shard for _, shard in ranges] if ranges[0][0] is not None else [shard for _, shard in ranges]
+            bounds = [bound for bound, _ in ranges if bound is not None]
+        else:
+            raise ValueError(f"Unknown sharding strategy {strategy} for table {table}")
+        unknown = [shard for shard in owners if shard is not None and shard not in groups]
+        if unknown or not owners:
+            raise ValueError(f"Table {table} is placed on unknown shards {unknown}")
+        rules[table.lower()] = {
+            'column': column,
+            'strategy': strategy,
+            'owners': owners,
+            'bounds': bounds,
+            'shards': list(dict.fromkeys(shard for shard in owners if shard is not None)),
+            'pattern': re.compile(r"(?<![\w.`])(?:`?\w+`?\.)?`?" + re.escape(column) + r"`?\s*=\s*('(?:[^'\\]|\\.|'')*'|-?\d+(?:\.\d+)?|%s|\?)", re.IGNORECASE),
+        }
+    return groups, rules
+
+shard_groups, shard_rules = load_shard_map(shard_map_file) if shard_map_file else ({}, {})
+for group in shard_groups.values():
+    for worker in group['workers'] if group else []:
+        breakers.setdefault(node_key(worker), CircuitBreaker(breaker_failure_threshold, breaker_open_seconds))
+if shard_groups:
+    print(f"Shards: {list(shard_groups)}, sharded tables: {list(shard_rules)}")
+
+# Runs the parts of a query fanned out to every shard, up to one per shard for every request thread
+shard_executor = ThreadPoolExecutor(max_workers=max(len(shard_groups), 1) * service_common.server_threads)
+# Runs both READs of a hedged pair, so that the thread hedging it can wait for the first to finish. READs are hedged by the request threads
+# (`SERVER_THREADS`) and by the `shard_executor` threads, each hedging one READ at a time: the pool has two threads for each of them, so that
+# it never holds a READ back
+hedge_executor = ThreadPoolExecutor(max_workers=2 * (max(len(shard_groups), 1) + 1) * service_common.server_threads)
+
+shard_queries = Metric('proxy_shard_queries_total', 'counter',
+                       'Queries routed by the shard map, by query type and scope: on one shard, fanned out over several, or a WRITE to an unsharded table broadcast to every shard.',
+                       ('query_type', 'scope'))
+
+'''
+Description: Lists the shards other than the default one.
+Outputs: list - The shard names.
+'''
+def other_shards():
+    return [name for name in shard_groups if name != 'default']
+
+'''
+Description: Returns the manager and the workers of a shard.
+Inputs: name (str) - The shard name.
+Outputs: tuple - (manager node, list of worker nodes).
+'''
+def shard_nodes(name: str):
+    group = shard_groups.get(name)
+    if group is None:
+        return manager, workers
+    return group['manager'], group['workers']
+
+'''
+Description: Lists the workers of every replication group: `workers`, then the replicas of the other shards.
+Outputs: list - The worker nodes.
+'''
+def all_workers():
+    return list(workers) + [worker for group in shard_groups.values() if group for worker in group['workers']]
+
+'''
+Description: Returns the shard a shard key value is placed on (see `load_shard_map`).
+Inputs:
+    rule (dict) - The rule of the sharded table.
+    value - The shard key value.
+Outputs: str - The shard name.
+Raises: ShardingError if the value is below every range.
+'''
+def shard_for(rule: dict, value):
+    if rule['strategy'] == 'hash':
+        return rule['owners'][zlib.crc32(str(value).encode()) % len(rule['owners'])]
+    try:
+        owner = rule['owners'][bisect_right(rule['bounds'], value)]
+    except TypeError:
+        raise ShardingError(f"Shard key value {value!r} of column {rule['column']} is not comparable to its ranges")
+    if owner is None:
+        raise ShardingError(f"Shard key value {value!r} of column {rule['column']} is on no shard")
+    return owner
+
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+PLACEHOLDER_PATTERN = re.compile(r"%s|\?")
+
+'''
+Description: Returns the value of a shard key in a query: a literal, or the parameter bound to a placeholder.
+Inputs:
+    token (str) - The literal or placeholder.
+    params (list) - The parameters of the query, or None.
+    index (int) - The index of the parameter, for a placeholder.
+Outputs: The value: a string, an integer or a float.
+Raises: ShardingError if the token is not a literal or its parameter is missing.
+'''
+def shard_key_value(token: str, params: list, index: int):
+    token = token.strip()
+    if token in ('%s', '?'):
+        if not params or index >= len(params):
+            raise ShardingError("Missing parameter for the shard key")
+        return params[index]
+    if token[:1] in ("'", '"'):
+        return token[1:-1].replace(token[0] * 2, token[0]).replace('\\' + token[0], token[0])
+    if re.fullmatch(r'-?\d+', token):
+        return int(token)
+    if re.fullmatch(r'-?\d+\.\d*', token):
+        return float(token)
+    raise ShardingError(f"The shard key must be a literal or a parameter, not {token}")
+
+'''
+Description: Splits a SQL fragment on its top-level commas, outside of parentheses. String literals must be masked.
+Inputs: text (str) - The fragment.
+Outputs: list - (offset in the fragment, item) pairs.
+'''
+def split_top_level(text: str):
+    items = []
+    depth = start = 0
+    for i, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append((start, text[start:i]))
+            start = i + 1
+    items.append((start, text[start:]))
+    return items
+
+'''
+Description: Finds the values of the shard key a query is restricted to. For an INSERT, those are the values of the key column in every row.
+For another statement, those are the `column = value` conditions of its WHERE clause; a WHERE clause with an OR, or without such a condition,
+does not restrict the query to some shards.
+Inputs:
+    query (str) - The SQL query, or a statement template.
+    params (list) - The parameters of the query, or None.
+    rule (dict) - The rule of the sharded table.
+Outputs: list or None - The shard key values, or None if the query may touch every shard.
+Raises: ShardingError if an INSERT gives no shard key, or an UPDATE changes it.
+'''
+def shard_key_values(query: str, params: list, rule: dict):
+    masked = STRING_LITERAL_PATTERN.sub(lambda match: match.group(0)[0] + ' ' * (len(match.group(0)) - 2) + match.group(0)[0], query)
+    column = rule['column']
+    if re.match(r"\s*(?:insert|replace)\b", masked, re.IGNORECASE):
+        insert = INSERT_PATTERN.match(masked)
+        if not insert:
+            raise ShardingError("Only INSERT ... VALUES statements with a column list are supported on sharded tables")
+        columns = [name.strip().strip('`').lower() for name in (insert.group(2) or '').strip('()').split(',')]
+        if column not in columns:
+            raise ShardingError(f"An INSERT into a sharded table must set its shard key {column}")
+        values = []
+        position = insert.end()
+        while position < len(masked) and masked[position] == '(':
+            end = closing_paren(masked[position:])
+            if end < 0:
+                break
+            row = split_top_level(masked[position + 1:position + end])
+            if len(row) != len(columns):
+                raise ShardingError("The rows of the INSERT do not match its column list")
+            offset, item = row[columns.index(column)]
+            start = position + 1 + offset + len(item) - len(item.lstrip())
+            token = query[start:start + len(item.strip())]
+            values.append(shard_key_value(token, params, len(PLACEHOLDER_PATTERN.findall(masked, 0, start))))
+            position = len(masked) - len(masked[position + end + 1:].lstrip().lstrip(',').lstrip())
+        return values
+
+    where = re.search(r"\bwhere\b", masked, re.IGNORECASE)
+    if re.match(r"\s*update\b", masked, re.IGNORECASE):
+        assignments = re.search(r"\bset\b", masked[:where.start() if where else len(masked)], re.IGNORECASE)
+        if assignments and re.search(r"(?<![\w.`])(?:`?\w+`?\.)?`?" + re.escape(column) + r"`?\s*=", masked[assignments.end():where.start() if where else len(masked)], re.IGNORECASE):
+            raise ShardingError(f"Updating the shard key {column} is not supported")
+    if not where or re.search(r"\bor\b", masked[where.end():], re.IGNORECASE):
+        return None
+    matches = list(rule['pattern'].finditer(masked, where.end()))
+    if not matches:
+        return None
+    return [shard_key_value(query[match.start(1):match.end(1)], params, len(PLACEHOLDER_PATTERN.findall(masked, 0, match.start(1)))) for match in matches]
+
+'''
+Description: Finds the shards a query on sharded tables must run on. The sharded tables of a query must be placed alike (same key column and
+placement), so that their rows with the same key are on the same shard; tables that are not sharded are joined with the copy each shard holds.
+Inputs:
+    query (str) - The SQL query, or a statement template.
+    params (list) - The parameters of the query, or None.
+Outputs: list or None - The names of the shards, or None if the query uses no sharded table.
+Raises: ShardingError if the query cannot be routed, e.g. an INSERT with rows on several shards.
+'''
+def shard_targets(query: str, params: list = None):
+    sharded = sorted(table for table in query_tables(query) if table in shard_rules)
+    if not sharded:
+        return None
+    rule = shard_rules[sharded[0]]
+    placement = (rule['column'], rule['strategy'], rule['owners'], rule['bounds'])
+    if any((other['column'], other['strategy'], other['owners'], other['bounds']) != placement for other in (shard_rules[table] for table in sharded[1:])):
+        raise ShardingError(f"The sharded tables {sharded} are not placed alike and cannot be used in the same query")
+    values = shard_key_values(query, params, rule)
+    if values is None:
+        return list(rule['shards'])
+    targets = list(dict.fromkeys(shard_for(rule, value) for value in values))
+    if len(targets) > 1 and re.match(r"\s*insert\b", query, re.IGNORECASE):
+        raise ShardingError("The rows of an INSERT into a sharded table must all belong to the same shard, send them separately")
+    return targets
+
+AGGREGATE_PATTERN = re.compile(r"^\s*(count|sum|min|max)\s*\(", re.IGNORECASE)
+
+'''
+Description: Checks that the results of a READ run on several shards can be merged, and tells how: the rows of every shard are concatenated
+(and cut to the READ's LIMIT, if any), or, for a READ selecting only COUNT, SUM, MIN and MAX aggregates, the one row of every shard is combined
+column by column. Grouping, ordering, DISTINCT, AVG and offsets would need the rows of every shard together, and are refused.
+Inputs: query (str) - The SQL query.
+Outputs: tuple - ('rows', LIMIT or None) or ('aggregate', the aggregate function of every column).
+Raises: ShardingError if the results cannot be merged.
+'''
+def fanout_merge_plan(query: str):
+    masked = STRING_LITERAL_PATTERN.sub(lambda match: match.group(0)[0] + ' ' * (len(match.group(0)) - 2) + match.group(0)[0], query)
+    masked = masked.strip().rstrip(';').rstrip()
+    select = re.match(r"\s*select\s+", masked, re.IGNORECASE)
+    if not select:
+        raise ShardingError("Only SELECT statements can be run on every shard")
+    unsupported = re.search(r"\b(group\s+by|order\s+by|having|distinct|union|offset|avg(?=\s*\())", masked, re.IGNORECASE)
+    if unsupported:
+        raise ShardingError(f"{unsupported.group(1).upper()} is not supported for a READ on every shard; restrict it to one shard with its shard key")
+    limit = re.search(r"\blimit\s+(\d+)\s*(,\s*\d+)?$", masked, re.IGNORECASE)
+    if limit and limit.group(2):
+        raise ShardingError("LIMIT with an offset is not supported for a READ on every shard")
+    end = next((match.start() for match in re.finditer(r"\bfrom\b", masked, re.IGNORECASE)
+                if masked.count('(', 0, match.start()) == masked.count(')', 0, match.start())), len(masked))
+    functions = []
+    for _, item in split_top_level(masked[select.end():end]):
+        aggregate = AGGREGATE_PATTERN.match(item)
+        if not aggregate:
+            functions.append(None)
+            continue
+        call = item[aggregate.start(1):].lstrip()
+        close = closing_paren(call[call.index('('):]) + call.index('(')
+        if not re.fullmatch(r"(?:\s+(?:as\s+)?`?\w+`?)?\s*", call[close + 1:], re.IGNORECASE):
+            raise ShardingError(f"The select expression {item.strip()} cannot be merged across shards")
+        functions.append(aggregate.group(1).lower())
+    if all(function is None for function in functions):
+        return 'rows', int(limit.group(1)) if limit else None
+    if any(function is None for function in functions):
+        raise ShardingError("Mixing aggregates and plain columns needs GROUP BY, which is not supported for a READ on every shard")
+    return 'aggregate', functions
+
+'''
+Description: Merges the results of a READ run on several shards (see `fanout_merge_plan`).
+Inputs:
+    plan (tuple) - The merge plan.
+    results (list) - The result rows of every shard.
+Outputs: list - The merged rows.
+'''
+def merge_shard_results(plan: tuple, results: list):
+    kind, detail = plan
+    if kind == 'rows':
+        rows = [row for result in results for row in result]
+        return rows[:detail] if detail is not None else rows
+    merged = []
+    for column, function in enumerate(detail):
+        values = [result[0][column] for result in results if result and result[0][column] is not None]
+        if function in ('count', 'sum'):
+            merged.append(sum(values) if values else (0 if function == 'count' else None))
+        else:
+            merged.append((min if function == 'min' else max)(values) if values else None)
+    return [tuple(merged)]
+
+'''
+Description: Runs a query on one shard: a WRITE on the shard's manager, and a READ on a replica of the shard chosen under the routing mode
+(one that has applied the session token's position on the shard, if any), retried once on another replica (or the manager) if that replica fails.
+Inputs:
+    name (str) - The shard name.
+    query (str) - The SQL query, or a statement template.
+    query_type (str) - 'READ' or 'WRITE'.
+    mode (str) - The routing mode of a READ.
+    session_token (str) - The session token of a READ (see `parse_position`), or None.
+    params (list) - The parameters of the query, or None.
+Outputs: list - A list of tuples containing the query result.
+Raises: PoolError or mysql.connector.Error if the query failed, DeadlineExceeded if the request ran out of time.
+'''
+def run_on_shard(name: str, query: str, query_type: str, mode: str, session_token: str, params: list):
+    shard_manager, group = shard_nodes(name)
+    if query_type == 'WRITE':
+        return run_query(shard_manager, query, params)
+    return read_with_retry(query, mode, parse_position(session_token, name), params, name)
+
+'''
+Description: Runs `run_on_shard` on a `shard_executor` thread, under the labels and deadline of the request.
+'''
+def run_on_shard_in_request(labels: tuple, deadline: float, *args):
+    set_query_labels(*labels)
+    set_deadline(deadline)
+    return run_on_shard(*args)
+
+'''
+Description: Executes a query on sharded tables: on its one shard, or on every shard it may touch, in parallel. The results of a READ run on
+several shards are merged (see `fanout_merge_plan`); a WRITE run on several shards, e.g. an UPDATE without shard key, commits on each shard
+on its own, so it may be applied on some shards only if another fails.
+Inputs:
+    targets (list) - The shards to run the query on (see `shard_targets`).
+    query (str) - The SQL query, or a statement template.
+    query_type (str) - 'READ' or 'WRITE'.
+    mode (str) - The routing mode of a READ.
+    session_token (str, optional) - The session token of a READ.
+    params (list, optional) - The parameters of the query.
+Outputs: result (list or dict) - The query result, or a dictionary with an error message.
+Raises: ShardingError if the results of a READ on several shards cannot be merged, DeadlineExceeded if the request ran out of time.
+'''
+def sharded_query(targets: list, query: str, query_type: str, mode: str, session_token: str = None, params: list = None):
+    plan = fanout_merge_plan(query) if query_type == 'READ' and len(targets) > 1 else None
+    shard_queries.inc(query_type, 'single' if len(targets) == 1 else 'fanout')
+    try:
+        if len(targets) == 1:
+            return run_on_shard(targets[0], query, query_type, mode, session_token, params)
+        labels = getattr(query_labels, 'value', (query_type, mode))
+        futures = [shard_executor.submit(run_on_shard_in_request, labels, current_deadline(), name, query, query_type, mode, session_token, params)
+                   for name in targets]
+        wait(futures)
+        results = [future.result() for future in futures]
+        return merge_shard_results(plan, results) if plan else [row for result in results for row in result]
+    except DeadlineExceeded:
+        raise
+    except PoolError as e:
+        app.logger.error(f"Error connecting to shard: {e}")
+        return {'error': 'Failed to connect to the shard'}
+    except Exception as e:
+        app.logger.error(f"Error executing query on shards {targets}: {e}")
+        return {'error': 'Error executing query on shard'}
+
+'''
+Description: Executes a WRITE on tables that are not sharded, which have a copy on every shard: on the default shard's manager first (see
+`direct_hit`), then, if it succeeded, on the managers of the other shards in parallel. Each shard commits on its own, so a WRITE that fails
+on a shard after the default one leaves that shard's copy behind; and concurrent INSERTs relying on AUTO_INCREMENT may be numbered
+differently on each shard, so rows that other shards refer to should be inserted with explicit keys.
+Inputs:
+    query (str) - The SQL query, or a statement template.
+    params (list, optional) - The parameters of the query.
+Outputs: result (list or dict) - The result on the default shard, or a dictionary with an error message.
+Raises: DeadlineExceeded if the request ran out of time.
+'''
+def broadcast_write(query: str, params: list = None):
+    result = direct_hit(query, params)
+    if 'error' in result:
+        return result
+    shard_queries.inc('WRITE', 'broadcast')
+    others = other_shards()
+    labels = getattr(query_labels, 'value', ('WRITE', 'direct'))
+    futures = [shard_executor.submit(run_on_shard_in_request, labels, current_deadline(), name, query, 'WRITE', 'direct', None, params) for name in others]
+    wait(futures)
+    failed = [name for name, future in zip(others, futures) if future.exception() is not None]
+    if any(isinstance(future.exception(), DeadlineExceeded) for future in futures):
+        raise DeadlineExceeded()
+    if failed:
+        app.logger.error(f"WRITE applied on the default shard but failed on shards {failed}: {[str(futures[others.index(name)].exception()) for name in failed]}")
+        return {'error': f"WRITE applied on the default shard but failed on shards {failed}"}
+    return result
+
+'''
+Description: Handles a query on sharded tables for the `/query` endpoint. A streamed READ is only supported on a single shard.
+Inputs:
+    targets (list) - The shards to run the query on (see `shard_targets`).
+    query (str) - The SQL query, or a statement template.
+    query_type (str) - 'READ' or 'WRITE'.
+    params (list) - The parameters of the query, or None.
+Outputs: The Flask response.
+'''
+def handle_sharded_query(targets: list, query: str, query_type: str, params: list):
+    mode = request.json.get('mode', 'random') if query_type == 'READ' else 'direct'
+    if mode not in READ_MODES:
+        mode = 'random'
+    set_query_labels(query_type, mode)
+    session_token = request.json.get('session_token') if query_type == 'READ' else None
+    if query_type == 'READ' and request.json.get('stream'):
+        if len(targets) > 1:
+            return jsonify({'error': 'Streaming is not supported for a READ on every shard; restrict it to one shard with its shard key'}), 400
+        shard_manager, group = shard_nodes(targets[0])
+        with span('route'):
+            node = pick_worker(mode, parse_position(session_token, targets[0]), group=group) or shard_manager
+        shard_queries.inc(query_type, 'single')
+        try:
+            return Response(stream_query(node, query, params), mimetype='application/x-ndjson')
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            app.logger.error(f"Error executing query on shard {targets[0]}: {e}")
+            return jsonify({'error': 'Error executing query on shard'}), 500
+
+    try:
+        result = sharded_query(targets, query, query_type, mode, session_token, params)
+    except ShardingError as e:
+        return jsonify({'error': str(e)}), 400
+    if 'error' in result:
+        return jsonify(result), 500
+    headers = {}
+    if query_type == 'WRITE' and request.json.get('session'):
+        token = manager_position(targets)
+        if token:
+            headers['X-Session-Token'] = token
+    return jsonify(result), 200, headers
+
+'''
+Description: Checks the 'params' of a query object: absent, or a list of scalar values to bind to the placeholders of its statement template.
+Inputs: params - The value of the 'params' key.
+Outputs: bool - True if the value is valid.
+'''
+def valid_params(params):
+    return params is None or (isinstance(params, list) and all(isinstance(value, (str, int, float, bool, type(None))) for value in params))
+
+'''
+Description: Handles incoming HTTP POST requests to the `/query` endpoint,
+processes the query based on its type (READ or WRITE),
+and routes it to the appropriate worker or manager. A query on sharded tables is routed to the shards holding its rows (see `shard_targets`).
+Inputs: JSON body (dict) containing:
+        - 'query' (str) - The SQL query to be executed, or a statement template with `%s` or `?` placeholders if 'params' is given.
+        - 'query_type' (str) - The type of query ('READ' or 'WRITE').
+        - 'params' (list, optional) - The values bound to the placeholders of the template. The template is prepared once per pooled
+          connection (see `StatementCache`) and later calls only send the parameters.
+        - 'mode' (str, optional) - The mode for routing 'READ' queries ('direct', 'random', 'customized', 'p2c' or 'least_outstanding'). Defaults to 'random' if not provided.
+        - 'stream' (bool, optional) - Stream the result of a 'READ' query as NDJSON instead of a single JSON array. Defaults to false.
+        - 'session' (bool, optional) - For a 'WRITE' query, return a session token in the `X-Session-Token` response header. Defaults to false.
+        - 'session_token' (str, optional) - For a 'READ' query, the token returned by the caller's last WRITE. The query is only sent to
+          a replica that has applied that WRITE, or to the manager if none has (read-your-writes).
+Outputs: JSON response (dict) containing:
+        - The result of the query execution if successful.
+        - An error message if there was an issue with the query or processing.
+        When streaming, an `application/x-ndjson` response with one JSON array per row.
+'''
+# Route for handling HTTP requests
+@app.route('/query', methods=['POST'])
+def handle_query():
+    try:
+        query = request.json.get('query')
+        query_type = request.json.get('query_type')  # 'READ' or 'WRITE'
+
+        params = request.json.get('params')
+
+        if not query or not query_type:
+            return jsonify({'error': 'Query and query_type are required'}), 400
+        if not valid_params(params):
+            return jsonify({'error': 'params must be a list of strings, numbers, booleans or nulls'}), 400
+
+        if shard_rules and query_type in ('READ', 'WRITE'):
+            try:
+                targets = shard_targets(query, params)
+            except ShardingError as e:
+                return jsonify({'error': str(e)}), 400
+            if targets is not None:
+                return handle_sharded_query(targets, query, query_type, params)
+
+        headers = {}
+        if query_type == 'WRITE':
+            set_query_labels('WRITE', 'direct')
+            broadcast = shard_rules and other_shards()
+            result = broadcast_write(query, params) if broadcast else direct_hit(query, params)  # WRITE operations go to the manager
+            if request.json.get('session') and 'error' not in result:
+                token = manager_position(['default'] + other_shards() if broadcast else None)
+                if token:
+                    headers['X-Session-Token'] = token
+        elif query_type == 'READ':
+            min_position = parse_position(request.json.get('session_token'))
+            # Choose between random or customized routing
+            mode = request.json.get('mode', 'random')  # Default to 'random'
+            if mode == 'random':
+                route = random_worker
+            elif mode == 'direct':
+                route = manager_read
+            elif mode == 'customized':
+                route = customized_worker
+            elif mode in ('p2c', 'least_outstanding'):
+                route = partial(balanced_worker, mode=mode)
+            else:
+                mode, route = 'random', random_worker
+            set_query_labels('READ', mode)
+
+            if request.json.get('stream'):
+                if mode != 'direct' and not workers:
+                    return jsonify({'error': 'No worker nodes available'}), 500
+                with span('route'):
+                    worker = pick_worker(mode, min_position) or manager
+                try:
+                    try:
+                        rows = stream_query(worker, query, params)
+                    except Exception as e:
+                        if worker is manager or not is_backend_failure(e):
+                            raise
+                        app.logger.warning(f"Worker {worker['host']} failed ({e}), retrying the query on another node")
+                        with span('route'):
+                            retry = pick_worker(mode, min_position, exclude=worker) or manager
+                        rows = stream_query(retry, query, params)
+                    return Response(rows, mimetype='application/x-ndjson')
+                except DeadlineExceeded:
+                    raise
+                except PoolError as e:
+                    app.logger.error(f"Error connecting to worker: {e}")
+                    return jsonify({'error': 'Failed to connect to a worker node'}), 500
+                except Exception as e:
+                    app.logger.error(f"Error executing query on worker: {e}")
+                    return jsonify({'error': 'Error executing query on worker'}), 500
+
+            # Session reads bypass the cache, which may hold a result read from a replica before the caller's WRITE reached it
+            if result_cache_enabled and min_position is None:
+                result = cached_read(query, route, params)
+            else:
+                result = route(query, min_position, params=params)
+        else:
+            result = {'error': 'Unknown query type'}
+
+        if 'error' in result:
+            return jsonify(result), 500
+
+        return jsonify(result), 200, headers
+    except DeadlineExceeded as e:
+        app.logger.warning(f"Request {g.request_id}: {e}")
+        return jsonify({'error': 'Deadline exceeded'}), 504
+    except Exception as e:
+        app.logger.error(f"Error handling request: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+'''
+Description: Handles incoming HTTP POST requests to the `/query/batch` endpoint, which executes several queries in one request.
+READs are routed like single queries, grouped per chosen worker and run over one connection per worker, the groups in parallel.
+WRITEs run in order in a single manager transaction, with consecutive single-row INSERTs into the same table merged into multi-row INSERTs.
+READs and WRITEs of the same batch run concurrently, so a READ is not guaranteed to observe the batch's own WRITEs.
+Inputs: JSON body (dict) containing:
+        - 'queries' (list) - Query objects with the same 'query', 'query_type', 'params' and 'mode' keys as the `/query` endpoint.
+        - 'mode' (str, optional) - The default routing mode for 'READ' queries that do not set their own. Defaults to 'random'.
+        - 'session' (bool, optional) - Return a session token covering the batch's WRITEs in the `X-Session-Token` response header.
+        - 'session_token' (str, optional) - Only send the batch's READs to replicas that have applied the WRITE this token was returned for.
+Outputs: JSON response (list) with one entry per query, in the original order: the query result, or a dictionary with an error message.
+'''
+@app.route('/query/batch', methods=['POST'])
+def handle_batch():
+    try:
+        items = request.json.get('queries')
+        default_mode = request.json.get('mode', 'random')
+        min_position = parse_position(request.json.get('session_token'))
+
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'A non-empty list of queries is required'}), 400
+        if len(items) > batch_max_size:
+            return jsonify({'error': f'A batch can hold at most {batch_max_size} queries'}), 400
+
+        results = [None] * len(items)
+        writes = []
+        reads = {}
+        cache_entries = {}
+        for index, item in enumerate(items):
+            query = item.get('query') if isinstance(item, dict) else None
+            query_type = item.get('query_type') if isinstance(item, dict) else None
+            params = item.get('params') if isinstance(item, dict) else None
+            if not query or not query_type:
+                results[index] = {'error': 'Query and query_type are required'}
+            elif not valid_params(params):
+                results[index] = {'error': 'params must be a list of strings, numbers, booleans or nulls'}
+            elif shard_rules and shard_rules.keys() & query_tables(query):
+                results[index] = {'error': 'Queries on sharded tables cannot be batched, send them to /query'}
+            elif shard_rules and other_shards() and query_type == 'WRITE':
+                results[index] = {'error': 'WRITEs cannot be batched when tables are sharded, send them to /query'}
+            elif query_type == 'WRITE':
+                writes.append(index)
+            elif query_type == 'READ':
+                if result_cache_enabled and min_position is None:
+                    key = result_cache_key(query, params)
+                    if key is not None:
+                        cached = result_cache.get(key)
+                        if cached is not None:
+                            results[index] = cached
+                            continue
+                        tables = query_tables(query)
+                        cache_entries[index] = (key, tables, result_cache.versions(tables))
+                if not workers:
+                    results[index] = {'error': 'No worker nodes available'}
+                    continue
+                mode = item.get('mode', default_mode)
+                if mode not in READ_MODES:
+                    mode = 'random'
+                worker = pick_worker(mode, min_position) or manager
+                reads.setdefault(node_key(worker), (worker, [], mode))[1].append((index, query, params))
+            else:
+                results[index] = {'error': 'Unknown query type'}
+
+        futures = [batch_executor.submit(run_read_group, worker, group, mode, min_position, current_deadline()) for worker, group, mode in reads.values()]
+        if writes:
+            set_query_labels('WRITE', 'batch')
+            for index, result in zip(writes, run_write_batch([items[i]['query'] for i in writes], [items[i].get('params') for i in writes])):
+                results[index] = result
+        for future in futures:
+            for index, result in future.result().items():
+                results[index] = result
+
+        for index, (key, tables, versions) in cache_entries.items():
+            if 'error' not in results[index]:
+                result_cache.put(key, results[index], tables, versions)
+
+        headers = {}
+        if request.json.get('session') and writes:
+            token = manager_position()
+            if token:
+                headers['X-Session-Token'] = token
+        return jsonify(results), 200, headers
+    except Exception as e:
+        app.logger.error(f"Error handling batch request: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+'''
+Description: Handles GET requests to the `/stats` endpoint and reports the state of the proxy.
+Outputs: JSON response (dict) containing:
+        - 'pools' (dict) - Per backend ("host:port") connection pool statistics: open, idle and in-use connections,
+          checkouts, connections created, closed, evicted or found dead, how often the pool was exhausted and how many checkouts timed out.
+        - 'latency' (dict) - Per worker ("host:port") latency estimate in milliseconds, `null` while the worker is unreachable.
+        - 'fastest_worker' (str) - The worker the customized routing mode currently sends reads to.
+        - 'cache' (dict) - Result cache size, hits, misses, LRU evictions, TTL expirations and write invalidations, if the cache is enabled.
+        - 'group_commit' (dict) - Number of committed groups and WRITEs, pending WRITEs and a histogram of group sizes, if group commit is enabled.
+        - 'replicas' (dict) - Per worker ("host:port") replication lag in seconds, applied manager binlog position, age of the sample
+          and whether the worker currently receives READs.
+        - 'load' (dict) - Per backend ("host:port") queries in flight and recent query latency in milliseconds, plus the static weight of workers.
+        - 'breakers' (dict) - Per worker ("host:port") circuit breaker state, see the `/breakers` endpoint.
+'''
+@app.route('/stats', methods=['GET'])
+def stats():
+    with latency_lock:
+        latency = {key: (None if value == float('inf') else round(value * 1000, 3)) for key, value in worker_latency.items()}
+        fastest = node_key(fastest_worker) if fastest_worker else None
+    eligible = {node_key(worker) for worker in fresh_workers()}
+    with replica_status_lock:
+        replicas = {
+            key: {
+                'lag': status['lag'],
+                'position': f"{status['position'][0]}:{status['position'][1]}" if status['position'] else None,
+                'age': round(time.monotonic() - status['updated'], 3),
+                'eligible': key in eligible,
+            }
+            for key, status in replica_status.items()
+        }
+    weights = {node_key(worker): worker.get('weight', 1.0) for worker in workers}
+    with worker_load_lock:
+        load = {
+            key: {
+                'inflight': value['inflight'],
+                'latency': round(value['latency'] * 1000, 3) if value['latency'] is not None else None,
+                'weight': weights.get(key),
+            }
+            for key, value in worker_load.items()
+        }
+    return jsonify({
+        'pools': {key: pool.stats() for key, pool in list(pools.items())},
+        'latency': latency,
+        'fastest_worker': fastest,
+        'cache': result_cache.stats() if result_cache_enabled else None,
+        'group_commit': group_committer.stats() if group_commit_enabled else None,
+        'replicas': replicas,
+        'load': load,
+        'breakers': {key: breaker.stats() for key, breaker in list(breakers.items())},
+    })
+
+'''
+Description: Handles GET requests to the `/breakers` endpoint and reports the circuit breaker of every worker.
+Outputs: JSON response (dict) with, per worker ("host:port"), the breaker state ('closed', 'open' or 'half_open'), its consecutive and
+        total failures, how many times it opened and for how long it has been open.
+'''
+@app.route('/breakers', methods=['GET'])
+def breakers_state():
+    return jsonify({key: breaker.stats() for key, breaker in list(breakers.items())})
+
+'''
+Description: Finds a worker from its "host:port" key, or from its host on the default port 3306.
+Inputs:
+    entries (list) - The workers, or the entries of a membership.
+    name (str) - The key or host.
+Outputs: dict or None - The matching worker or entry, or None if there is no such worker.
+'''
+def find_worker(entries: list, name: str):
+    key = name if ':' in name else f"{name}:3306"
+    return next((entry for entry in entries if node_key(entry) == key), None)
+
+'''
+Description: Describes a worker of this process for the admin endpoints.
+'''
+def describe_worker(worker: dict):
+    return {'worker': node_key(worker), 'weight': worker.get('weight', 1.0), 'draining': worker.get('draining', False), **worker_activity(worker)}
+
+'''
+Description: Handles GET requests to the `/admin/workers` endpoint and lists the workers of this process.
+Outputs: JSON response (list) with, per worker, its key ("host:port"), weight, whether it is draining, its queries in flight and its checked-out connections.
+'''
+@app.route('/admin/workers', methods=['GET'])
+def list_workers():
+    return jsonify([describe_worker(worker) for worker in workers])
+
+'''
+Description: Handles POST requests to the `/admin/workers` endpoint and adds a worker, which starts receiving READs at once
+(its replication status is checked like any other worker's). Adding a draining worker again makes it active.
+Inputs: JSON body (dict) containing:
+        - 'host' (str) - The address of the replica.
+        - 'port' (int, optional) - Its MySQL port. Defaults to 3306.
+        - 'weight' (float, optional) - Its static routing weight. Defaults to 1.
+Outputs: JSON response (dict) describing the worker, with status 201.
+'''
+@app.route('/admin/workers', methods=['POST'])
+def add_worker():
+    body = request.get_json(silent=True) or {}
+    host, port, weight = body.get('host'), body.get('port', 3306), body.get('weight', 1.0)
+    if not isinstance(host, str) or not host or not isinstance(port, int) or not isinstance(weight, (int, float)) or weight <= 0:
+        return jsonify({'error': 'host (str) is required, port must be an int and weight a positive number'}), 400
+    entry = {'host': host, 'port': port, 'weight': float(weight), 'draining': False}
+
+    def change(entries):
+        return [e for e in entries if node_key(e) != node_key(entry)] + [entry]
+
+    retire_in_background(update_membership(change))
+    return jsonify(describe_worker(find_worker(workers, node_key(entry)))), 201
+
+'''
+Description: Handles POST requests to the `/admin/workers/<worker>/drain` endpoint: the worker ("host:port", or its host) stops receiving new
+READs, while the queries it is running complete. Poll `/admin/workers` until it has nothing in flight, or remove it with DELETE.
+Outputs: JSON response (dict) describing the worker, or 404 if there is no such worker.
+'''
+@app.route('/admin/workers/<name>/drain', methods=['POST'])
+def drain_worker(name: str):
+    if find_worker(workers, name) is None:
+        return jsonify({'error': f'Unknown worker {name}'}), 404
+
+    def change(entries):
+        draining = find_worker(entries, name)
+        return [dict(entry, draining=True) if entry is draining else entry for entry in entries]
+
+    retire_in_background(update_membership(change))
+    return jsonify(describe_worker(find_worker(workers, name)))
+
+'''
+Description: Handles DELETE requests to the `/admin/workers/<worker>` endpoint: drains the worker ("host:port", or its host), waits for its
+queries in flight to finish, then removes it and closes its connection pool (see `retire_worker`).
+Inputs: 'timeout' query parameter (float, optional) - Seconds to wait for the worker to drain. Defaults to `DRAIN_TIMEOUT`.
+Outputs: JSON response (dict) with the 'worker' removed and whether it 'drained' before the timeout, or 404 if there is no such worker.
+'''
+@app.route('/admin/workers/<name>', methods=['DELETE'])
+def remove_worker(name: str):
+    worker = find_worker(workers, name)
+    if worker is None:
+        return jsonify({'error': f'Unknown worker {name}'}), 404
+    timeout = request.args.get('timeout', type=float)
+    retired = update_membership(lambda entries: [e for e in entries if node_key(e) != node_key(worker)])
+    drained = True
+    for retiring in retired:
+        drained = retire_worker(retiring, timeout) and drained
+    return jsonify({'worker': node_key(worker), 'drained': drained})
+
+backend_inflight = Metric('proxy_backend_inflight_queries', 'gauge', 'Queries currently in flight per backend.', ('backend', 'role'))
+pool_connections = Metric('proxy_pool_connections', 'gauge', 'Open connections per backend pool, by state.', ('backend', 'state'))
+pool_exhausted = Metric('proxy_pool_exhausted_total', 'counter', 'Checkouts that found the backend pool exhausted and had to wait.', ('backend',))
+pool_timeouts = Metric('proxy_pool_checkout_timeouts_total', 'counter', 'Checkouts that gave up after the checkout timeout.', ('backend',))
+breaker_state = Metric('proxy_breaker_state', 'gauge', 'Circuit breaker state per worker: 0 closed, 1 half-open, 2 open.', ('backend',))
+replica_lag = Metric('proxy_replica_lag_seconds', 'gauge', 'Replication lag per worker, -1 while replication is stopped.', ('backend',))
+membership_size = Metric('proxy_workers', 'gauge', 'Workers of the membership, by state: active or draining.', ('state',))
+cache_events = Metric('proxy_result_cache_events_total', 'counter', 'Result cache hits, misses, evictions, expirations and invalidations.', ('event',))
+group_commits = Metric('proxy_group_commit_total', 'counter', 'Committed WRITE groups and the WRITEs they held.', ('unit',))
+
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+'''
+Description: Copies the current state of the pools, breakers, membership, replicas, result cache and group committer into their metrics.
+Called when the metrics are scraped, so none of it costs anything on the request path.
+'''
+def collect_state_metrics():
+    manager_keys = {node_key(shard_nodes(name)[0]) for name in shard_groups} | {node_key(manager)}
+    with worker_load_lock:
+        inflight = {key: value['inflight'] for key, value in worker_load.items()}
+    for key, count in inflight.items():
+        backend_inflight.set(count, key, 'manager' if key in manager_keys else 'worker')
+    for key, pool in list(pools.items()):
+        pool_stats = pool.stats()
+        pool_connections.set(pool_stats['idle'], key, 'idle')
+        pool_connections.set(pool_stats['in_use'], key, 'in_use')
+        pool_exhausted.set(pool_stats['exhausted'], key)
+        pool_timeouts.set(pool_stats['timeouts'], key)
+    for key, breaker in list(breakers.items()):
+        breaker_state.set(BREAKER_STATES[breaker.stats()['state']], key)
+    current = workers
+    draining = sum(1 for worker in current if worker.get('draining'))
+    membership_size.set(len(current) - draining, 'active')
+    membership_size.set(draining, 'draining')
+    with replica_status_lock:
+        lags = {key: status['lag'] for key, status in replica_status.items()}
+    for key, lag in lags.items():
+        replica_lag.set(-1 if lag is None else lag, key)
+    if result_cache_enabled:
+        cache_stats = result_cache.stats()
+        for event in ('hits', 'misses', 'evictions', 'expirations', 'invalidations'):
+            cache_events.set(cache_stats[event], event)
+    if group_commit_enabled:
+        commit_stats = group_committer.stats()
+        group_commits.set(commit_stats['batches'], 'batches')
+        group_commits.set(commit_stats['writes'], 'writes')
+
+'''
+Description: Handles GET requests to the `/metrics` endpoint and exposes the proxy's metrics in the Prometheus text format:
+request counts and latency per route, query latency and errors per backend (labelled with the backend role, query type and routing mode),
+queries in flight per backend, and the state of the pools, breakers, membership, replicas, result cache and group committer.
+Outputs: A plain text response in the Prometheus exposition format.
+'''
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    collect_state_metrics()
+    return service_common.metrics_response(metrics_registry)
+
+'''
+Description: Starts the proxy's background threads. Must run in the process that serves requests.
+'''
+def start_background_tasks():
+    threading.Thread(target=pool_maintenance_loop, daemon=True).start()
+    threading.Thread(target=latency_probe_loop, daemon=True).start()
+    threading.Thread(target=replica_status_loop, daemon=True).start()
+    threading.Thread(target=deadline_watchdog.run, daemon=True).start()
+    if workers_file:
+        threading.Thread(target=membership_sync_loop, daemon=True).start()
+
+if __name__ == '__main__':
+    service_common.serve(app, 8080, on_worker_start=start_background_tasks)
@@ -7,10 +7,10 @@ if [ $? -eq 0 ]; then
     echo "main.py executed successfully."
     
     echo "Running benchmark.py..."
-    python3 benchmark.py > benchmark_results.txt
+    python3 benchmark.py
 
     if [ $? -eq 0 ]; then
-        echo "benchmark.py executed successfully. Results saved to output/benchmark_results.txt."
+        echo "benchmark.py executed successfully. Results saved to output/benchmark_results.json."
     else
         echo "Error: benchmark.py failed to execute."
     fi
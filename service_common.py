@@ -0,0 +1,270 @@
+"""
+Code shared by the three services (proxy.py, trusted_host.py and gatekeeper.py): the Prometheus metrics, the calls to the next hop over
+a keep-alive session and the relaying of its responses, and the server. `main.deploy_service` uploads this module next to each service.
+"""
+
+from flask import Response, request
+from bisect import bisect_left
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import requests
+import threading
+import os
+
+# Serving: "development" runs Flask's built-in server, "production" a pre-fork gunicorn server (see `serve`)
+server_mode = os.getenv("SERVER_MODE", "development")
+server_workers = int(os.getenv("SERVER_WORKERS", str(os.cpu_count() or 1)))
+server_threads = int(os.getenv("SERVER_THREADS", "8"))
+server_timeout = int(os.getenv("SERVER_TIMEOUT", "60"))
+server_graceful_timeout = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+server_keepalive = int(os.getenv("SERVER_KEEPALIVE", "5"))
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+'''
+Description: A metric exported on the `/metrics` endpoint in the Prometheus text format: a counter, a gauge or a latency histogram,
+with one series per combination of label values. Recording a value takes one short lock (plus a binary search over the buckets for a histogram),
+so it stays cheap on the request path; histogram series keep a count per bucket and are only made cumulative when rendered.
+Each service binds its own registry, e.g. `Metric = partial(service_common.Metric, metrics_registry)`, since the services may share a process
+(see local_cluster.py).
+Inputs:
+    registry (list) - The metrics of the service, in the order they are rendered; the metric is appended to it.
+    name (str) - The metric name.
+    kind (str) - "counter", "gauge" or "histogram".
+    description (str) - The help text.
+    labels (tuple, optional) - The label names, in the order their values are passed when recording.
+'''
+class Metric:
+    def __init__(self, registry: list, name: str, kind: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.labels = labels
+        self._series = {}  # label values -> value, or for a histogram [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *values, amount: float = 1):
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + amount
+
+    def set(self, value: float, *values):
+        with self._lock:
+            self._series[values] = value
+
+    '''
+    Description: Drops the series whose label `label` has the value `value`, e.g. those of a backend that left the cluster.
+    '''
+    def remove(self, label: str, value):
+        index = self.labels.index(label)
+        with self._lock:
+            for values in [values for values in self._series if values[index] == value]:
+                del self._series[values]
+
+    def observe(self, seconds: float, *values):
+        index = bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        with self._lock:
+            series = [(values, list(value) if self.kind == "histogram" else value) for values, value in self._series.items()]
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in series:
+            labels = list(zip(self.labels, values))
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value):
+                cumulative += count
+                bucket_labels = labels + [("le", bound)]
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {value[-1]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+'''
+Description: Formats label name/value pairs as a Prometheus label set, escaping the values.
+Inputs: labels (list) - (name, value) pairs.
+Outputs: str - The label set, e.g. `{route="/query",status="200"}`, or an empty string without labels.
+'''
+def format_labels(labels: list):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+'''
+Description: Renders the metrics of a service in the Prometheus text format.
+Inputs: registry (list) - The metrics of the service.
+Outputs: flask.Response - The plain text response of the `/metrics` endpoint.
+'''
+def metrics_response(registry: list):
+    return Response("".join(metric.render() for metric in registry), mimetype="text/plain; version=0.0.4")
+
+'''
+Description: The retry policy of the calls to an upstream, which counts the retries in the upstream metrics. A request that could not be sent
+(connection failure) is retried whatever its method; after it was sent, only idempotent methods (GET, HEAD...) are retried, since a POSTed WRITE
+may already have been applied. Retries are spaced by an exponential backoff starting at `UPSTREAM_RETRY_BACKOFF` seconds.
+Inputs:
+    on_retry (function, optional) - Called for every retry; passed on to the copies urllib3 makes of the policy as the retries are counted down.
+    *args, **kwargs - Passed on to `urllib3.util.Retry`.
+'''
+class CountedRetry(Retry):
+    def __init__(self, *args, on_retry=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_retry = on_retry
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.on_retry = self.on_retry
+        return retry
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        if self.on_retry:
+            self.on_retry()
+        return retry
+
+# Upstream response headers that are passed back to the client
+RELAYED_HEADERS = ["X-Session-Token", "X-Backend", "Content-Length", "Content-Encoding"]
+
+# Bytes read from the upstream per chunk when relaying a response
+RELAY_CHUNK_SIZE = 64 * 1024
+
+'''
+Description: The connections of a service to its upstream, the next hop: a session shared by every request, so that calls reuse its keep-alive
+connections (up to `pool_max_size` are kept open, and when more requests are forwarded at once the extra connections are opened for them and
+closed after use), and the `upstream_*` metrics of the calls.
+Inputs:
+    name (str) - The upstream, as labelled in the metrics, e.g. "proxy".
+    registry (list) - The metrics of the service (see `Metric`).
+    pool_max_size (int) - The keep-alive connections kept open.
+    max_retries (int) - The retries of a failed call (see `CountedRetry`).
+    retry_backoff (float) - The backoff of the first retry, in seconds.
+'''
+class Upstream:
+    def __init__(self, name: str, registry: list, pool_max_size: int, max_retries: int, retry_backoff: float):
+        self.name = name
+        self.pool_max_size = pool_max_size
+        self.latency = Metric(registry, "upstream_request_duration_seconds", "histogram",
+                              "Time until the upstream answered a forwarded request, up to the response headers for streamed responses, by upstream and path.",
+                              ("upstream", "path"))
+        self.errors = Metric(registry, "upstream_errors_total", "counter",
+                             "Forwarded requests that could not reach the upstream or got a 5xx answer, by upstream and path.", ("upstream", "path"))
+        self.retries = Metric(registry, "upstream_retries_total", "counter", "Calls to the upstream retried after a failed attempt, by upstream.", ("upstream",))
+        self.pool_size = Metric(registry, "upstream_pool_size", "gauge", "Keep-alive connections to the upstream kept open when idle, by upstream.", ("upstream",))
+        self.pool_connections = Metric(registry, "upstream_pool_connections", "gauge",
+                                       "Connections to the upstream in use by a forwarded request (active) or kept alive for the next one (idle), by upstream.",
+                                       ("upstream", "state"))
+        self.pool_opened = Metric(registry, "upstream_pool_connections_opened_total", "counter",
+                                  "Connections opened to the upstream, by upstream. It stays flat in steady state, when every call reuses a kept-alive connection.",
+                                  ("upstream",))
+
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_max_size,
+                                   max_retries=CountedRetry(total=max_retries, backoff_factor=retry_backoff, respect_retry_after_header=False,
+                                                            on_retry=lambda: self.retries.inc(name)))
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+        self.active = 0  # connections held by forwarded requests, from the call to the upstream until its relayed response is closed
+        self._lock = threading.Lock()
+
+    '''
+    Description: Updates the count of connections to the upstream held by forwarded requests.
+    Inputs: delta (int) - 1 when a call to the upstream starts, -1 when its connection is released.
+    '''
+    def track_connection(self, delta: int):
+        with self._lock:
+            self.active += delta
+
+    '''
+    Description: Sets the pool metrics of the connections to the upstream from the state of the shared session's connection pools.
+    '''
+    def collect_pool_metrics(self):
+        idle = opened = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            opened += pool.num_connections
+            idle += sum(1 for connection in list(pool.pool.queue) if connection is not None)
+        self.pool_size.set(self.pool_max_size, self.name)
+        self.pool_connections.set(self.active, self.name, "active")
+        self.pool_connections.set(idle, self.name, "idle")
+        self.pool_opened.set(opened, self.name)
+
+    '''
+    Description: Relays an upstream response as-is: its status code, content type and raw body bytes, which are neither decoded nor parsed.
+    The body is streamed chunk by chunk as it arrives (a streamed NDJSON result keeps flowing row batch by row batch), and the upstream
+    connection goes back to the shared session's pool (and stops counting as active) once the relayed response is closed.
+    Inputs: response (requests.Response) - An upstream response opened with `stream=True`.
+    Outputs: Flask Response relaying the upstream response.
+    '''
+    def relay(self, response):
+        relayed = Response(response.raw.stream(RELAY_CHUNK_SIZE, decode_content=False), status=response.status_code,
+                           content_type=response.headers.get("Content-Type"), headers=relayed_headers(response))
+        relayed.call_on_close(response.close)
+        relayed.call_on_close(lambda: self.track_connection(-1))
+        return relayed
+
+'''
+Description: Picks the upstream response headers that must reach the client, such as the session token returned by a WRITE.
+Inputs: response (requests.Response) - The upstream response.
+Outputs: dict - The headers to set on the relayed response.
+'''
+def relayed_headers(response):
+    return {name: response.headers[name] for name in RELAYED_HEADERS if name in response.headers}
+
+'''
+Description: Returns the keyword arguments of a call to the upstream that forward the raw body of the current request with its content type,
+so that it is not re-encoded on the way.
+Outputs: dict - The 'data' and 'headers' arguments.
+'''
+def raw_body():
+    return {"data": request.get_data(), "headers": {"Content-Type": request.content_type or "application/json"}}
+
+'''
+Description: Serves an app with Flask's development server or, when `SERVER_MODE` is 'production', with a pre-fork gunicorn server
+of `SERVER_WORKERS` processes running `SERVER_THREADS` threads each. In production, every worker process runs `on_worker_start` right after
+it is forked, so that threads, pools and other per-process state are created in the process that uses them; in development it runs once,
+before serving. SIGHUP to the gunicorn master replaces the workers gracefully: new workers start while the old ones finish their requests,
+for up to `SERVER_GRACEFUL_TIMEOUT` seconds.
+Inputs:
+    app (flask.Flask) - The app of the service.
+    port (int) - The port to listen on.
+    on_worker_start (function, optional) - Called in every serving process before it handles requests.
+'''
+def serve(app, port: int, on_worker_start=None):
+    if server_mode != "production":
+        if on_worker_start:
+            on_worker_start()
+        app.run(host="0.0.0.0", port=port)
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"0.0.0.0:{port}")
+            self.cfg.set("workers", server_workers)
+            self.cfg.set("threads", server_threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("timeout", server_timeout)
+            self.cfg.set("graceful_timeout", server_graceful_timeout)
+            self.cfg.set("keepalive", server_keepalive)
+            if on_worker_start:
+                self.cfg.set("post_fork", lambda server, worker: on_worker_start())
+
+        def load(self):
+            return app
+
+    ProductionServer().run()
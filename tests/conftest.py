@@ -0,0 +1,65 @@
+"""
+Shared fixtures of the test suite. The services read their configuration from the environment when they are imported, so they are
+imported once per test session: the environment below is set first, and the `cluster` fixture starts the local topology of
+`local_cluster.py` (two workers per shard, two shards with the `rental` table sharded by `customer_id`) on free loopback ports.
+"""
+
+import os
+import socket
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+'''
+Description: Returns a loopback port no server is listening on.
+'''
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+GATEKEEPER_PORT, TRUSTED_HOST_PORT, PROXY_PORT = free_port(), free_port(), free_port()
+
+os.environ.update({
+    "TRUSTED_HOST_URL": f"http://127.0.0.1:{TRUSTED_HOST_PORT}",
+    "PROXY_URL": f"http://127.0.0.1:{PROXY_PORT}",
+    "REPLICA_STATUS_INTERVAL": "0.1",
+    "LATENCY_PROBE_INTERVAL": "0.1",
+    "REQUEST_LOG_SAMPLE_RATE": "0",
+})
+
+@pytest.fixture(scope="session")
+def cluster():
+    import local_cluster
+    backend, modules = local_cluster.start_cluster(2, ports=(GATEKEEPER_PORT, TRUSTED_HOST_PORT, PROXY_PORT), rentals=1000, shards=2)
+    return types.SimpleNamespace(backend=backend, **modules)
+
+'''
+Description: The stand-in backend of the session's cluster, with every node restored to no latency, no failures and up after the test.
+'''
+@pytest.fixture
+def backend(cluster):
+    yield cluster.backend
+    for node in cluster.backend.nodes.values():
+        node.latency = 0.0
+        node.failure_rate = 0.0
+        node.down = False
+
+'''
+Description: A Flask test client of the proxy of the session's cluster. The test client handles requests on the test's thread, so the deadline
+the last request set there is cleared afterwards, for the queries the test runs directly.
+'''
+@pytest.fixture
+def proxy_client(cluster):
+    yield cluster.proxy.app.test_client()
+    cluster.proxy.set_deadline(None)
+
+'''
+Description: The URL of the gatekeeper of the session's cluster, as the benchmark posts queries to it.
+'''
+@pytest.fixture
+def gatekeeper_url(cluster):
+    return f"http://127.0.0.1:{GATEKEEPER_PORT}/"
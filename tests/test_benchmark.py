@@ -0,0 +1,26 @@
+import pytest
+
+import benchmark
+
+def test_percentiles_have_a_bounded_relative_error():
+    histogram = benchmark.LatencyHistogram()
+    for millis in range(1, 1001):
+        histogram.record(millis / 1000)
+    assert histogram.percentile(50) == pytest.approx(0.500, rel=0.025)
+    assert histogram.percentile(99) == pytest.approx(0.990, rel=0.025)
+    summary = histogram.summary()
+    assert (summary["count"], summary["min_ms"], summary["max_ms"]) == (1000, 1.0, 1000.0)
+    assert benchmark.LatencyHistogram().summary() == {"count": 0}
+
+def test_closed_loop_run_through_the_gatekeeper(gatekeeper_url):
+    result = benchmark.load_test(gatekeeper_url, "p2c", 40, 0.25, 4)
+    assert result["requests"] == result["reads"] + result["writes"] == 40
+    assert result["errors"] == {"READ": 0, "WRITE": 0}
+    assert result["status_codes"] == {"200": 40}
+    assert result["latency"]["all"]["count"] == 40
+
+def test_open_loop_run_keeps_the_target_rate(gatekeeper_url):
+    result = benchmark.load_test(gatekeeper_url, "random", 20, 0.5, 4, qps=100, parameterized=True)
+    assert result["requests"] == 20
+    assert result["errors"] == {"READ": 0, "WRITE": 0}
+    assert result["duration_s"] >= 0.19
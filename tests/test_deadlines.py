@@ -0,0 +1,30 @@
+import time
+
+# Runs for seconds on SQLite, until it is killed
+RUNAWAY = "SELECT count(*) FROM actor a, actor b, actor c, actor d"
+
+def exceeded(proxy, stage):
+    return proxy.deadline_exceeded._series.get((stage,), 0)
+
+def test_runaway_query_is_killed_at_its_deadline(cluster, proxy_client):
+    proxy = cluster.proxy
+    killed = exceeded(proxy, "query")
+    start = time.monotonic()
+    response = proxy_client.post("/query", json={"query": RUNAWAY, "query_type": "READ"}, headers={"X-Request-Budget-Ms": "150"})
+    assert (response.status_code, response.json) == (504, {"error": "Deadline exceeded"})
+    assert time.monotonic() - start < 1.5
+    assert exceeded(proxy, "query") == killed + 1
+    response = proxy_client.post("/query", json={"query": "SELECT count(*) FROM actor WHERE actor_id <= 4", "query_type": "READ"})
+    assert response.json == [[4]]
+
+def test_spent_budget_is_answered_on_arrival(cluster, proxy_client):
+    arrivals = exceeded(cluster.proxy, "arrival")
+    response = proxy_client.post("/query", json={"query": "SELECT 1", "query_type": "READ"}, headers={"X-Request-Budget-Ms": "0"})
+    assert response.status_code == 504
+    assert exceeded(cluster.proxy, "arrival") == arrivals + 1
+
+def test_budget_set_at_the_gatekeeper_bounds_every_hop(cluster):
+    start = time.monotonic()
+    response = cluster.gatekeeper.app.test_client().post("/", json={"query": RUNAWAY, "query_type": "READ"}, headers={"X-Request-Budget-Ms": "300"})
+    assert response.status_code == 504
+    assert time.monotonic() - start < 1.5
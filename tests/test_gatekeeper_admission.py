@@ -0,0 +1,53 @@
+import threading
+import time
+
+import gatekeeper
+
+def test_full_queue_and_deadline_turn_requests_away():
+    limiter = gatekeeper.ConcurrencyLimiter(1, 1, 5)
+    assert limiter.acquire() is None
+    assert limiter.acquire(time.monotonic() + 0.01) == "deadline_exceeded"
+    waiter = threading.Thread(target=limiter.acquire, args=(time.monotonic() + 0.2,))
+    waiter.start()
+    time.sleep(0.05)
+    assert limiter.acquire() == "queue_full"
+    waiter.join()
+
+def test_released_slot_reaches_a_waiter_still_in_the_queue():
+    limiter = gatekeeper.ConcurrencyLimiter(1, 5, 5)
+    assert limiter.acquire() is None
+    outcomes = {}
+    def wait(name, deadline):
+        outcomes[name] = limiter.acquire(deadline)
+    short = threading.Thread(target=wait, args=("short", time.monotonic() + 0.05))
+    patient = threading.Thread(target=wait, args=("patient", time.monotonic() + 5))
+    short.start()
+    patient.start()
+    short.join()
+    assert outcomes["short"] == "deadline_exceeded"
+    start = time.monotonic()
+    limiter.release()
+    patient.join(1)
+    assert outcomes.get("patient", "waiting") is None
+    assert time.monotonic() - start < 0.5
+    assert (limiter.active, limiter.waiting) == (1, 0)
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = gatekeeper.TokenBucket(10, 2)
+    assert (bucket.take(), bucket.take()) == (0.0, 0.0)
+    assert 0.05 < bucket.take() <= 0.1
+    assert bucket.take(5) > 0.1
+    time.sleep(0.1)
+    assert bucket.take() == 0.0
+
+def test_write_storm_does_not_starve_reads(cluster, monkeypatch):
+    monkeypatch.setitem(cluster.gatekeeper.global_buckets, "WRITE", gatekeeper.TokenBucket(0.5, 1))
+    client = cluster.gatekeeper.app.test_client()
+    write = {"query": "UPDATE actor SET last_update = CURRENT_TIMESTAMP WHERE actor_id = 11", "query_type": "WRITE"}
+    assert client.post("/", json=write).status_code == 200
+    limited = client.post("/", json=write)
+    assert limited.status_code == 429
+    assert limited.headers["Retry-After"] == "2"
+    assert client.post("/query/batch", json={"queries": [write]}).status_code == 429
+    for _ in range(5):
+        assert client.post("/", json={"query": "SELECT 1", "query_type": "READ"}).status_code == 200
@@ -0,0 +1,61 @@
+import logging
+import time
+
+import pytest
+
+import gatekeeper
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+@pytest.fixture
+def handler():
+    logger = logging.getLogger("test_gatekeeper_logging")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.addHandler(handler)
+    yield handler
+    logger.removeHandler(handler)
+
+def new_log(handler, sample_rate, max_payload=10, queue_size=100):
+    return gatekeeper.AsyncRequestLog(logging.getLogger("test_gatekeeper_logging"), sample_rate, max_payload, queue_size, 10)
+
+def wait_for_messages(handler, count):
+    deadline = time.monotonic() + 2
+    while len(handler.messages) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return handler.messages
+
+def test_sampled_out_requests_still_log_warnings(handler):
+    log = new_log(handler, 0)
+    with gatekeeper.app.test_request_context():
+        gatekeeper.g.request_id = "r1"
+        log.log(logging.INFO, "Received data", {"query": "SELECT 1"})
+        log.log(logging.WARNING, "Query rejected", "denied table")
+    assert wait_for_messages(handler, 1) == ["[r1] Query rejected: denied tab... (12 characters)"]
+
+def test_payloads_are_formatted_and_truncated_off_the_request_thread(handler):
+    log = new_log(handler, 1)
+    with gatekeeper.app.test_request_context():
+        log.log(logging.INFO, "Received data", "x" * 11)
+        log.log(logging.INFO, "Response from trusted host", 200)
+    assert wait_for_messages(handler, 2) == ["Received data: xxxxxxxxxx... (11 characters)", "Response from trusted host: 200"]
+
+def test_full_queue_drops_records(handler, monkeypatch):
+    log = new_log(handler, 1, queue_size=2)
+    monkeypatch.setattr(log, "_ensure_started", lambda: None)
+    dropped = gatekeeper.request_log_dropped._series.get((), 0)
+    with gatekeeper.app.test_request_context():
+        for i in range(3):
+            log.log(logging.INFO, f"record {i}")
+    assert log.pending() == 2
+    assert gatekeeper.request_log_dropped._series.get((), 0) == dropped + 1
+    monkeypatch.undo()
+    log._ensure_started()
+    assert wait_for_messages(handler, 2) == ["record 0", "record 1"]
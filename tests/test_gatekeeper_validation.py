@@ -0,0 +1,82 @@
+import pytest
+
+import gatekeeper
+
+DENIED = {"mysql.*", "information_schema.*", "performance_schema.*", "sys.*"}
+
+@pytest.fixture
+def validator():
+    return gatekeeper.QueryValidator({"select", "insert", "update", "delete", "replace"}, set(), DENIED, False, 100)
+
+def check(validator, query, query_type="READ"):
+    return validator.check(gatekeeper.fingerprint(query), query_type)
+
+def test_fingerprint_replaces_literals_and_lists():
+    assert gatekeeper.fingerprint("SELECT * FROM actor WHERE actor_id IN (1, 2, 3) AND last_name = 'O''Hara'") == \
+        "select * from actor where actor_id in (?+) and last_name = ?"
+    assert gatekeeper.fingerprint("INSERT INTO actor (first_name) VALUES ('a'), ('b')") == "insert into actor (first_name) values (?)+"
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM actor a JOIN film_actor fa USING (actor_id) WHERE a.actor_id IN (1, 2)",
+    "SELECT count(*) FROM actor a, (SELECT actor_id FROM film_actor) t WHERE a.actor_id = t.actor_id",
+    "SELECT '/*!', 'mysql.user' FROM actor",
+    "SELECT * FROM actor -- , mysql.user",
+])
+def test_allows_ordinary_reads(validator, query):
+    assert check(validator, query) is None
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM mysql.user",
+    "SELECT * FROM `mysql`.`user`",
+    "SELECT * FROM actor STRAIGHT_JOIN mysql.user",
+    "SELECT * FROM actor a, (mysql.user)",
+    "SELECT * FROM actor a, (film f JOIN mysql.user u ON 1 = 1)",
+    "SELECT * FROM actor a JOIN film f ON a.actor_id = f.film_id, mysql.user",
+    "SELECT * FROM (SELECT * FROM actor) t, mysql.user",
+    "SELECT * FROM actor WHERE actor_id IN (SELECT 1 FROM mysql.user)",
+])
+def test_rejects_denied_tables(validator, query):
+    assert check(validator, query) == "table mysql.user is not allowed"
+
+@pytest.mark.parametrize("query", ["SELECT * FROM actor /*!, mysql.user */", "SELECT /*+ MAX_EXECUTION_TIME(1) */ * FROM actor"])
+def test_rejects_executable_comments(validator, query):
+    assert check(validator, query) == "executable comments and optimizer hints are not allowed"
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM actor INTO OUTFILE '/tmp/actor.csv'",
+    "SELECT * FROM actor INTO DUMPFILE '/tmp/actor.bin'",
+    "SELECT load_file('/etc/passwd')",
+])
+def test_rejects_file_access(validator, query):
+    assert check(validator, query) == "reading or writing server files is not allowed"
+
+def test_rejects_multi_statements_and_mismatched_types(validator):
+    assert check(validator, "SELECT 1 FROM actor; DELETE FROM actor") == "multiple statements"
+    assert check(validator, "DELETE FROM actor WHERE actor_id = 1") == "DELETE is not a READ statement"
+    assert check(validator, "SELECT * FROM actor", "WRITE") == "SELECT is not a WRITE statement"
+    assert check(validator, "DROP TABLE actor", "WRITE") == "DROP statements are not allowed"
+
+def test_multi_table_update_checks_every_table(validator):
+    assert check(validator, "UPDATE actor a, mysql.user u SET a.first_name = u.user", "WRITE") == "table mysql.user is not allowed"
+
+def test_allowed_tables(validator):
+    allow_list = gatekeeper.QueryValidator({"select"}, {"actor", "film_actor"}, set(), False, 100)
+    assert check(allow_list, "SELECT * FROM actor a JOIN film_actor fa USING (actor_id)") is None
+    assert check(allow_list, "SELECT * FROM actor a, (film f)") == "table film is not allowed"
+
+def test_verdicts_are_cached_per_fingerprint(validator):
+    assert validator.validate("SELECT * FROM actor WHERE actor_id = 1", "READ") is None
+    assert validator.validate("SELECT * FROM actor WHERE actor_id = 2", "READ") is None
+    assert len(validator._verdicts) == 1
+
+def test_rejected_queries_are_not_forwarded(cluster):
+    client = cluster.gatekeeper.app.test_client()
+    response = client.post("/", json={"query": "SELECT * FROM mysql.user", "query_type": "READ"})
+    assert response.status_code == 403
+    assert response.json == {"error": "Query rejected: table mysql.user is not allowed"}
+    assert "gatekeeper_upstream" not in response.headers["Server-Timing"]
+    response = client.post("/query/batch", json={"queries": [
+        {"query": "SELECT 1", "query_type": "READ"},
+        {"query": "DELETE FROM actor; DROP TABLE actor", "query_type": "WRITE"},
+    ]})
+    assert response.status_code == 403
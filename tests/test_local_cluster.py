@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+from mysql.connector import errors
+
+import local_cluster
+
+@pytest.fixture
+def local_backend(tmp_path):
+    path = str(tmp_path / "sakila.db")
+    local_cluster.create_schema(path, 10)
+    backend = local_cluster.LocalBackend(path)
+    backend.add_node("manager")
+    return backend
+
+def master_position(conn):
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SHOW MASTER STATUS")
+    return cursor.fetchone()["Position"]
+
+def test_binlog_position_follows_committed_writes(local_backend):
+    conn = local_backend.connect("manager", 3306)
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO actor (first_name, last_name) VALUES (%s, %s)", ["A", "B"])
+    assert master_position(conn) == 1
+    conn.start_transaction()
+    cursor.execute("UPDATE actor SET first_name = 'C' WHERE actor_id <= 2")
+    cursor.execute("DELETE FROM actor WHERE actor_id = 3")
+    assert master_position(conn) == 1
+    conn.commit()
+    assert master_position(conn) == 3
+    conn.start_transaction()
+    cursor.execute("DELETE FROM actor")
+    conn.rollback()
+    cursor.execute("SELECT count(*) FROM actor")
+    assert (cursor.fetchall(), master_position(conn)) == ([(200,)], 3)
+
+def test_injected_failures(local_backend):
+    node = local_backend.nodes["manager"]
+    conn = local_backend.connect("manager", 3306)
+    node.failure_rate = 1.0
+    with pytest.raises(errors.OperationalError):
+        conn.cursor().execute("SELECT 1")
+    assert not conn.is_connected()
+    node.failure_rate = 0.0
+    with pytest.raises(errors.ProgrammingError):
+        local_backend.connect("manager", 3306).cursor().execute("SELECT * FROM film")
+    node.down = True
+    assert local_backend.connect("manager", 3306) is None
+    assert local_backend.connect("unknown", 3306) is None
+
+def test_kill_query_interrupts_a_slow_statement(local_backend):
+    slow = local_backend.connect("manager", 3306)
+    admin = local_backend.connect("manager", 3306)
+    local_backend.nodes["manager"].latency = 5.0
+    outcome = {}
+    def run():
+        try:
+            slow.cursor().execute("SELECT count(*) FROM rental")
+        except errors.DatabaseError as e:
+            outcome["errno"] = e.errno
+    thread = threading.Thread(target=run)
+    start = time.monotonic()
+    thread.start()
+    time.sleep(0.05)
+    local_backend.nodes["manager"].latency = 0.0
+    admin.cursor().execute(f"KILL QUERY {slow.connection_id}")
+    thread.join(2)
+    assert outcome == {"errno": 1317}
+    assert time.monotonic() - start < 1
+    assert slow.is_connected()
@@ -0,0 +1,59 @@
+import json
+import threading
+import time
+
+import pytest
+
+import local_aws
+import provisioning
+
+def test_steps_start_once_their_dependencies_completed():
+    plan = provisioning.ProvisioningPlan()
+    # Both steps only complete if they run at the same time
+    barrier = threading.Barrier(2, timeout=2)
+    def concurrent(result):
+        def step(results):
+            barrier.wait()
+            return result
+        return step
+    def manager(results):
+        time.sleep(0.05)
+        return "10.0.0.1"
+    plan.add("manager", manager)
+    plan.add("security_group", concurrent("sg-1"))
+    plan.add("key_pair", concurrent("key"))
+    plan.add("worker", lambda results: f"replica of {results['manager']} in {results['security_group']}", ["manager", "security_group"])
+    results = plan.run()
+    assert results["worker"] == "replica of 10.0.0.1 in sg-1"
+    assert plan.timings["worker"][0] >= plan.timings["manager"][1]
+    with pytest.raises(ValueError):
+        plan.add("gatekeeper", lambda results: None, ["trusted_host"])
+
+def test_a_failed_step_stops_the_plan():
+    plan = provisioning.ProvisioningPlan()
+    ran = []
+    def fail(results):
+        raise RuntimeError("launch failed")
+    plan.add("manager", fail)
+    plan.add("worker", lambda results: ran.append("worker"), ["manager"])
+    with pytest.raises(RuntimeError, match="launch failed"):
+        plan.run()
+    assert ran == []
+
+def test_parallel_plan_is_faster_and_exports_the_same_cluster():
+    sequential, _, sequential_path = local_aws.provision(True, 2, 0.001)
+    parallel, aws, parallel_path = local_aws.provision(False, 2, 0.001)
+    assert parallel < 0.6 * sequential
+    with open(sequential_path) as file:
+        expected = json.load(file)
+    with open(parallel_path) as file:
+        cluster = json.load(file)
+    assert cluster.keys() == expected.keys()
+    assert len(cluster["worker_ips"]) == 2
+
+def test_every_shard_gets_its_replication_group():
+    _, aws, path = local_aws.provision(False, 1, 0.001, shards=2)
+    with open(path) as file:
+        cluster = json.load(file)
+    assert set(cluster["shard_map"]["shards"]) == {"default", "shard_2"}
+    assert len(aws.pruned) == 2
@@ -0,0 +1,40 @@
+def test_consecutive_single_row_inserts_are_merged(cluster):
+    queries = [
+        "INSERT INTO actor (first_name, last_name) VALUES ('A', 'B')",
+        "INSERT INTO `actor` (first_name, last_name) VALUES ('C', 'D');",
+        "UPDATE actor SET first_name = 'E' WHERE actor_id = 1",
+        "INSERT INTO actor (first_name, last_name) VALUES ('F', 'G')",
+        "INSERT INTO actor (first_name, last_name) VALUES (%s, %s)",
+    ]
+    assert cluster.proxy.coalesce_writes(queries, [None, None, None, None, ["H", "I"]]) == [
+        ("INSERT INTO actor (first_name, last_name) VALUES ('A', 'B'), ('C', 'D')", [0, 1]),
+        (queries[2], [2]),
+        (queries[3], [3]),
+        (queries[4], [4]),
+    ]
+
+def test_write_batch_isolates_the_failing_row(cluster):
+    proxy = cluster.proxy
+    results = proxy.run_write_batch([
+        "INSERT INTO actor (first_name, last_name) VALUES ('ROW1', 'BATCHED')",
+        "INSERT INTO actor (first_name, last_name) VALUES (NULL, 'BATCHED')",
+        "INSERT INTO actor (first_name, last_name) VALUES ('ROW3', 'BATCHED')",
+    ])
+    assert results[0] == [] and results[2] == []
+    assert "error" in results[1]
+    rows = proxy.run_query(proxy.manager, "SELECT first_name FROM actor WHERE last_name = 'BATCHED' ORDER BY actor_id")
+    assert [row[0] for row in rows] == ["ROW1", "ROW3"]
+
+def test_batch_results_keep_the_request_order(proxy_client):
+    response = proxy_client.post("/query/batch", json={"queries": [
+        {"query": "SELECT count(*) FROM actor WHERE actor_id <= 3", "query_type": "READ"},
+        {"query": "SELECT first_name FROM actor WHERE actor_id = %s", "query_type": "READ", "params": [2], "mode": "p2c"},
+        {"query": "SELECT 1", "query_type": "DELETE"},
+        {"query": "SELECT * FROM rental", "query_type": "READ"},
+    ]})
+    assert response.status_code == 200
+    results = response.json
+    assert results[0] == [[3]]
+    assert results[1] == [["NAME1"]]
+    assert results[2] == {"error": "Unknown query type"}
+    assert "sharded" in results[3]["error"]
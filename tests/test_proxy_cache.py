@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+@pytest.fixture
+def caching(cluster, monkeypatch):
+    monkeypatch.setattr(cluster.proxy, "result_cache_enabled", True)
+    return cluster.proxy
+
+def query(client, query, query_type="READ"):
+    return client.post("/query", json={"query": query, "query_type": query_type})
+
+def test_reads_are_served_from_the_cache_until_a_write(caching, proxy_client):
+    read = "SELECT count(*) FROM actor WHERE last_name = 'CACHED'"
+    first = query(proxy_client, read)
+    assert first.headers["X-Backend"] != "cache"
+    second = query(proxy_client, read)
+    assert second.headers["X-Backend"] == "cache"
+    assert second.json == first.json
+
+    assert query(proxy_client, "INSERT INTO actor (first_name, last_name) VALUES ('READ', 'CACHED')", "WRITE").status_code == 200
+    third = query(proxy_client, read)
+    assert third.headers["X-Backend"] != "cache"
+    assert third.json == [[first.json[0][0] + 1]]
+
+def test_expired_and_overtaken_results_are_not_cached(cluster):
+    cache = cluster.proxy.ResultCache(10, 0)
+    cache.put("key", [(1,)], {"actor"}, cache.versions({"actor"}))
+    assert cache.get("key") is None
+
+    cache = cluster.proxy.ResultCache(10, 60)
+    versions = cache.versions({"actor"})
+    cache.invalidate({"actor"})
+    cache.put("key", [(1,)], {"actor"}, versions)
+    assert cache.get("key") is None
+
+def test_the_cache_is_off_with_several_server_processes():
+    env = dict(os.environ, SERVER_MODE="production", SERVER_WORKERS="2", RESULT_CACHE_ENABLED="true")
+    output = subprocess.run([sys.executable, "-c", "import proxy; print(proxy.result_cache_enabled)"], env=env, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), timeout=60).stdout
+    assert output.strip().splitlines()[-1] == "False"
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+def submit_all(committer, queries):
+    results = [None] * len(queries)
+    barrier = threading.Barrier(len(queries))
+    def submit(index):
+        barrier.wait()
+        results[index] = committer.submit(queries[index])
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(len(queries))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+def test_concurrent_writes_share_one_commit(cluster):
+    proxy = cluster.proxy
+    committer = proxy.GroupCommitter(0.2, 64)
+    queries = [f"INSERT INTO actor (first_name, last_name) VALUES ('ROW{i}', 'GROUPED')" for i in range(6)]
+    queries.append("INSERT INTO actor (first_name, last_name) VALUES (NULL, 'GROUPED')")
+    results = submit_all(committer, queries)
+    assert results[:6] == [[]] * 6
+    assert "error" in results[6]
+    stats = committer.stats()
+    assert (stats["batches"], stats["writes"], stats["batch_size_histogram"]) == (1, 7, {"le_8": 1})
+    assert proxy.run_query(proxy.manager, "SELECT count(*) FROM actor WHERE last_name = 'GROUPED'") == [(6,)]
+
+def test_groups_are_capped_at_max_batch(cluster):
+    committer = cluster.proxy.GroupCommitter(0.2, 2)
+    results = submit_all(committer, [f"UPDATE actor SET last_update = CURRENT_TIMESTAMP WHERE actor_id = {i}" for i in range(1, 6)])
+    assert results == [[]] * 5
+    stats = committer.stats()
+    assert (stats["batches"], stats["writes"]) == (3, 5)
+
+def test_writes_give_up_at_their_deadline(cluster):
+    proxy = cluster.proxy
+    committer = proxy.GroupCommitter(0.01, 64)
+    # Runs for seconds on SQLite, until it is killed
+    runaway = "UPDATE actor SET last_update = CURRENT_TIMESTAMP WHERE actor_id = (SELECT count(*) FROM actor a, actor b, actor c, actor d)"
+    start = time.monotonic()
+    proxy.set_deadline(start + 0.1)
+    try:
+        with pytest.raises(proxy.DeadlineExceeded):
+            committer.submit(runaway)
+    finally:
+        proxy.set_deadline(None)
+    assert time.monotonic() - start < 0.3
+    deadline = time.monotonic() + 2
+    while committer.stats()["batches"] == 0:
+        assert time.monotonic() < deadline, "the group was not killed at its deadline"
+        time.sleep(0.01)
+    assert committer.submit("UPDATE actor SET last_update = CURRENT_TIMESTAMP WHERE actor_id = 1") == []
+
+def test_expired_writes_are_dropped_from_their_group(cluster):
+    proxy = cluster.proxy
+    committer = proxy.GroupCommitter(0.2, 64)
+    item = {"query": "DELETE FROM actor", "params": None, "deadline": time.monotonic() - 1, "done": threading.Event(), "result": None}
+    committer._queue.put(item)
+    committer._ensure_started()
+    assert item["done"].wait(2)
+    assert item["result"] == {"error": "Deadline exceeded"}
+    assert committer.stats()["batches"] == 0
+    assert proxy.run_query(proxy.manager, "SELECT count(*) FROM actor")[0][0] > 0
@@ -0,0 +1,72 @@
+import sqlite3
+import time
+
+import pytest
+
+@pytest.fixture
+def hedging(cluster, backend, monkeypatch):
+    proxy = cluster.proxy
+    monkeypatch.setattr(proxy, "hedge_enabled", True)
+    monkeypatch.setattr(proxy.hedge_latency, "delay", lambda fingerprint: 0.02)
+    monkeypatch.setattr(proxy.hedge_budget, "withdraw", lambda: True)
+    return proxy
+
+def rentals(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT count(*) FROM rental").fetchone()[0]
+    finally:
+        conn.close()
+
+def test_hedge_wins_over_a_slow_worker(hedging, backend):
+    slow, fast = hedging.workers
+    expected = hedging.run_query(fast, "SELECT count(*) FROM actor")
+    hedging.run_query(slow, "SELECT 1")
+    backend.nodes[slow["host"]].latency = 1.0
+    won = hedging.hedged_reads._series.get(("won",), 0)
+    start = time.perf_counter()
+    assert hedging.hedged_read(slow, "SELECT count(*) FROM actor", "random") == expected
+    assert time.perf_counter() - start < 0.5
+    assert hedging.hedged_reads._series.get(("won",), 0) == won + 1
+
+def test_hedges_stay_in_the_shard(hedging, backend, cluster):
+    group = hedging.shard_groups["shard_2"]["workers"]
+    slow = group[0]
+    hedging.run_query(slow, "SELECT 1")
+    backend.nodes[slow["host"]].latency = 1.0
+    result = hedging.hedged_read(slow, "SELECT count(*) FROM rental", "random", group=group)
+    assert result == [(rentals(backend.nodes["shard2-manager"].path),)]
+    assert result != [(rentals(backend.nodes["manager"].path),)]
+
+def test_fast_reads_are_not_hedged(hedging):
+    sent = hedging.hedged_reads._series.get(("sent",), 0)
+    worker = hedging.workers[0]
+    assert hedging.hedged_read(worker, "SELECT 1", "random") == [(1,)]
+    time.sleep(0.05)
+    assert hedging.hedged_reads._series.get(("sent",), 0) == sent
+
+def test_cancelled_queries_keep_their_connection(cluster):
+    proxy = cluster.proxy
+    node = proxy.workers[0]
+    pool = proxy.get_pool(node)
+    proxy.run_query(node, "SELECT 1")
+    scope = proxy.CancelScope()
+    scope.cancel()
+    checkouts, closed = pool.checkouts, pool.closed
+    proxy.cancel_scopes.value = scope
+    try:
+        with pytest.raises(proxy.QueryCancelled):
+            proxy.run_query(node, "SELECT 1")
+    finally:
+        proxy.cancel_scopes.value = None
+    assert (pool.checkouts, pool.closed) == (checkouts, closed)
+
+    with pytest.raises(proxy.QueryCancelled):
+        with pool.connection() as conn:
+            proxy.cancel_scopes.value = scope
+            try:
+                with proxy.deadline_guard(conn, node):
+                    pass
+            finally:
+                proxy.cancel_scopes.value = None
+    assert pool.closed == closed
@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+
+import pytest
+
+@pytest.fixture
+def extra_node(cluster, backend, proxy_client):
+    node = backend.nodes.get("worker3") or backend.add_node("worker3")
+    yield node
+    if cluster.proxy.find_worker(cluster.proxy.workers, "worker3"):
+        proxy_client.delete("/admin/workers/worker3?timeout=0")
+
+def keys(proxy, nodes):
+    return {proxy.node_key(node) for node in nodes}
+
+def test_workers_are_added_drained_and_removed(cluster, extra_node, proxy_client, monkeypatch, tmp_path):
+    proxy = cluster.proxy
+    monkeypatch.setattr(proxy, "workers_file", str(tmp_path / "workers.json"))
+    response = proxy_client.post("/admin/workers", json={"host": "worker3", "weight": 2})
+    assert response.status_code == 201
+    assert response.json["worker"] == "worker3:3306" and response.json["weight"] == 2.0
+    assert "worker3:3306" in {entry["worker"] for entry in proxy_client.get("/admin/workers").json}
+    assert "worker3:3306" in {proxy.node_key(proxy.pick_worker("random")) for _ in range(100)}
+    with open(tmp_path / "workers.json") as file:
+        assert {"host": "worker3", "port": 3306, "weight": 2.0, "draining": False} in json.load(file)
+
+    assert proxy_client.post("/admin/workers/worker3/drain").json["draining"] is True
+    assert "worker3:3306" not in keys(proxy, proxy.fresh_workers())
+    assert "worker3:3306" in keys(proxy, proxy.workers)
+
+    response = proxy_client.delete("/admin/workers/worker3:3306")
+    assert response.json == {"worker": "worker3:3306", "drained": True}
+    assert "worker3:3306" not in keys(proxy, proxy.workers)
+    assert "worker3:3306" not in proxy.pools and "worker3:3306" not in proxy.breakers
+
+def test_removal_waits_for_queries_in_flight(cluster, extra_node, proxy_client):
+    proxy = cluster.proxy
+    proxy_client.post("/admin/workers", json={"host": "worker3"})
+    worker = proxy.find_worker(proxy.workers, "worker3")
+    proxy.run_query(worker, "SELECT 1")
+    extra_node.latency = 0.3
+    outcome = {}
+    query = threading.Thread(target=lambda: outcome.update(rows=proxy.run_query(worker, "SELECT count(*) FROM actor WHERE actor_id <= 2")))
+    query.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    response = proxy_client.delete("/admin/workers/worker3")
+    query.join()
+    assert response.json["drained"] is True
+    assert time.monotonic() - start >= 0.2
+    assert outcome["rows"] == [(2,)]
+
+def test_unknown_workers_and_bad_requests(proxy_client):
+    assert proxy_client.post("/admin/workers/nowhere/drain").status_code == 404
+    assert proxy_client.delete("/admin/workers/nowhere:3307").status_code == 404
+    assert proxy_client.post("/admin/workers", json={"host": "worker3", "weight": 0}).status_code == 400
+    assert proxy_client.post("/admin/workers", json={"port": 3306}).status_code == 400
@@ -0,0 +1,55 @@
+import threading
+import time
+
+import pytest
+
+def new_pool(proxy, host="worker1", max_size=2, checkout_timeout=0.05, ping_interval=60, breaker=None):
+    return proxy.ConnectionPool(host, 3306, 0, max_size, 300, checkout_timeout, ping_interval, breaker)
+
+def test_connections_are_reused(cluster):
+    pool = new_pool(cluster.proxy)
+    for _ in range(5):
+        with pool.connection() as conn:
+            conn.cursor().execute("SELECT 1")
+    assert (pool.created, pool.checkouts) == (1, 5)
+
+def test_exhausted_pool_times_out(cluster):
+    pool = new_pool(cluster.proxy, max_size=1)
+    with pool.connection():
+        with pytest.raises(cluster.proxy.PoolError):
+            pool.acquire()
+    assert (pool.exhausted, pool.timeouts) == (1, 1)
+    with pool.connection():
+        pass
+    assert pool.created == 1
+
+def test_dead_connections_are_replaced(cluster, backend):
+    pool = new_pool(cluster.proxy, ping_interval=0)
+    with pool.connection():
+        pass
+    backend.nodes["worker1"].down = True
+    with pytest.raises(cluster.proxy.BackendUnavailable):
+        pool.acquire()
+    assert pool.dead == 1
+    backend.nodes["worker1"].down = False
+    with pool.connection():
+        pass
+    assert pool.created == 2
+
+def test_idle_connections_are_evicted(cluster):
+    pool = cluster.proxy.ConnectionPool("worker1", 3306, 0, 2, 0, 0.05, 60)
+    with pool.connection():
+        pass
+    pool.maintain()
+    assert (pool.evicted, pool.stats()["idle"]) == (1, 0)
+
+def test_connection_opened_while_the_pool_closes_is_not_kept(cluster, backend):
+    pool = cluster.proxy.ConnectionPool("worker1", 3306, 1, 2, 300, 0.05, 60)
+    backend.nodes["worker1"].latency = 0.2
+    maintainer = threading.Thread(target=pool.maintain)
+    maintainer.start()
+    time.sleep(0.05)
+    pool.close()
+    maintainer.join()
+    stats = pool.stats()
+    assert (stats["size"], stats["idle"], pool.created, pool.closed) == (0, 0, 1, 1)
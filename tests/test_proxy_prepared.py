@@ -0,0 +1,40 @@
+import pytest
+from mysql.connector import errors
+
+TEMPLATE = "SELECT first_name FROM actor WHERE actor_id = %s"
+
+@pytest.fixture
+def connection(cluster):
+    pool = cluster.proxy.ConnectionPool("worker1", 3306, 0, 1, 300, 0.05, 60)
+    with pool.connection() as conn:
+        yield conn
+
+def test_template_is_prepared_once_per_connection(cluster, backend, connection):
+    node = backend.nodes["worker1"]
+    prepares, executions = node.prepares, node.prepared_executions
+    names = [cluster.proxy.execute_prepared(connection, TEMPLATE, [actor_id]).fetchall() for actor_id in range(1, 6)]
+    assert names == [[(f"NAME{actor_id - 1}",)] for actor_id in range(1, 6)]
+    assert (node.prepares - prepares, node.prepared_executions - executions) == (1, 5)
+
+def test_least_recently_used_statements_are_evicted(cluster, backend, connection):
+    node = backend.nodes["worker1"]
+    cache = connection.statement_cache = cluster.proxy.StatementCache(2)
+    templates = [TEMPLATE, "SELECT last_name FROM actor WHERE actor_id = %s", "SELECT count(*) FROM actor WHERE actor_id > %s"]
+    prepares = node.prepares
+    for template in templates + templates[2:]:
+        cluster.proxy.execute_prepared(connection, template, [1])
+    assert node.prepares - prepares == 3
+    assert list(cache._statements) == templates[1:]
+    cluster.proxy.execute_prepared(connection, TEMPLATE, [1])
+    assert node.prepares - prepares == 4
+
+def test_failed_templates_are_not_kept(cluster, connection):
+    with pytest.raises(errors.ProgrammingError):
+        cluster.proxy.execute_prepared(connection, "SELECT * FROM film WHERE film_id = %s", [1])
+    assert "SELECT * FROM film WHERE film_id = %s" not in connection.statement_cache._statements
+
+def test_parameterized_queries_over_http(proxy_client):
+    response = proxy_client.post("/query", json={"query": TEMPLATE, "query_type": "READ", "params": [3]})
+    assert response.json == [["NAME2"]]
+    response = proxy_client.post("/query", json={"query": TEMPLATE, "query_type": "READ", "params": [{"id": 3}]})
+    assert response.status_code == 400
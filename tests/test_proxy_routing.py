@@ -0,0 +1,161 @@
+import threading
+import time
+
+import pytest
+
+def query(client, query, query_type="READ", **kwargs):
+    return client.post("/query", json=dict(query=query, query_type=query_type, **kwargs))
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.05)
+
+def test_customized_mode_follows_the_fastest_worker(cluster, backend, proxy_client):
+    proxy = cluster.proxy
+    for slow, fast in (proxy.workers, reversed(proxy.workers)):
+        backend.nodes[slow["host"]].latency = 0.05
+        backend.nodes[fast["host"]].latency = 0.0
+        wait_for(lambda: proxy.fastest_worker is fast)
+        assert proxy.pick_worker("customized") is fast
+        assert query(proxy_client, "SELECT count(*) FROM actor", mode="customized").headers["X-Backend"] == proxy.node_key(fast)
+
+def test_latency_estimate_recovers_from_a_failed_probe(cluster, monkeypatch):
+    proxy = cluster.proxy
+    worker = {"host": "probe-only", "port": 3306}
+    monkeypatch.setattr(proxy, "worker_latency", {})
+    proxy.record_latency(worker, 0.010)
+    proxy.record_latency(worker, 0.020)
+    assert proxy.worker_latency["probe-only:3306"] == proxy.latency_ewma_alpha * 0.020 + (1 - proxy.latency_ewma_alpha) * 0.010
+    proxy.record_latency(worker, float("inf"))
+    assert proxy.worker_latency["probe-only:3306"] == float("inf")
+    proxy.record_latency(worker, 0.030)
+    assert proxy.worker_latency["probe-only:3306"] == 0.030
+
+@pytest.fixture
+def replication(cluster, monkeypatch):
+    proxy = cluster.proxy
+    samples = {}
+    def sample(worker):
+        return dict(samples.get(worker["host"], {"lag": 0.0, "position": None}))
+    monkeypatch.setattr(proxy, "fetch_replica_status", sample)
+    def replicate(**hosts):
+        samples.clear()
+        samples.update(hosts)
+        def applied(worker):
+            status = proxy.replica_status.get(proxy.node_key(worker), {})
+            return (status.get("lag"), status.get("position")) == tuple(sample(worker).values())
+        wait_for(lambda: all(applied(worker) for worker in proxy.workers))
+    yield replicate
+    replicate()
+
+def test_lagging_replicas_are_skipped(cluster, replication, proxy_client):
+    proxy = cluster.proxy
+    lagging, fresh = proxy.workers
+    replication(**{lagging["host"]: {"lag": proxy.replica_lag_budget + 10, "position": None}})
+    assert {proxy.node_key(proxy.pick_worker("random")) for _ in range(20)} == {proxy.node_key(fresh)}
+
+    replication(**{w["host"]: {"lag": None, "position": None} for w in proxy.workers})
+    assert proxy.pick_worker("p2c") is None
+    assert query(proxy_client, "SELECT count(*) FROM actor").headers["X-Backend"] == proxy.node_key(proxy.manager)
+
+def test_session_reads_wait_for_the_write(cluster, replication, proxy_client):
+    proxy = cluster.proxy
+    write = query(proxy_client, "UPDATE actor SET first_name = 'SESSION' WHERE actor_id = 7", "WRITE", session=True)
+    token = write.headers["X-Session-Token"]
+    position = proxy.parse_position(token)
+    assert position is not None and proxy.parse_position(token, "shard_2") is not None
+
+    behind = {"lag": 0.0, "position": (position[0], position[1] - 1)}
+    replication(**{w["host"]: behind for w in proxy.workers})
+    read = query(proxy_client, "SELECT first_name FROM actor WHERE actor_id = 7", session_token=token)
+    assert (read.headers["X-Backend"], read.json) == (proxy.node_key(proxy.manager), [["SESSION"]])
+
+    caught_up = proxy.workers[1]
+    replication(**{proxy.workers[0]["host"]: behind, caught_up["host"]: {"lag": 0.0, "position": position}})
+    read = query(proxy_client, "SELECT first_name FROM actor WHERE actor_id = 7", session_token=token)
+    assert (read.headers["X-Backend"], read.json) == (proxy.node_key(caught_up), [["SESSION"]])
+
+def test_malformed_session_tokens_are_ignored(cluster):
+    proxy = cluster.proxy
+    assert proxy.parse_position("local-bin.000001:120,shard_2@local-bin.000001:40", "shard_2") == ("local-bin.000001", 40)
+    assert proxy.parse_position("local-bin.000001:x") is None
+    assert proxy.parse_position("shard_2@local-bin.000001:40") is None
+    assert proxy.parse_position(None) is None
+
+@pytest.fixture
+def load(cluster, monkeypatch):
+    monkeypatch.setattr(cluster.proxy, "worker_load", {})
+    def set_load(host, inflight, latency=0.01):
+        cluster.proxy.worker_load[f"{host}:3306"] = {"inflight": inflight, "latency": latency}
+    return set_load
+
+def test_p2c_keeps_the_cheaper_worker(cluster, load):
+    proxy = cluster.proxy
+    busy, idle = {"host": "busy", "port": 3306}, {"host": "idle", "port": 3306}
+    load("busy", 3)
+    load("idle", 0)
+    assert all(proxy.power_of_two_choices([busy, idle]) is idle for _ in range(20))
+
+    heavy, light = {"host": "heavy", "port": 3306, "weight": 3.0}, {"host": "light", "port": 3306}
+    load("heavy", 2)
+    load("light", 1)
+    assert all(proxy.power_of_two_choices([heavy, light]) is heavy for _ in range(20))
+    load("heavy", 0, latency=0.5)
+    assert all(proxy.power_of_two_choices([heavy, light]) is light for _ in range(20))
+
+def test_least_outstanding_spreads_over_the_idlest(cluster, load):
+    proxy = cluster.proxy
+    nodes = [{"host": host, "port": 3306} for host in ("a", "b", "c")]
+    load("a", 2)
+    assert {proxy.least_outstanding(nodes)["host"] for _ in range(50)} == {"b", "c"}
+
+def test_in_flight_queries_steer_load_aware_modes(cluster, backend, load):
+    proxy = cluster.proxy
+    busy, idle = proxy.workers
+    backend.nodes[busy["host"]].latency = 0.3
+    threads = [threading.Thread(target=proxy.run_query, args=(busy, "SELECT count(*) FROM actor")) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: proxy.worker_load.get(proxy.node_key(busy), {}).get("inflight", 0) >= 3)
+    assert proxy.pick_worker("least_outstanding") is idle
+    assert proxy.pick_worker("p2c") is idle
+    for thread in threads:
+        thread.join()
+
+def test_breaker_opens_and_is_readmitted_by_a_probe(cluster):
+    breaker = cluster.proxy.CircuitBreaker(2, 0.05)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert (breaker.state, breaker.allows_traffic()) == ("open", False)
+    breaker.probe_passed()
+    assert breaker.state == "open"
+    time.sleep(0.05)
+    breaker.probe_passed()
+    assert (breaker.state, breaker.allows_traffic()) == ("half_open", True)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(0.05)
+    breaker.probe_passed()
+    breaker.record_success()
+    assert breaker.stats()["state"] == "closed"
+    assert (breaker.opened, breaker.failures) == (2, 3)
+
+def test_reads_fail_over_while_a_worker_is_down(cluster, backend, proxy_client, monkeypatch):
+    proxy = cluster.proxy
+    down, up = proxy.workers
+    breaker = proxy.breakers[proxy.node_key(down)]
+    monkeypatch.setattr(breaker, "open_seconds", 0.2)
+    backend.nodes[down["host"]].down = True
+    for _ in range(10):
+        response = query(proxy_client, "SELECT count(*) FROM actor WHERE actor_id <= 5")
+        assert (response.status_code, response.json) == (200, [[5]])
+    wait_for(lambda: breaker.state == "open")
+    assert proxy_client.get("/breakers").json[proxy.node_key(down)]["state"] == "open"
+    assert all(proxy.pick_worker("random") is up for _ in range(20))
+
+    backend.nodes[down["host"]].down = False
+    wait_for(lambda: breaker.state == "closed")
+    assert down in proxy.fresh_workers()
@@ -0,0 +1,117 @@
+import sqlite3
+import zlib
+
+import pytest
+
+def shard_of(cluster, customer_id):
+    return cluster.proxy.shard_for(cluster.proxy.shard_rules['rental'], customer_id)
+
+def shard_path(cluster, shard):
+    node = 'manager' if shard == 'default' else f"shard{shard.split('_')[1]}-manager"
+    return cluster.backend.nodes[node].path
+
+def count(path, query):
+    return fetch(path, query)[0][0]
+
+def fetch(path, query):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(query).fetchall()
+    finally:
+        conn.close()
+
+def query(client, query, query_type='READ', **kwargs):
+    return client.post('/query', json=dict(query=query, query_type=query_type, **kwargs))
+
+def test_rows_are_spread_by_crc32(cluster):
+    for shard in cluster.proxy.shard_groups:
+        owners = list(cluster.proxy.shard_groups)
+        conn = sqlite3.connect(shard_path(cluster, shard))
+        customers = conn.execute("SELECT DISTINCT customer_id FROM rental").fetchall()
+        conn.close()
+        assert customers
+        assert all(owners[zlib.crc32(str(customer).encode()) % len(owners)] == shard for customer, in customers)
+
+def test_shard_targets(cluster):
+    proxy = cluster.proxy
+    assert proxy.shard_targets("SELECT * FROM actor") is None
+    assert proxy.shard_targets("SELECT * FROM rental WHERE customer_id = 5") == [shard_of(cluster, 5)]
+    assert proxy.shard_targets("SELECT * FROM rental WHERE customer_id = %s", [8]) == [shard_of(cluster, 8)]
+    assert proxy.shard_targets("SELECT * FROM rental WHERE customer_id = 5 OR customer_id = 8") == list(proxy.shard_groups)
+    assert proxy.shard_targets("INSERT INTO rental (rental_date, inventory_id, customer_id, staff_id) VALUES ('x', 1, %s, 1)", [5]) == \
+        [shard_of(cluster, 5)]
+    with pytest.raises(proxy.ShardingError):
+        proxy.shard_targets("INSERT INTO rental (rental_date, inventory_id, staff_id) VALUES ('x', 1, 1)")
+    with pytest.raises(proxy.ShardingError):
+        proxy.shard_targets("UPDATE rental SET customer_id = 3 WHERE customer_id = 5")
+    assert shard_of(cluster, 5) != shard_of(cluster, 8)
+    with pytest.raises(proxy.ShardingError):
+        proxy.shard_targets("INSERT INTO rental (rental_date, inventory_id, customer_id, staff_id) VALUES ('x', 1, 5, 1), ('x', 1, 8, 1)")
+
+def test_fanout_merge_plan(cluster):
+    proxy = cluster.proxy
+    assert proxy.fanout_merge_plan("SELECT count(*), max(rental_id) FROM rental") == ('aggregate', ['count', 'max'])
+    assert proxy.fanout_merge_plan("SELECT rental_id FROM rental LIMIT 3") == ('rows', 3)
+    for unsupported in ("SELECT customer_id, count(*) FROM rental GROUP BY customer_id", "SELECT avg(rental_id) FROM rental",
+                        "SELECT rental_id FROM rental ORDER BY rental_id", "SELECT rental_id FROM rental LIMIT 5, 2"):
+        with pytest.raises(proxy.ShardingError):
+            proxy.fanout_merge_plan(unsupported)
+    assert proxy.merge_shard_results(('aggregate', ['count', 'sum', 'min', 'max']), [[(2, 10, 3, 7)], [(3, None, None, None)]]) == [(5, 10, 3, 7)]
+    assert proxy.merge_shard_results(('rows', 3), [[(1,), (2,)], [(3,), (4,)]]) == [(1,), (2,), (3,)]
+
+def test_aggregates_are_merged_across_shards(cluster, proxy_client):
+    paths = [shard_path(cluster, shard) for shard in cluster.proxy.shard_groups]
+    response = query(proxy_client, "SELECT count(*), min(rental_id), max(rental_id) FROM rental")
+    assert response.status_code == 200
+    assert response.json == [[sum(count(path, "SELECT count(*) FROM rental") for path in paths),
+                              min(count(path, "SELECT min(rental_id) FROM rental") for path in paths),
+                              max(count(path, "SELECT max(rental_id) FROM rental") for path in paths)]]
+    assert query(proxy_client, "SELECT customer_id, count(*) FROM rental GROUP BY customer_id").status_code == 400
+
+def test_keyed_queries_run_on_their_shard(cluster, proxy_client):
+    shard = shard_of(cluster, 8)
+    assert shard != 'default'
+    response = query(proxy_client, "SELECT count(*) FROM rental WHERE customer_id = 8")
+    assert response.headers['X-Backend'].startswith('shard2-')
+    assert response.json == [[count(shard_path(cluster, shard), "SELECT count(*) FROM rental WHERE customer_id = 8")]]
+
+    before = count(shard_path(cluster, shard), "SELECT count(*) FROM rental")
+    response = query(proxy_client, "INSERT INTO rental (rental_date, inventory_id, customer_id, staff_id) VALUES ('2006-01-01', 1, 8, 1)", 'WRITE',
+                     session=True)
+    assert response.status_code == 200
+    assert count(shard_path(cluster, shard), "SELECT count(*) FROM rental") == before + 1
+    token = response.headers['X-Session-Token']
+    assert token.startswith(f"{shard}@")
+    assert cluster.proxy.parse_position(token, shard) is not None
+    assert cluster.proxy.parse_position(token) is None
+
+def test_unsharded_writes_reach_every_shard(cluster, proxy_client):
+    response = query(proxy_client, "INSERT INTO actor (first_name, last_name) VALUES ('SHARDED', 'EVERYWHERE')", 'WRITE', session=True)
+    assert response.status_code == 200
+    for shard in cluster.proxy.shard_groups:
+        assert count(shard_path(cluster, shard), "SELECT count(*) FROM actor WHERE first_name = 'SHARDED'") == 1
+    token = response.headers['X-Session-Token']
+    assert all(cluster.proxy.parse_position(token, shard) is not None for shard in cluster.proxy.shard_groups)
+
+def test_batches_refuse_sharded_queries_and_writes(proxy_client):
+    response = proxy_client.post('/query/batch', json={'queries': [
+        {'query': 'SELECT 1 FROM rental', 'query_type': 'READ'},
+        {'query': "UPDATE actor SET last_name = 'X' WHERE actor_id = 1", 'query_type': 'WRITE'},
+        {'query': 'SELECT count(*) FROM actor WHERE actor_id = 1', 'query_type': 'READ'},
+    ]})
+    assert response.status_code == 200
+    assert 'error' in response.json[0] and 'error' in response.json[1]
+    assert response.json[2] == [[1]]
+
+def test_rows_are_concatenated_across_shards(cluster, proxy_client):
+    paths = [shard_path(cluster, shard) for shard in cluster.proxy.shard_groups]
+    keyed = "SELECT rental_id FROM rental WHERE customer_id = 5 OR customer_id = 8"
+    response = query(proxy_client, keyed)
+    assert response.status_code == 200
+    expected = [row for path in paths for row in fetch(path, keyed)]
+    assert sorted(row[0] for row in response.json) == sorted(row[0] for row in expected)
+    assert {shard_of(cluster, 5), shard_of(cluster, 8)} == set(cluster.proxy.shard_groups)
+
+    response = query(proxy_client, "SELECT rental_id FROM rental LIMIT 3")
+    assert len(response.json) == 3
+    assert query(proxy_client, "SELECT rental_id FROM rental LIMIT 3 OFFSET 2").status_code == 400
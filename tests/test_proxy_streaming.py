@@ -0,0 +1,26 @@
+import json
+
+def test_streamed_result_passes_every_hop_in_chunks(cluster, monkeypatch):
+    monkeypatch.setattr(cluster.proxy, "stream_chunk_size", 7)
+    read = "SELECT rental_id, customer_id FROM rental WHERE customer_id = 5 ORDER BY rental_id"
+    expected = cluster.proxy.app.test_client().post("/query", json={"query": read, "query_type": "READ"}).json
+    assert len(expected) > 1
+
+    response = cluster.gatekeeper.app.test_client().post("/", json={"query": read, "query_type": "READ", "stream": True}, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == expected
+
+def test_stream_over_every_shard_is_refused(proxy_client):
+    response = proxy_client.post("/query", json={"query": "SELECT * FROM rental", "query_type": "READ", "stream": True})
+    assert response.status_code == 400
+
+def test_direct_streams_need_no_worker(cluster, monkeypatch, proxy_client):
+    monkeypatch.setattr(cluster.proxy, "workers", [])
+    read = {"query": "SELECT actor_id FROM actor WHERE actor_id <= 3", "query_type": "READ", "stream": True}
+    response = proxy_client.post("/query", json=dict(read, mode="direct"))
+    assert response.status_code == 200
+    assert response.headers["X-Backend"] == cluster.proxy.node_key(cluster.proxy.manager)
+    assert response.get_data(as_text=True).splitlines() == ["[1]", "[2]", "[3]"]
+    assert proxy_client.post("/query", json=dict(read, mode="random")).status_code == 500
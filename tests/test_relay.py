@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+READ = {"query": "SELECT actor_id, first_name FROM actor WHERE actor_id <= 3 ORDER BY actor_id", "query_type": "READ"}
+
+@pytest.fixture
+def gatekeeper_client(cluster):
+    return cluster.gatekeeper.app.test_client()
+
+def test_body_is_relayed_byte_for_byte(gatekeeper_client, proxy_client):
+    relayed = gatekeeper_client.post("/", json=READ)
+    direct = proxy_client.post("/query", json=READ)
+    assert relayed.status_code == 200
+    assert relayed.content_type == direct.content_type
+    assert relayed.get_data() == direct.get_data()
+
+def test_upstream_errors_keep_their_status(gatekeeper_client, proxy_client):
+    stream_everywhere = {"query": "SELECT * FROM rental", "query_type": "READ", "stream": True}
+    relayed = gatekeeper_client.post("/", json=stream_everywhere)
+    assert relayed.status_code == 400
+    assert relayed.get_data() == proxy_client.post("/query", json=stream_everywhere).get_data()
+
+def test_session_token_reaches_the_client(cluster, gatekeeper_client):
+    response = gatekeeper_client.post("/", json={"query": "UPDATE actor SET last_update = CURRENT_TIMESTAMP WHERE actor_id = 9",
+                                                 "query_type": "WRITE", "session": True})
+    assert response.status_code == 200
+    assert cluster.proxy.parse_position(response.headers["X-Session-Token"]) is not None
+
+def test_calls_reuse_kept_alive_connections(cluster, gatekeeper_client):
+    upstreams = (cluster.gatekeeper.upstream, cluster.trusted_host.upstream)
+    def opened():
+        for upstream in upstreams:
+            upstream.collect_pool_metrics()
+        return [upstream.pool_opened._series.get((upstream.name,), 0) for upstream in upstreams]
+
+    def settled():
+        # The trusted host releases its connection to the proxy on its own server thread, just after the last byte was sent
+        time.sleep(0.1)
+        return [upstream.active for upstream in upstreams]
+
+    gatekeeper_client.post("/", json=READ).close()
+    before = opened()
+    active = settled()
+    assert all(before)
+    for _ in range(10):
+        response = gatekeeper_client.post("/", json=READ)
+        assert response.status_code == 200
+        response.close()
+    assert opened() == before
+    assert settled() == active
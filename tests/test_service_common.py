@@ -0,0 +1,53 @@
+import service_common
+
+def test_metrics_render_in_prometheus_format():
+    registry = []
+    requests = service_common.Metric(registry, "requests_total", "counter", "Requests.", ("path",))
+    latency = service_common.Metric(registry, "latency_seconds", "histogram", "Latency.")
+    requests.inc('/q"1')
+    latency.observe(0.003)
+    text = "".join(metric.render() for metric in registry)
+    assert 'requests_total{path="/q\\"1"} 1' in text
+    assert 'latency_seconds_bucket{le="0.0025"} 0' in text
+    assert 'latency_seconds_bucket{le="0.005"} 1' in text
+    assert "latency_seconds_count 1" in text
+
+def test_counted_retries_keep_counting_once_copied():
+    retries = []
+    retry = service_common.CountedRetry(total=2, on_retry=lambda: retries.append(1))
+    retry = retry.increment(method="GET", error=ConnectionError())
+    retry.increment(method="GET", error=ConnectionError())
+    assert len(retries) == 2
+
+def test_each_service_renders_its_own_metrics(cluster):
+    gatekeeper = cluster.gatekeeper.app.test_client().get("/metrics").get_data(as_text=True)
+    trusted_host = cluster.trusted_host.app.test_client().get("/metrics").get_data(as_text=True)
+    assert 'upstream_pool_size{upstream="trusted_host"}' in gatekeeper and 'upstream="proxy"' not in gatekeeper
+    assert 'upstream_pool_size{upstream="proxy"}' in trusted_host and "gatekeeper_" not in trusted_host
+
+def test_production_mode_serves_with_gunicorn_workers(monkeypatch):
+    from gunicorn.app.base import BaseApplication
+    monkeypatch.setattr(service_common, "server_mode", "production")
+    monkeypatch.setattr(service_common, "server_workers", 3)
+    monkeypatch.setattr(service_common, "server_threads", 4)
+    started = []
+    served = {}
+    def run(server):
+        served.update(bind=server.cfg.bind, workers=server.cfg.workers, threads=server.cfg.threads, worker_class=server.cfg.worker_class_str)
+        assert started == []
+        server.cfg.post_fork(None, None)
+        served["app"] = server.load()
+    monkeypatch.setattr(BaseApplication, "run", run)
+    app = object()
+    service_common.serve(app, 8080, on_worker_start=lambda: started.append(1))
+    assert served == {"bind": ["0.0.0.0:8080"], "workers": 3, "threads": 4, "worker_class": "gthread", "app": app}
+    assert started == [1]
+
+def test_development_mode_runs_flask(monkeypatch):
+    monkeypatch.setattr(service_common, "server_mode", "development")
+    calls = []
+    class App:
+        def run(self, host, port):
+            calls.append(("run", host, port))
+    service_common.serve(App(), 5000, on_worker_start=lambda: calls.append("start"))
+    assert calls == ["start", ("run", "0.0.0.0", 5000)]
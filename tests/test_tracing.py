@@ -0,0 +1,31 @@
+import json
+
+def span_names(response):
+    return [entry.strip().partition(";dur=")[0] for entry in response.headers["Server-Timing"].split(",")]
+
+def test_spans_of_every_hop_reach_the_client(cluster):
+    response = cluster.gatekeeper.app.test_client().post("/", json={"query": "SELECT count(*) FROM actor", "query_type": "READ", "mode": "random"})
+    assert response.status_code == 200
+    assert len(response.headers["X-Request-ID"]) == 32
+    assert response.headers["X-Backend"] in {cluster.proxy.node_key(w) for w in cluster.proxy.workers}
+    names = span_names(response)
+    for name in ("proxy_route", "proxy_conn", "proxy_db", "proxy", "trusted_host_upstream", "trusted_host",
+                 "gatekeeper_validate", "gatekeeper_upstream", "gatekeeper"):
+        assert name in names
+    assert names.index("proxy") < names.index("trusted_host") < names.index("gatekeeper")
+
+def test_request_id_is_kept_by_the_proxy(proxy_client):
+    response = proxy_client.post("/query", json={"query": "SELECT 1", "query_type": "READ"}, headers={"X-Request-ID": "abc123"})
+    assert response.headers["X-Request-ID"] == "abc123"
+
+def test_sampled_requests_go_to_the_trace_log(cluster, monkeypatch, tmp_path):
+    gatekeeper = cluster.gatekeeper
+    path = tmp_path / "traces.log"
+    monkeypatch.setattr(gatekeeper, "trace_sample_rate", 1.0)
+    monkeypatch.setattr(gatekeeper, "trace_log_path", str(path))
+    monkeypatch.setattr(gatekeeper, "trace_log", None)
+    response = gatekeeper.app.test_client().post("/", json={"query": "SELECT 1", "query_type": "READ"})
+    gatekeeper.trace_log.close()
+    record = json.loads(path.read_text())
+    assert (record["request_id"], record["route"], record["status"]) == (response.headers["X-Request-ID"], "/", 200)
+    assert set(record["spans"]) == set(span_names(response))
@@ -1,54 +1,223 @@
-from flask import Flask, request, jsonify
-import requests
-import json
-
-app = Flask(__name__)
-
-with open("instances_ips.json", "r") as f:
-    instance_ips = json.load(f)
-    proxy_ip = instance_ips["proxy_ip"]
-
-PROXY_URL = f"http://{proxy_ip}:5000"
-
-'''
-Description: A simple health check route that responds with a confirmation message to indicate that the Trusted Host is running and accessible.
-Outputs: A plain text message "Trusted Host OK" with a status code of 200 indicating that the Trusted Host is operational.
-'''
-@app.route("/", methods=["GET"])
-def health_check():
-    return "Trusted Host OK", 200
-
-'''
-Description: Handles GET and POST requests to the "/mode" endpoint. It forwards the request to a proxy server and returns the response from the proxy.
-Inputs: - For GET requests: None.
-        - For POST requests: JSON body (dict) containing data to be sent to the proxy.
-Outputs: JSON response from the proxy server.
-'''
-@app.route("/mode", methods=["GET", "POST"])
-def process_mode():
-    data = request.json if request.method == "POST" else {}
-    try:
-        if request.method == "GET":
-            response = requests.get(f"{PROXY_URL}/mode")
-        else:
-            response = requests.post(f"{PROXY_URL}/mode", json=data)
-        return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 500
-
-'''
-Description: Forwards incoming POST requests with a query to a proxy server and returns the response from the proxy.
-Inputs: JSON body (dict) containing the query data to be forwarded to the proxy server.
-Outputs: JSON response from the proxy server, along with the corresponding HTTP status code.
-'''
-@app.route("/query", methods=["POST"])
-def forward_query():
-    data = request.json
-    try:
-        response = requests.post(PROXY_URL, json=data)
-        return jsonify(response.json()), response.status_code
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": str(e)}), 500
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+from flask import Flask, g, request, jsonify
+from functools import partial
+import requests
+import time
+import uuid
+import json
+import os
+
+import service_common
+
+app = Flask(__name__)
+
+# The proxy can be set explicitly (e.g. by local_cluster.py), otherwise it is read from the IPs exported by main.py
+PROXY_URL = os.getenv("PROXY_URL")
+
+if not PROXY_URL:
+    with open("instances_ips.json", "r") as f:
+        instance_ips = json.load(f)
+        proxy_ip = instance_ips["proxy_ip"]
+
+    PROXY_URL = f"http://{proxy_ip}:8080"
+
+# Calls to the proxy: timeouts in seconds (to connect, and to wait for data once connected), retries (see `service_common.CountedRetry`)
+# and connections kept alive, by default as many as the gatekeeper forwards requests at once
+upstream_connect_timeout = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3"))
+upstream_timeout = float(os.getenv("UPSTREAM_TIMEOUT", "30"))
+upstream_max_retries = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+upstream_retry_backoff = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.05"))
+upstream_pool_max_size = int(os.getenv("UPSTREAM_POOL_SIZE", "96"))
+
+# Deadlines: the time budget of a request in milliseconds when the gatekeeper passed none in the `X-Request-Budget-Ms` header, the largest accepted,
+# and how long a wait for the proxy may outlast the budget, the time the proxy has to answer with its own deadline error (see gatekeeper.py)
+default_deadline_ms = float(os.getenv("DEFAULT_DEADLINE_MS", "30000"))
+max_deadline_ms = float(os.getenv("MAX_DEADLINE_MS", "60000"))
+deadline_grace = float(os.getenv("DEADLINE_GRACE", "0.5"))
+
+metrics_registry = []  # every Metric, in the order they are rendered on the `/metrics` endpoint
+Metric = partial(service_common.Metric, metrics_registry)
+
+http_requests = Metric("http_requests_total", "counter", "HTTP requests handled, by method, route and status code.", ("method", "route", "status"))
+http_request_latency = Metric("http_request_duration_seconds", "histogram",
+                              "Time to handle an HTTP request, up to the response headers for streamed responses, by method and route.", ("method", "route"))
+
+'''
+Description: Records the start time of every request, for the per-route latency histogram, and picks up the request ID and the remaining
+time budget (`X-Request-Budget-Ms`) set by the gatekeeper. A request whose budget was spent before it arrived is answered at once.
+Outputs: None, or a 504 JSON error response if the budget is already spent.
+'''
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    try:
+        budget = float(request.headers.get("X-Request-Budget-Ms", default_deadline_ms))
+    except ValueError:
+        budget = default_deadline_ms
+    g.deadline = time.monotonic() + min(budget, max_deadline_ms) / 1000
+    if budget <= 0:
+        deadline_exceeded.inc("arrival")
+        return jsonify({"error": "Deadline exceeded"}), 504
+    return None
+
+'''
+Description: Records the count and latency of every request, labelled with the route that matched it rather than the raw path.
+Inputs: response (flask.Response) - The response about to be sent.
+Outputs: flask.Response - The same response.
+'''
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if "request_start" in g:
+        http_request_latency.observe(time.perf_counter() - g.request_start, request.method, route)
+    http_requests.inc(request.method, route, str(response.status_code))
+    return response
+
+'''
+Description: Adds the request ID and the timing breakdown to every response. The `Server-Timing` header carries the spans reported by the
+proxy, then 'trusted_host_upstream' (waiting for the proxy) and 'trusted_host' (the whole request in this service), in milliseconds.
+For a streamed result, the spans stop when the first rows are about to be sent.
+Inputs: response (flask.Response) - The response about to be sent.
+Outputs: flask.Response - The same response with the `X-Request-ID` and `Server-Timing` headers.
+'''
+@app.after_request
+def add_trace_headers(response):
+    timings = [g.upstream_timing] if g.get("upstream_timing") else []
+    if "upstream_duration" in g:
+        timings.append(f"trusted_host_upstream;dur={g.upstream_duration * 1000:.3f}")
+    if "request_start" in g:
+        timings.append(f"trusted_host;dur={(time.perf_counter() - g.request_start) * 1000:.3f}")
+    response.headers["Server-Timing"] = ", ".join(timings)
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+deadline_exceeded = Metric("deadline_exceeded_total", "counter", "Requests answered with a 504 because their deadline passed, by stage: on arrival or waiting for the proxy.", ("stage",))
+
+'''
+Description: Raised when the deadline of the current request has passed; answered with a 504 (see `deadline_exceeded_response`).
+'''
+class DeadlineExceeded(Exception):
+    pass
+
+'''
+Description: Returns the time left to the current request before its deadline.
+Outputs: float - The remaining budget in seconds, negative once the deadline has passed.
+'''
+def remaining_budget():
+    return g.deadline - time.monotonic()
+
+'''
+Description: Answers a request whose deadline passed with a distinct error, so that the client can tell it from a failure of the backend.
+Inputs: e (DeadlineExceeded) - The exception raised.
+Outputs: JSON error response with a 504 status code.
+'''
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded_response(e):
+    return jsonify({"error": "Deadline exceeded"}), 504
+
+# Calls to the proxy, over keep-alive connections shared by every request
+upstream = service_common.Upstream("proxy", metrics_registry, upstream_pool_max_size, upstream_max_retries, upstream_retry_backoff)
+
+'''
+Description: Sends a request to the proxy over the shared keep-alive session, under the current request ID, giving up after `UPSTREAM_CONNECT_TIMEOUT` seconds
+to connect or `UPSTREAM_TIMEOUT` seconds without data (at most the request's remaining budget), and records its latency and failures in the upstream metrics.
+The remaining budget is passed on in the `X-Request-Budget-Ms` header, for the proxy to enforce. The time spent waiting for the proxy and the timing spans it reported are kept for the `Server-Timing` header of the response.
+Inputs:
+    method (str) - The HTTP method.
+    path (str) - The path on the proxy, e.g. "/query".
+    **kwargs - Passed on to `requests.Session.request`. The response is expected to be relayed (see `service_common.Upstream.relay`), which releases its connection.
+Outputs: requests.Response - The response of the proxy.
+Raises: requests.exceptions.RequestException if the proxy cannot be reached, DeadlineExceeded if the request's deadline passed first.
+'''
+def call_upstream(method: str, path: str, **kwargs):
+    remaining = remaining_budget()
+    if remaining <= 0:
+        deadline_exceeded.inc("upstream")
+        raise DeadlineExceeded("Deadline exceeded before calling the proxy")
+    kwargs.setdefault("headers", {})["X-Request-ID"] = g.request_id
+    kwargs["headers"]["X-Request-Budget-Ms"] = str(int(remaining * 1000))
+    kwargs.setdefault("timeout", (min(upstream_connect_timeout, remaining), min(upstream_timeout, remaining + deadline_grace)))
+    start = time.perf_counter()
+    upstream.track_connection(1)
+    try:
+        response = upstream.session.request(method, f"{PROXY_URL}{path}", **kwargs)
+    except requests.exceptions.RequestException as e:
+        upstream.track_connection(-1)
+        if remaining_budget() <= 0:
+            deadline_exceeded.inc("upstream")
+            raise DeadlineExceeded("Deadline exceeded waiting for the proxy") from e
+        upstream.errors.inc("proxy", path)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        upstream.latency.observe(elapsed, "proxy", path)
+        g.upstream_duration = g.get("upstream_duration", 0.0) + elapsed
+    if response.status_code >= 500:
+        upstream.errors.inc("proxy", path)
+    g.upstream_timing = response.headers.get("Server-Timing")
+    return response
+
+'''
+Description: Exposes request counts and latency histograms per route, and the latency, failures and connection pool of the calls to the proxy, in the Prometheus text format.
+Outputs: A plain text response in the Prometheus exposition format.
+'''
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    upstream.collect_pool_metrics()
+    return service_common.metrics_response(metrics_registry)
+
+'''
+Description: A simple health check route that responds with a confirmation message to indicate that the Trusted Host is running and accessible.
+Outputs: A plain text message "Trusted Host OK" with a status code of 200 indicating that the Trusted Host is operational.
+'''
+@app.route("/", methods=["GET"])
+def health_check():
+    return "Trusted Host OK", 200
+
+'''
+Description: Handles GET and POST requests to the "/mode" endpoint. It forwards the request to a proxy server and returns the response from the proxy.
+Inputs: - For GET requests: None.
+        - For POST requests: JSON body (dict) containing data to be sent to the proxy.
+Outputs: JSON response from the proxy server.
+'''
+@app.route("/mode", methods=["GET", "POST"])
+def process_mode():
+    try:
+        if request.method == "GET":
+            response = call_upstream("GET", "/mode", stream=True)
+        else:
+            response = call_upstream("POST", "/mode", stream=True, **service_common.raw_body())
+        return upstream.relay(response)
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": str(e)}), 500
+
+'''
+Description: Forwards incoming POST requests with a query to a proxy server and returns the response from the proxy.
+Neither the request nor the response is parsed: both are relayed as raw bytes (see `service_common.Upstream.relay`), and streamed (NDJSON) results as they arrive.
+Inputs: JSON body (dict) containing the query data to be forwarded to the proxy server.
+Outputs: JSON response from the proxy server, along with the corresponding HTTP status code.
+'''
+@app.route("/query", methods=["POST"])
+def forward_query():
+    try:
+        response = call_upstream("POST", "/query", stream=True, **service_common.raw_body())
+        return upstream.relay(response)
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": str(e)}), 500
+
+'''
+Description: Forwards incoming POST requests with a batch of queries to the proxy server's batch endpoint and relays its response as raw bytes.
+Inputs: JSON body (dict) containing the batch to be forwarded to the proxy server.
+Outputs: JSON response from the proxy server, along with the corresponding HTTP status code.
+'''
+@app.route("/query/batch", methods=["POST"])
+def forward_batch():
+    try:
+        response = call_upstream("POST", "/query/batch", stream=True, **service_common.raw_body())
+        return upstream.relay(response)
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": str(e)}), 500
+
+if __name__ == "__main__":
+    service_common.serve(app, 5000)
\ No newline at end of file